@@ -0,0 +1,62 @@
+#! /usr/bin/env python
+"""
+Exports the trained YOLO OD_model as a frozen inference graph.
+
+Builds yolo_body with a fixed input size and loads the trained weights, then folds the batch norms into the
+convolutions, fuses the attention layers, drops the regularizers and writes a single GraphDef with the weights as
+constants. The raw outputs of the exported graph are compared with the trained model on random input before it is
+written. Load it with YOLO(frozen_graph_path=...) or cfg.od_worker['frozen_graph_path']. Run it from the repository
+root:
+    python -m OD_model.export_frozen --output_path OD_model/logs/yolo-attention-log-multiply_pi/frozen_graph.pb
+"""
+
+import argparse
+import os
+
+import numpy as np
+from keras import backend as K
+from keras.layers import Input
+
+from OD_model.yolo import YOLO
+from OD_model.yolo3.freeze import inference_model, freeze_model
+from OD_model.yolo3.model import yolo_body, tiny_yolo_body
+
+parser = argparse.ArgumentParser(description='Export the YOLO OD_model as a frozen inference graph.')
+parser.add_argument('--model_path', default=YOLO.get_defaults('model_path'), help='Path to the trained .h5 file.')
+parser.add_argument('--anchors_path', default=YOLO.get_defaults('anchors_path'), help='Path to the anchors file.')
+parser.add_argument('--classes_path', default=YOLO.get_defaults('classes_path'), help='Path to the classes file.')
+parser.add_argument('--input_size', type=int, default=YOLO.get_defaults('model_image_size')[0],
+                    help='Width and height of the fixed model input, a multiple of 32.')
+parser.add_argument('--output_path', default=None,
+                    help='Path of the frozen graph, frozen_graph.pb next to the model by default.')
+parser.add_argument('--tolerance', type=float, default=1e-3, help='Allowed difference of the raw outputs.')
+
+
+def _main(args):
+    assert args.input_size % 32 == 0, 'Multiples of 32 required'
+    output_path = args.output_path or os.path.join(os.path.dirname(args.model_path), 'frozen_graph.pb')
+    with open(os.path.expanduser(args.anchors_path)) as f:
+        num_anchors = len(f.readline().split(',')) // 2
+    with open(os.path.expanduser(args.classes_path)) as f:
+        num_classes = len([c for c in f.readlines() if c.strip()])
+
+    # no training branches for batch norms which can not be folded
+    K.set_learning_phase(0)
+    input_shape = (args.input_size, args.input_size, 3)
+    model = tiny_yolo_body(Input(shape=input_shape), num_anchors//2, num_classes) \
+        if num_anchors == 6 else yolo_body(Input(shape=input_shape), num_anchors//3, num_classes)
+    model.load_weights(os.path.expanduser(args.model_path))
+    fused = inference_model(model, input_shape)
+    print('{} layers in the trained model, {} after folding'.format(len(model.layers), len(fused.layers)))
+
+    image_data = np.random.RandomState(0).uniform(size=(2,) + input_shape).astype('float32')
+    differences = [np.abs(a - b).max() for a, b in zip(model.predict(image_data), fused.predict(image_data))]
+    print('Largest difference of the raw outputs: {:.2e}'.format(max(differences)))
+    assert max(differences) <= args.tolerance, 'Folded model does not match the trained model'
+
+    graph_def = freeze_model(fused, output_path)
+    print('Frozen graph with {} nodes saved to {}'.format(len(graph_def.node), output_path))
+
+
+if __name__ == '__main__':
+    _main(parser.parse_args())
@@ -0,0 +1,52 @@
+#! /usr/bin/env python
+"""
+Converts the frozen inference graph of the YOLO OD_model to ONNX for the onnxruntime backend.
+
+The graph written by OD_model/export_frozen.py is converted with tf2onnx, keeping its NHWC input so the images are
+preprocessed the same way for every backend. The raw outputs of the ONNX model on ONNX Runtime are compared with
+the frozen graph on random input before the command returns. Use it with YOLO(backend='onnxruntime', onnx_path=...)
+or cfg.od_worker['backend']. This script requires tf2onnx and onnxruntime. Run it from the repository root:
+    python -m OD_model.export_onnx --frozen_graph OD_model/logs/yolo-attention-log-multiply_pi/frozen_graph.pb
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+
+import numpy as np
+import tensorflow as tf
+
+from OD_model.yolo import YOLO
+from OD_model.yolo3.backends import OnnxRuntimeBackend
+from OD_model.yolo3.freeze import INPUT_NAME, OUTPUT_NAME, load_frozen_graph
+
+parser = argparse.ArgumentParser(description='Convert the frozen YOLO OD_model graph to ONNX.')
+parser.add_argument('--frozen_graph', required=True, help='Graph written by OD_model/export_frozen.py.')
+parser.add_argument('--output_path', default=YOLO.get_defaults('onnx_path'), help='Path of the ONNX model.')
+parser.add_argument('--num_layers', type=int, default=3, help='Output layers of the model, 2 for tiny YOLO.')
+parser.add_argument('--opset', type=int, default=11, help='ONNX opset to convert to.')
+parser.add_argument('--tolerance', type=float, default=1e-3, help='Allowed difference of the raw outputs.')
+
+
+def _main(args):
+    outputs = [OUTPUT_NAME.format(l) + ':0' for l in range(args.num_layers)]
+    subprocess.check_call([sys.executable, '-m', 'tf2onnx.convert', '--graphdef', args.frozen_graph,
+                           '--inputs', INPUT_NAME + ':0', '--outputs', ','.join(outputs),
+                           '--opset', str(args.opset), '--output', args.output_path])
+
+    engine = OnnxRuntimeBackend(os.path.expanduser(args.output_path))
+    input_size = engine.input_size()
+    image_data = np.random.RandomState(0).uniform(size=(2,) + input_size + (3,)).astype('float32')
+    with tf.Graph().as_default() as graph:
+        frozen = load_frozen_graph(args.frozen_graph, args.num_layers, graph)
+        with tf.Session(graph=graph) as sess:
+            expected = sess.run(frozen.output, feed_dict={frozen.input: image_data})
+    differences = [np.abs(a - b).max() for a, b in zip(expected, engine.run(image_data))]
+    print('Largest difference of the raw outputs: {:.2e}'.format(max(differences)))
+    assert max(differences) <= args.tolerance, 'ONNX model does not match the frozen graph'
+    print('ONNX model saved to {}'.format(args.output_path))
+
+
+if __name__ == '__main__':
+    _main(parser.parse_args())
@@ -13,8 +13,11 @@ from keras.layers import Input
 from keras.models import load_model
 from keras.utils import multi_gpu_model
 
-from OD_model.yolo3.model import yolo_eval, yolo_body, tiny_yolo_body
-from OD_model.yolo3.utils import letterbox_image
+from OD_model.yolo3.backends import KerasBackend, OnnxRuntimeBackend
+from OD_model.yolo3.freeze import load_frozen_graph
+from OD_model.yolo3.model import yolo_eval, yolo_eval_batch, yolo_body, tiny_yolo_body
+from OD_model.yolo3.postprocess import yolo_postprocess
+from OD_model.yolo3.utils import letterbox_image, letterbox_image_into
 
 
 class YOLO(object):
@@ -26,6 +29,20 @@ class YOLO(object):
         "iou" : 0.45,
         "model_image_size" : (416, 416),
         "gpu_num" : 1,
+        "max_boxes" : 20,
+        # 'graph' filters boxes inside the TF session, 'numpy' in OD_model.yolo3.postprocess on the raw outputs
+        "postprocess" : 'graph',
+        # one NMS over all classes instead of one per class, numpy postprocess only
+        "class_agnostic" : False,
+        # graph written by OD_model/export_frozen.py, loaded instead of model_path. Fixes model_image_size
+        "frozen_graph_path" : None,
+        # 'keras' runs the TF session, 'onnxruntime' the model written by OD_model/export_onnx.py on the ONNX Runtime
+        # CPU engine, always with numpy postprocess
+        "backend" : 'keras',
+        "onnx_path": os.path.join('OD_model', 'logs', 'yolo-attention-log-multiply_pi', 'yolo.onnx'),
+        # onnxruntime thread pools, None for its defaults. The TF session is configured by whoever creates it
+        "intra_op_threads" : None,
+        "inter_op_threads" : None,
     }
 
     @classmethod
@@ -40,7 +57,8 @@ class YOLO(object):
         self.__dict__.update(kwargs) # and update with user overrides
         self.class_names = self._get_class()
         self.anchors = self._get_anchors()
-        self.sess = K.get_session()
+        assert self.backend in ('keras', 'onnxruntime'), 'Unknown backend ' + str(self.backend)
+        self.sess = K.get_session() if self.backend == 'keras' else None
         self.boxes, self.scores, self.classes = self.generate()
 
     def _get_class(self):
@@ -59,22 +77,25 @@ class YOLO(object):
 
     def generate(self):
         model_path = os.path.expanduser(self.model_path)
-        assert model_path.endswith('.h5'), 'Keras OD_model or weights must be a .h5 file.'
+        assert self.backend != 'keras' or self.frozen_graph_path or model_path.endswith('.h5'), \
+            'Keras OD_model or weights must be a .h5 file.'
 
         # Load OD_model, or construct OD_model and load weights.
         num_anchors = len(self.anchors)
         num_classes = len(self.class_names)
         is_tiny_version = num_anchors==6 # default setting
-        try:
-            self.yolo_model = load_model(model_path, compile=False)
-        except:
-            self.yolo_model = tiny_yolo_body(Input(shape=(None,None,3)), num_anchors//2, num_classes) \
-                if is_tiny_version else yolo_body(Input(shape=(None,None,3)), num_anchors//3, num_classes)
-            self.yolo_model.load_weights(self.model_path) # make sure OD_model, anchors and classes match
+        if self.backend == 'onnxruntime':
+            self.engine = OnnxRuntimeBackend(os.path.expanduser(self.onnx_path), self.intra_op_threads,
+                                             self.inter_op_threads)
+            self.model_image_size = self.engine.input_size()
+            # there is no graph to filter the boxes in
+            self.postprocess = 'numpy'
+        elif self.frozen_graph_path:
+            # batch norms folded and attention fused at export, the input size is part of the graph
+            self.yolo_model = load_frozen_graph(self.frozen_graph_path, 2 if is_tiny_version else 3, self.sess.graph)
+            self.model_image_size = tuple(self.yolo_model.input.shape.as_list()[1:3])
         else:
-            assert self.yolo_model.layers[-1].output_shape[-1] == \
-                num_anchors/len(self.yolo_model.output) * (num_classes + 5), \
-                'Mismatch between OD_model and given anchor and class sizes'
+            self.yolo_model = self.load_keras_model(model_path, num_anchors, num_classes, is_tiny_version)
 
         # print('{} OD_model, anchors, and classes loaded.'.format(model_path))
         # print(self.yolo_model.summary())
@@ -88,23 +109,48 @@ class YOLO(object):
         np.random.seed(10101)  # Fixed seed for consistent colors across runs.
         np.random.shuffle(self.colors)  # Shuffle colors to decorrelate adjacent classes.
         np.random.seed(None)  # Reset seed to default.
+        if self.backend == 'onnxruntime':
+            return None, None, None
 
         # Generate output tensor targets for filtered bounding boxes.
         self.input_image_shape = K.placeholder(shape=(2, ))
-        if self.gpu_num>=2:
+        if self.gpu_num>=2 and not self.frozen_graph_path:
             self.yolo_model = multi_gpu_model(self.yolo_model, gpus=self.gpu_num)
+        self.engine = KerasBackend(self.sess, self.yolo_model)
         boxes, scores, classes = yolo_eval(self.yolo_model.output, self.anchors,
-                len(self.class_names), self.input_image_shape,
+                len(self.class_names), self.input_image_shape, max_boxes=self.max_boxes,
                 score_threshold=self.score, iou_threshold=self.iou)
+        # Same filtering for a batch of images, with the (height, width) of every image fed separately.
+        self.input_image_shapes = K.placeholder(shape=(None, 2))
+        self.batch_boxes, self.batch_scores, self.batch_classes, self.batch_counts = yolo_eval_batch(
+                self.yolo_model.output, self.anchors, len(self.class_names), self.input_image_shapes,
+                max_boxes=self.max_boxes, score_threshold=self.score, iou_threshold=self.iou)
         return boxes, scores, classes
 
-    def detect_image(self, image, save=False):
-        # start = timer()
+    def load_keras_model(self, model_path, num_anchors, num_classes, is_tiny_version):
+        try:
+            yolo_model = load_model(model_path, compile=False)
+        except:
+            yolo_model = tiny_yolo_body(Input(shape=(None,None,3)), num_anchors//2, num_classes) \
+                if is_tiny_version else yolo_body(Input(shape=(None,None,3)), num_anchors//3, num_classes)
+            yolo_model.load_weights(model_path) # make sure OD_model, anchors and classes match
+        else:
+            assert yolo_model.layers[-1].output_shape[-1] == \
+                num_anchors/len(yolo_model.output) * (num_classes + 5), \
+                'Mismatch between OD_model and given anchor and class sizes'
+        return yolo_model
+
+    def preprocess(self, image, out=None):
+        """Letterboxes a PIL image to the model input and scales it to [0, 1], safe to call from several threads.
 
+        With a fixed model_image_size the result is written straight into out, e.g. a row of a reused batch buffer.
+        """
         if self.model_image_size != (None, None):
             assert self.model_image_size[0]%32 == 0, 'Multiples of 32 required'
             assert self.model_image_size[1]%32 == 0, 'Multiples of 32 required'
-            boxed_image = letterbox_image(image, tuple(reversed(self.model_image_size)))
+            if out is None:
+                out = np.empty(tuple(self.model_image_size) + (3,), dtype='float32')
+            return letterbox_image_into(image, out)
         else:
             new_image_size = (image.width - (image.width % 32),
                               image.height - (image.height % 32))
@@ -113,7 +159,17 @@ class YOLO(object):
 
         # print(image_data.shape)
         image_data /= 255.
+        return image_data
+
+    def detect_image(self, image, save=False):
+        # start = timer()
+
+        image_data = self.preprocess(image)
         image_data = np.expand_dims(image_data, 0)  # Add batch dimension.
+        if self.boxes is None:
+            # backends without a TF graph filter the boxes in numpy
+            return self.annotate(image.size, *self.detect_batch(image_data, [image.size])[0],
+                                 image if save is True else None)
 
         out_boxes, out_scores, out_classes = self.sess.run(
             [self.boxes, self.scores, self.classes],
@@ -125,9 +181,51 @@ class YOLO(object):
 
         # print('Found {} boxes for {}'.format(len(out_boxes), 'img'))
 
-        font = ImageFont.truetype(font=os.path.join('OD_model', 'font', 'FiraMono-Medium.otf'),
-                    size=np.floor(3e-2 * image.size[1] + 0.5).astype('int32'))
-        thickness = (image.size[0] + image.size[1]) // 300
+        # end = timer()
+        # print(end - start)
+        return self.annotate(image.size, out_boxes, out_scores, out_classes, image if save is True else None)
+
+    def detect_images(self, images, save=False):
+        """Detects objects on a list of images with one forward pass, returns one result per image like
+        detect_image. Images of different sizes can be mixed, model_image_size must be fixed."""
+        if not images:
+            return []
+        image_data = np.empty((len(images),) + tuple(self.model_image_size) + (3,), dtype='float32')
+        for image, out in zip(images, image_data):
+            self.preprocess(image, out)
+        detections = self.detect_batch(image_data, [image.size for image in images])
+        return [self.annotate(image.size, *detection, image if save is True else None)
+                for image, detection in zip(images, detections)]
+
+    def detect_batch(self, image_data, image_sizes):
+        """Runs the model on a batch of preprocessed images.
+
+        image_data is the stacked output of preprocess and image_sizes holds the (width, height) of every original
+        image. Returns (boxes, scores, classes) of every image, boxes in original image coordinates.
+        """
+        assert self.model_image_size != (None, None), 'Batched detection needs a fixed model_image_size'
+        if self.postprocess == 'numpy':
+            yolo_outputs = self.engine.run(image_data)
+            return yolo_postprocess(yolo_outputs, self.anchors, len(self.class_names), image_sizes,
+                                    max_boxes=self.max_boxes, score_threshold=self.score, iou_threshold=self.iou,
+                                    class_agnostic=self.class_agnostic)
+        out_boxes, out_scores, out_classes, out_counts = self.sess.run(
+            [self.batch_boxes, self.batch_scores, self.batch_classes, self.batch_counts],
+            feed_dict={
+                self.yolo_model.input: image_data,
+                self.input_image_shapes: [[height, width] for width, height in image_sizes],
+                K.learning_phase(): 0
+            })
+
+        return [(out_boxes[i, :count], out_scores[i, :count], out_classes[i, :count])
+                for i, count in enumerate(out_counts)]
+
+    def annotate(self, image_size, out_boxes, out_scores, out_classes, image=None):
+        """Turns the detections of one image into annotation dicts. If the image is given the boxes are drawn on it
+        and (image, annot) is returned."""
+        if image is not None:
+            font = ImageFont.truetype(font=os.path.join('OD_model', 'font', 'FiraMono-Medium.otf'),
+                        size=np.floor(3e-2 * image_size[1] + 0.5).astype('int32'))
         annot=[]
         for i, c in reversed(list(enumerate(out_classes))):
             predicted_class = self.class_names[c]
@@ -136,29 +234,28 @@ class YOLO(object):
 
             # label = '{} {:.2f}'.format(predicted_class, score)
             label = ''
-            lab = '{} {:.2f}'.format(predicted_class, score)
-            draw = ImageDraw.Draw(image)
-            label_size = draw.textsize(label, font)
 
             top, left, bottom, right = box
             top = max(0, np.floor(top + 0.5).astype('int32'))
             left = max(0, np.floor(left + 0.5).astype('int32'))
-            bottom = min(image.size[1], np.floor(bottom + 0.5).astype('int32'))
-            right = min(image.size[0], np.floor(right + 0.5).astype('int32'))
+            bottom = min(image_size[1], np.floor(bottom + 0.5).astype('int32'))
+            right = min(image_size[0], np.floor(right + 0.5).astype('int32'))
             # print(label, (left, top), (right, bottom))
             annot.append({'class': predicted_class, 'confidence_score': '{:.2f}'.format(score), 'left': str(left),
                           'top': str(top), 'right': str(right), 'bottom': str(bottom)})
 
-            if save is True:
+            if image is not None:
+                draw = ImageDraw.Draw(image)
+                label_size = draw.textsize(label, font)
                 if top - label_size[1] >= 0:
                     text_origin = np.array([left, top - label_size[1]])
                 else:
                     text_origin = np.array([left, top + 1])
 
                 # My kingdom for a good redistributable image drawing library.
-                for i in range(4):
+                for j in range(4):
                     draw.rectangle(
-                        [left + i, top + i, right - i, bottom - i],
+                        [left + j, top + j, right - j, bottom - j],
                         outline=self.colors[c])
                 draw.rectangle(
                     [tuple(text_origin), tuple(text_origin + label_size)],
@@ -166,13 +263,12 @@ class YOLO(object):
                 draw.text(text_origin, label, fill=(0, 0, 0), font=font)
                 del draw
 
-        # end = timer()
-        # print(end - start)
-        if save is True:
+        if image is not None:
             return image, annot
         else:
             return annot
-        
+
     def close_session(self):
-        self.sess.close()
+        if self.sess is not None:
+            self.sess.close()
 
@@ -0,0 +1,52 @@
+"""Inference backends running the YOLO body on a batch of preprocessed images.
+
+A backend only produces the raw outputs of yolo_body, boxes are decoded and filtered by the caller. KerasBackend runs
+the keras TF session, with the model loaded from the .h5 or a frozen graph. OnnxRuntimeBackend runs a model written
+by OD_model/export_onnx.py on the ONNX Runtime CPU engine, which does not need a TF session at all. onnxruntime is
+optional and only imported when its backend is used.
+"""
+
+from keras import backend as K
+
+
+class KerasBackend(object):
+    '''Runs the yolo_model of a keras TF session, a loaded .h5 or a FrozenModel'''
+    name = 'keras'
+
+    def __init__(self, sess, yolo_model):
+        self.sess = sess
+        self.yolo_model = yolo_model
+
+    def input_size(self):
+        '''(height, width) of the model input, None for sizes which are only known at run time'''
+        return tuple(self.yolo_model.input.shape.as_list()[1:3])
+
+    def run(self, image_data):
+        return self.sess.run(self.yolo_model.output, feed_dict={
+            self.yolo_model.input: image_data,
+            K.learning_phase(): 0
+        })
+
+
+class OnnxRuntimeBackend(object):
+    '''Runs an exported ONNX model on the ONNX Runtime CPU engine'''
+    name = 'onnxruntime'
+
+    def __init__(self, onnx_path, intra_op_threads=None, inter_op_threads=None):
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if intra_op_threads:
+            options.intra_op_num_threads = intra_op_threads
+        if inter_op_threads:
+            options.inter_op_num_threads = inter_op_threads
+        self.session = onnxruntime.InferenceSession(onnx_path, options, providers=['CPUExecutionProvider'])
+        self.input = self.session.get_inputs()[0]
+        # yolo_output_0, yolo_output_1, ... from the coarsest to the finest grid, as yolo_body returns them
+        self.output_names = sorted(output.name for output in self.session.get_outputs())
+
+    def input_size(self):
+        return tuple(size if isinstance(size, int) else None for size in self.input.shape[1:3])
+
+    def run(self, image_data):
+        return self.session.run(self.output_names, {self.input.name: image_data})
@@ -0,0 +1,147 @@
+"""Frozen inference graph of the YOLO body.
+
+The training model carries BatchNormalization layers after every darknet convolution, l2 regularizers, and the log
+multiply attention as a Lambda and a Multiply layer. inference_model rebuilds the body for inference only: batch
+norms are folded into the weights and biases of their convolutions, every attention is one Lambda computing
+x * log1p(relu(x)), regularizers are dropped and the input shape is fixed. freeze_model turns the variables into
+constants and removes training only nodes, so load_frozen_graph only has to import a single GraphDef.
+"""
+
+import os
+
+import numpy as np
+import tensorflow as tf
+from keras import backend as K
+from keras.engine import InputLayer
+from keras.layers import Input, Conv2D, Lambda, Multiply, BatchNormalization
+from keras.models import Model
+
+# Names of the input and output tensors in the frozen graph
+INPUT_NAME = 'image_input'
+OUTPUT_NAME = 'yolo_output_{}'
+
+
+class FrozenModel(object):
+    '''Input and output tensors of an imported frozen graph, used in place of the keras model'''
+    def __init__(self, input, output):
+        self.input = input
+        self.output = output
+
+
+def fused_attention(x):
+    '''Log multiply attention x * log(relu(x) + 1) as one layer, log1p saves the add'''
+    return x * tf.log1p(tf.nn.relu(x))
+
+
+def fold_batch_norm(conv_weights, bn):
+    '''Kernel and bias of a convolution with the batch norm following it folded in'''
+    kernel = conv_weights[0]
+    bias = conv_weights[1] if len(conv_weights) > 1 else np.zeros(kernel.shape[-1], dtype=kernel.dtype)
+    gamma, beta, mean, variance = bn.get_weights()
+    scale = gamma / np.sqrt(variance + bn.epsilon)
+    return [kernel * scale, (bias - mean) * scale + beta]
+
+
+def _inbound_layers(layer):
+    inbound = layer._inbound_nodes[0].inbound_layers
+    return inbound if isinstance(inbound, list) else [inbound]
+
+
+def _attention_input(layer):
+    '''Input x of a Multiply layer computing x * Lambda(x), None for any other layer'''
+    if not isinstance(layer, Multiply):
+        return None
+    inbound = _inbound_layers(layer)
+    for i, lambda_layer in enumerate(inbound):
+        other = inbound[1 - i] if len(inbound) == 2 else None
+        if isinstance(lambda_layer, Lambda) and other is not None and _inbound_layers(lambda_layer) == [other]:
+            return layer.get_input_at(0)[1 - i]
+    return None
+
+
+def _mapped(tensors, layer):
+    inputs = layer.get_input_at(0)
+    if isinstance(inputs, list):
+        return [tensors[x.name] for x in inputs]
+    return tensors[inputs.name]
+
+
+def inference_model(model, input_shape=(416, 416, 3)):
+    '''Rebuild a trained YOLO body for inference, the weights of model are copied or folded into the new layers.
+
+    Layers are visited in the topological order of model.layers and every output tensor of the trained model is
+    mapped to its counterpart in the new one.
+    '''
+    consumers = {}
+    for layer in model.layers:
+        for inbound in _inbound_layers(layer) if layer._inbound_nodes else []:
+            consumers.setdefault(inbound.name, []).append(layer)
+
+    def folded_bn(layer):
+        following = consumers.get(layer.name, [])
+        if len(following) == 1 and isinstance(following[0], BatchNormalization):
+            return following[0]
+        return None
+
+    inputs = Input(shape=input_shape, name=INPUT_NAME)
+    tensors = {}
+    for layer in model.layers:
+        output = layer.get_output_at(0)
+        if isinstance(layer, InputLayer):
+            tensors[output.name] = inputs
+        elif isinstance(layer, BatchNormalization) and isinstance(_inbound_layers(layer)[0], Conv2D) \
+                and folded_bn(_inbound_layers(layer)[0]) is layer:
+            # already part of the weights of the convolution
+            tensors[output.name] = _mapped(tensors, layer)
+        elif isinstance(layer, Lambda) and consumers.get(layer.name) \
+                and all(_attention_input(c) is not None for c in consumers.get(layer.name)):
+            # computed by the fused attention of the Multiply layer
+            continue
+        elif _attention_input(layer) is not None:
+            tensors[output.name] = Lambda(fused_attention, name=layer.name)(tensors[_attention_input(layer).name])
+        elif isinstance(layer, Conv2D):
+            config = layer.get_config()
+            config.update(kernel_regularizer=None, bias_regularizer=None, activity_regularizer=None)
+            weights = layer.get_weights()
+            bn = folded_bn(layer)
+            if bn is not None:
+                config['use_bias'] = True
+                weights = fold_batch_norm(weights, bn)
+            conv = Conv2D.from_config(config)
+            tensors[output.name] = conv(_mapped(tensors, layer))
+            conv.set_weights(weights)
+        else:
+            new_layer = type(layer).from_config(layer.get_config())
+            tensors[output.name] = new_layer(_mapped(tensors, layer))
+            new_layer.set_weights(layer.get_weights())
+    return Model(inputs, [tensors[output.name] for output in model.outputs])
+
+
+def freeze_model(model, output_path, sess=None):
+    '''Write the graph of a keras model with its variables as constants and training only nodes removed.'''
+    sess = sess or K.get_session()
+    with sess.graph.as_default():
+        outputs = [tf.identity(output, name=OUTPUT_NAME.format(l)) for l, output in enumerate(model.outputs)]
+    output_names = [output.op.name for output in outputs]
+    graph_def = tf.graph_util.convert_variables_to_constants(sess, sess.graph.as_graph_def(), output_names)
+    graph_def = tf.graph_util.remove_training_nodes(graph_def, protected_nodes=output_names)
+    try:
+        from tensorflow.tools.graph_transforms import TransformGraph
+        graph_def = TransformGraph(graph_def, [INPUT_NAME], output_names,
+                                   ['fold_constants(ignore_errors=true)', 'sort_by_execution_order'])
+    except ImportError:
+        pass
+    tf.io.write_graph(graph_def, os.path.dirname(output_path) or '.', os.path.basename(output_path), as_text=False)
+    return graph_def
+
+
+def load_frozen_graph(frozen_graph_path, num_layers, graph=None):
+    '''Import a graph written by freeze_model, returns a FrozenModel with its input and output tensors.'''
+    graph = graph or tf.get_default_graph()
+    graph_def = tf.GraphDef()
+    with open(os.path.expanduser(frozen_graph_path), 'rb') as f:
+        graph_def.ParseFromString(f.read())
+    with graph.as_default():
+        tensors = tf.import_graph_def(graph_def, name='frozen', return_elements=[INPUT_NAME + ':0'] +
+                                      [OUTPUT_NAME.format(l) + ':0' for l in range(num_layers)])
+    return FrozenModel(tensors[0], tensors[1:])
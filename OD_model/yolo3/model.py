@@ -173,7 +173,8 @@ def yolo_correct_boxes(box_xy, box_wh, input_shape, image_shape):
     box_hw = box_wh[..., ::-1]
     input_shape = K.cast(input_shape, K.dtype(box_yx))
     image_shape = K.cast(image_shape, K.dtype(box_yx))
-    new_shape = K.round(image_shape * K.min(input_shape/image_shape))
+    # min over the last axis so a batch of image shapes broadcast as (batch, 1, 1, 1, 2) is corrected per image
+    new_shape = K.round(image_shape * K.min(input_shape/image_shape, axis=-1, keepdims=True))
     offset = (input_shape-new_shape)/2./input_shape
     scale = input_shape/new_shape
     box_yx = (box_yx - offset) * scale
@@ -225,6 +226,11 @@ def yolo_eval(yolo_outputs,
     boxes = K.concatenate(boxes, axis=0)
     box_scores = K.concatenate(box_scores, axis=0)
 
+    return filter_boxes(boxes, box_scores, num_classes, max_boxes, score_threshold, iou_threshold)
+
+
+def filter_boxes(boxes, box_scores, num_classes, max_boxes=20, score_threshold=.6, iou_threshold=.5):
+    """Apply the score threshold and per class non max suppression to the boxes of one image."""
     mask = box_scores >= score_threshold
     max_boxes_tensor = K.constant(max_boxes, dtype='int32')
     boxes_ = []
@@ -249,6 +255,50 @@ def yolo_eval(yolo_outputs,
     return boxes_, scores_, classes_
 
 
+def yolo_eval_batch(yolo_outputs,
+                    anchors,
+                    num_classes,
+                    image_shapes,
+                    max_boxes=20,
+                    score_threshold=.6,
+                    iou_threshold=.5):
+    """Evaluate YOLO OD_model on a batch of images and return filtered boxes per image.
+
+    image_shapes holds the (height, width) of every original image. Results are padded to max_boxes * num_classes
+    boxes per image, counts holds the number of valid boxes of every image.
+    """
+    num_layers = len(yolo_outputs)
+    anchor_mask = [[6,7,8], [3,4,5], [0,1,2]] if num_layers==3 else [[3,4,5], [1,2,3]] # default setting
+    input_shape = K.shape(yolo_outputs[0])[1:3] * 32
+    batch_size = K.shape(yolo_outputs[0])[0]
+    image_shapes = K.reshape(image_shapes, [-1, 1, 1, 1, 2])
+    boxes = []
+    box_scores = []
+    for l in range(num_layers):
+        box_xy, box_wh, box_confidence, box_class_probs = yolo_head(yolo_outputs[l],
+            anchors[anchor_mask[l]], num_classes, input_shape)
+        _boxes = yolo_correct_boxes(box_xy, box_wh, input_shape, image_shapes)
+        boxes.append(K.reshape(_boxes, [batch_size, -1, 4]))
+        box_scores.append(K.reshape(box_confidence * box_class_probs, [batch_size, -1, num_classes]))
+    boxes = K.concatenate(boxes, axis=1)
+    box_scores = K.concatenate(box_scores, axis=1)
+
+    max_total = max_boxes * num_classes
+
+    def eval_image(inputs):
+        boxes_, scores_, classes_ = filter_boxes(inputs[0], inputs[1], num_classes, max_boxes,
+                                                 score_threshold, iou_threshold)
+        count = K.shape(scores_)[0]
+        padding = max_total - count
+        return (tf.pad(boxes_, [[0, padding], [0, 0]]), tf.pad(scores_, [[0, padding]]),
+                tf.pad(classes_, [[0, padding]]), count)
+
+    boxes_, scores_, classes_, counts = tf.map_fn(eval_image, (boxes, box_scores),
+                                                  dtype=(K.dtype(boxes), K.dtype(boxes), 'int32', 'int32'),
+                                                  back_prop=False)
+    return boxes_, scores_, classes_, counts
+
+
 def preprocess_true_boxes(true_boxes, input_shape, anchors, num_classes):
     '''Preprocess true boxes to training input format
 
@@ -0,0 +1,133 @@
+"""NumPy post-processing of raw YOLO outputs for a batch of images.
+
+Decodes the outputs of yolo_body the same way yolo_head and yolo_correct_boxes do in the graph, for all images of a
+batch at once, and filters them with greedy non max suppression following tf.image.non_max_suppression. Running it
+outside the graph allows changing thresholds, max boxes and class aware or class agnostic NMS without rebuilding the
+session.
+"""
+
+import numpy as np
+
+
+def anchor_masks(num_layers):
+    '''Anchor indexes used by every output layer, same default setting as yolo_eval'''
+    return [[6,7,8], [3,4,5], [0,1,2]] if num_layers==3 else [[3,4,5], [1,2,3]]
+
+
+def sigmoid(x):
+    return 1. / (1. + np.exp(-x))
+
+
+def correct_boxes(box_xy, box_wh, input_shape, image_shapes):
+    '''Get corrected boxes, image_shapes broadcasts against box_xy like (batch, 1, 1, 1, 2)'''
+    box_yx = box_xy[..., ::-1]
+    box_hw = box_wh[..., ::-1]
+    input_shape = input_shape.astype(box_yx.dtype)
+    image_shapes = image_shapes.astype(box_yx.dtype)
+    new_shape = np.round(image_shapes * np.min(input_shape/image_shapes, axis=-1, keepdims=True))
+    offset = (input_shape-new_shape)/2./input_shape
+    scale = input_shape/new_shape
+    box_yx = (box_yx - offset) * scale
+    box_hw = box_hw * scale
+
+    box_mins = box_yx - (box_hw / 2.)
+    box_maxes = box_yx + (box_hw / 2.)
+    boxes = np.concatenate([box_mins, box_maxes], axis=-1)
+
+    # Scale boxes back to original image shape.
+    boxes *= np.concatenate([image_shapes, image_shapes], axis=-1)
+    return boxes
+
+
+def decode(yolo_outputs, anchors, num_classes, image_shapes):
+    '''Convert raw outputs of a batch into boxes (batch, n, 4) as top, left, bottom, right in original image
+    coordinates and box scores (batch, n, num_classes)'''
+    masks = anchor_masks(len(yolo_outputs))
+    input_shape = np.array(yolo_outputs[0].shape[1:3]) * 32
+    image_shapes = np.asarray(image_shapes, dtype='float32').reshape(-1, 1, 1, 1, 2)
+    boxes = []
+    box_scores = []
+    for l, feats in enumerate(yolo_outputs):
+        batch_size, grid_h, grid_w = feats.shape[:3]
+        layer_anchors = np.asarray(anchors, dtype='float32')[masks[l]]
+        feats = np.asarray(feats, dtype='float32').reshape(
+            batch_size, grid_h, grid_w, len(layer_anchors), num_classes + 5)
+
+        grid_y, grid_x = np.meshgrid(np.arange(grid_h), np.arange(grid_w), indexing='ij')
+        grid = np.stack([grid_x, grid_y], axis=-1)[:, :, np.newaxis, :].astype('float32')
+        box_xy = (sigmoid(feats[..., :2]) + grid) / np.array([grid_w, grid_h], dtype='float32')
+        box_wh = np.exp(feats[..., 2:4]) * layer_anchors / input_shape[::-1].astype('float32')
+        box_confidence = sigmoid(feats[..., 4:5])
+        box_class_probs = sigmoid(feats[..., 5:])
+
+        boxes.append(correct_boxes(box_xy, box_wh, input_shape, image_shapes).reshape(batch_size, -1, 4))
+        box_scores.append((box_confidence * box_class_probs).reshape(batch_size, -1, num_classes))
+    return np.concatenate(boxes, axis=1), np.concatenate(box_scores, axis=1)
+
+
+def non_max_suppression(boxes, scores, max_boxes, iou_threshold):
+    '''Greedy NMS like tf.image.non_max_suppression, returns the kept indexes by descending score.
+
+    A box is dropped when its IoU with an already kept box is greater than iou_threshold.
+    '''
+    y_min = np.minimum(boxes[:, 0], boxes[:, 2])
+    x_min = np.minimum(boxes[:, 1], boxes[:, 3])
+    y_max = np.maximum(boxes[:, 0], boxes[:, 2])
+    x_max = np.maximum(boxes[:, 1], boxes[:, 3])
+    areas = (y_max - y_min) * (x_max - x_min)
+
+    order = np.argsort(-scores, kind='stable')
+    keep = []
+    while order.size and len(keep) < max_boxes:
+        i = order[0]
+        keep.append(i)
+        rest = order[1:]
+        inter_h = np.maximum(np.minimum(y_max[i], y_max[rest]) - np.maximum(y_min[i], y_min[rest]), 0.)
+        inter_w = np.maximum(np.minimum(x_max[i], x_max[rest]) - np.maximum(x_min[i], x_min[rest]), 0.)
+        intersection = inter_h * inter_w
+        union = areas[i] + areas[rest] - intersection
+        # boxes without area never overlap, as in tensorflow
+        valid = (areas[i] > 0) & (areas[rest] > 0)
+        iou = np.where(valid, intersection / np.where(valid, union, 1.), 0.)
+        order = rest[iou <= iou_threshold]
+    return np.array(keep, dtype='int64')
+
+
+def filter_boxes(boxes, box_scores, max_boxes=20, score_threshold=.6, iou_threshold=.5, class_agnostic=False):
+    '''Apply the score threshold and NMS to the boxes of one image.
+
+    Class aware NMS keeps up to max_boxes per class, ordered by class and then by score like yolo_eval. Class
+    agnostic NMS runs once over the best class of every box and keeps up to max_boxes in total.
+    '''
+    if class_agnostic:
+        classes = np.argmax(box_scores, axis=-1)
+        scores = box_scores[np.arange(len(classes)), classes]
+        mask = scores >= score_threshold
+        keep = non_max_suppression(boxes[mask], scores[mask], max_boxes, iou_threshold)
+        return boxes[mask][keep], scores[mask][keep], classes[mask][keep].astype('int32')
+
+    boxes_ = []
+    scores_ = []
+    classes_ = []
+    for c in range(box_scores.shape[-1]):
+        mask = box_scores[:, c] >= score_threshold
+        class_boxes = boxes[mask]
+        class_box_scores = box_scores[mask, c]
+        keep = non_max_suppression(class_boxes, class_box_scores, max_boxes, iou_threshold)
+        boxes_.append(class_boxes[keep])
+        scores_.append(class_box_scores[keep])
+        classes_.append(np.full(len(keep), c, dtype='int32'))
+    return np.concatenate(boxes_), np.concatenate(scores_), np.concatenate(classes_)
+
+
+def yolo_postprocess(yolo_outputs, anchors, num_classes, image_sizes, max_boxes=20, score_threshold=.6,
+                     iou_threshold=.5, class_agnostic=False):
+    '''Decode and filter the raw outputs of a batch.
+
+    yolo_outputs are the outputs of yolo_body for the batch and image_sizes holds the (width, height) of every
+    original image. Returns (boxes, scores, classes) of every image like YOLO.detect_batch.
+    '''
+    image_shapes = [[height, width] for width, height in image_sizes]
+    boxes, box_scores = decode(yolo_outputs, anchors, num_classes, image_shapes)
+    return [filter_boxes(image_boxes, image_box_scores, max_boxes, score_threshold, iou_threshold, class_agnostic)
+            for image_boxes, image_box_scores in zip(boxes, box_scores)]
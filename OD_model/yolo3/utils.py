@@ -31,6 +31,31 @@ def letterbox_image(image, size):
     new_image.paste(image, ((w-nw)//2, (h-nh)//2))
     return new_image
 
+def letterbox_image_into(image, out):
+    '''letterbox image into the float32 array out of shape (h, w, 3), scaled to [0, 1]
+
+    Gives the same values as np.array(letterbox_image(image, (w, h)), dtype='float32') / 255. without allocating the
+    canvas and the intermediate arrays, so out can be a slice of a reused batch buffer.
+    '''
+    iw, ih = image.size
+    h, w = out.shape[:2]
+    scale = min(w/iw, h/ih)
+    nw = int(iw*scale)
+    nh = int(ih*scale)
+
+    image = image.resize((nw,nh), Image.BICUBIC)
+    if image.mode != 'RGB':
+        # paste converts onto the RGB canvas the same way
+        image = image.convert('RGB')
+    left, top = (w-nw)//2, (h-nh)//2
+    grey = np.float32(128) / np.float32(255)
+    out[:top] = grey
+    out[top+nh:] = grey
+    out[top:top+nh, :left] = grey
+    out[top:top+nh, left+nw:] = grey
+    np.divide(np.asarray(image), np.float32(255), out=out[top:top+nh, left:left+nw], dtype=np.float32)
+    return out
+
 def rand(a=0, b=1):
     return np.random.rand()*(b-a) + a
 
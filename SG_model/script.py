@@ -69,7 +69,11 @@ model.compile(optimizer = Adam(lr = 1e-4), loss =blance_loss, metrics = ['accura
 model.load_weights(os.path.join('SG_model','model.h5'))
 
 def predict_(input_img):
-    input_=np.array(cv2.imread(str(input_img)))
+    # input_img is an image path or an already decoded BGR array, e.g. from image_loader.load_array
+    if isinstance(input_img, np.ndarray):
+        input_ = input_img
+    else:
+        input_=np.array(cv2.imread(str(input_img)))
     input_ = cv2.resize(input_, (256,256), interpolation = cv2.INTER_NEAREST)
     input_=input_.reshape(1,256,256,3)
     input_=input_/255
@@ -10,13 +10,14 @@ This script can also be imported as a module and contains the ODApiCall class.
 import operator
 from datetime import datetime, timedelta
 import enum
-from typing import Optional, Dict
+from typing import Optional, Dict, List
 
 import numpy as np
 from pymongo import MongoClient
 
 # noinspection PyUnresolvedReferences
 import cfg
+import predictions
 
 # Mongo initialization
 client = MongoClient(cfg.mongo_cfg.get('db_server').get('host'), int(cfg.mongo_cfg.get('db_server').get('port')))
@@ -55,11 +56,11 @@ class ODApiCall:
     -------
     image_count(camid=None)
         Calculates total number of images of all camera nodes or a specific camera node if camid is specified
-    trash_count(camid=None, date=None)
+    trash_count(camid=None, date=None, min_score=None, iou=None)
         Calculates total number of trash detected according to parameters specified.
-    day_graph(camid=None, date=None)
+    day_graph(camid=None, date=None, min_score=None, iou=None)
         Calculates number of trash according to time for a specified day.
-    range_graph(start_date, end_date, date_format='%Y%m%d', camid=None)
+    range_graph(start_date, end_date, date_format='%Y%m%d', camid=None, min_score=None, iou=None)
         Calculates total number of trash per day between specified date range
     max_trash_hours(camid=None)
         Calculates the time for maximum trash detected during the day
@@ -67,6 +68,11 @@ class ODApiCall:
         Calculates Day of the month which gives the maximum trash
     max_trash_month(camid=None)
         Calculates month which gives maximum trash over the year in the dataset
+
+    The counting methods take min_score and iou to apply a score threshold and NMS to the stored boxes at query time,
+    which approximates running the model at that operating point. Without them, or at the model's default operating
+    point, the od_count written by the OD worker is used. Otherwise the boxes of all matching documents are filtered
+    at once with predictions.count_many.
     """
 
     def __init__(self, db: str, clc: str):
@@ -104,7 +110,8 @@ class ODApiCall:
             return self.collection.find({"cam_id": camid}).count()
 
     # get documents that contain predictions
-    def prediction_documents(self, camid: Optional[str] = None, date: Optional[str] = None):
+    def prediction_documents(self, camid: Optional[str] = None, date: Optional[str] = None,
+                             projection: Optional[Dict] = None):
         """
         Retrieves all present data or data specific to defined parameters from the database
 
@@ -114,6 +121,8 @@ class ODApiCall:
             Camera ID of camera node for which the data is supposed to be retrieved (Default is None).
         date : str, optional
             Date for which the data is supposed to be retrieved (Default is None).
+        projection : Dict, optional
+            Fields to be retrieved, e.g. {'od_count': 1} to leave out the box arrays (Default is None for all fields).
 
         Returns
         -------
@@ -122,20 +131,96 @@ class ODApiCall:
         """
 
         if camid is None and date is None:
-            documents = self.collection.find({"OD_Predictions": {"$exists": True}})
+            documents = self.collection.find({"OD_Predictions": {"$exists": True}}, projection)
 
         elif camid is None and date is not None:
-            documents = self.collection.find({"date": date, "OD_Predictions": {"$exists": True}})
+            documents = self.collection.find({"date": date, "OD_Predictions": {"$exists": True}}, projection)
 
         elif camid is not None and date is None:
-            documents = self.collection.find({"cam_id": camid, "OD_Predictions": {"$exists": True}})
+            documents = self.collection.find({"cam_id": camid, "OD_Predictions": {"$exists": True}}, projection)
 
         else:
-            documents = self.collection.find({"cam_id": camid, "date": date, "OD_Predictions": {"$exists": True}})
+            documents = self.collection.find({"cam_id": camid, "date": date, "OD_Predictions": {"$exists": True}},
+                                             projection)
 
         return documents
 
-    def trash_count(self, camid: Optional[str] = None, date: Optional[str] = None):
+    @staticmethod
+    def count_projection(fields: Dict, min_score: Optional[float] = None, iou: Optional[float] = None) -> Dict:
+        """
+        Returns the projection needed to count the trash of documents
+
+        Parameters
+        ----------
+        fields : Dict
+            Other fields to be retrieved
+        min_score : float, optional
+            Score threshold applied at query time (Default is None)
+        iou : float, optional
+            NMS IoU threshold applied at query time (Default is None, the model's IoU when min_score is given)
+
+        Returns
+        -------
+        projection : Dict
+            fields with od_count, or the box arrays when thresholds are applied at query time
+        """
+
+        if predictions.at_default(min_score, iou):
+            return dict(fields, od_count=1)
+        return dict(fields, OD_Predictions=1)
+
+    @staticmethod
+    def document_count(document: Dict, min_score: Optional[float] = None, iou: Optional[float] = None) -> int:
+        """
+        Returns the number of trash predictions of a document
+
+        Parameters
+        ----------
+        document : Dict
+            Document retrieved with count_projection
+        min_score : float, optional
+            Only boxes with at least this score are counted (Default is None)
+        iou : float, optional
+            NMS IoU threshold applied to the stored boxes (Default is None, the model's IoU when min_score is given)
+
+        Returns
+        -------
+        count : int
+            od_count, or the number of stored boxes kept at min_score and iou
+        """
+
+        if predictions.at_default(min_score, iou):
+            return document.get("od_count", 0)
+        return predictions.count(document.get("OD_Predictions", {}), min_score, iou)
+
+    @staticmethod
+    def document_counts(documents: List[Dict], min_score: Optional[float] = None,
+                        iou: Optional[float] = None) -> List[int]:
+        """
+        Returns the number of trash predictions of every document, filtering the boxes of all of them at once
+
+        Parameters
+        ----------
+        documents : list
+            Documents retrieved with count_projection
+        min_score : float, optional
+            Only boxes with at least this score are counted (Default is None)
+        iou : float, optional
+            NMS IoU threshold applied to the stored boxes (Default is None, the model's IoU when min_score is given)
+
+        Returns
+        -------
+        counts : list
+            od_count, or the number of stored boxes kept at min_score and iou, of every document
+        """
+
+        if predictions.at_default(min_score, iou):
+            return [document.get("od_count", 0) for document in documents]
+        return predictions.count_many([document.get("OD_Predictions", {}) for document in documents],
+                                      min_score, iou).tolist()
+
+    def trash_count(self, camid: Optional[str] = None, date: Optional[str] = None,
+                    min_score: Optional[float] = None, iou: Optional[float] = None):
         """
         Calculates total number of trash detected according to parameters specified.
 
@@ -145,6 +230,10 @@ class ODApiCall:
             Camera ID of camera node for which the data is supposed to be retrieved (Default is None).
         date : str, optional
             Date for which the data is supposed to be retrieved (Default is None).
+        min_score : float, optional
+            Only boxes with at least this score are counted, applied to the stored boxes (Default is None)
+        iou : float, optional
+            NMS IoU threshold applied to the stored boxes (Default is None, the model's IoU when min_score is given)
 
         Returns
         -------
@@ -152,15 +241,14 @@ class ODApiCall:
             Total number of trash predictions
         """
 
-        documents = self.prediction_documents(camid=camid, date=date)
-        count = 0
-        for document in documents:
-            pred = document.get("OD_Predictions")
-            count += len(pred)
+        # the boxes are only fetched when thresholds are applied at query time, otherwise just the precomputed count
+        documents = list(self.prediction_documents(camid=camid, date=date,
+                                                   projection=self.count_projection({}, min_score, iou)))
 
-        return count
+        return sum(self.document_counts(documents, min_score, iou))
 
-    def day_graph(self, camid: Optional[str] = None, date: Optional[str] = None):
+    def day_graph(self, camid: Optional[str] = None, date: Optional[str] = None,
+                  min_score: Optional[float] = None, iou: Optional[float] = None):
         """
         Calculates number of trash according to time for a specified day.
 
@@ -170,25 +258,26 @@ class ODApiCall:
             Camera ID of camera node for which the data is supposed to be retrieved.
         date : str, optional
             Date for which the data is supposed to be retrieved
+        min_score : float, optional
+            Only boxes with at least this score are counted, applied to the stored boxes (Default is None)
+        iou : float, optional
+            NMS IoU threshold applied to the stored boxes (Default is None, the model's IoU when min_score is given)
 
         Returns
         -------
         Dict containing times of the day with their corresponding number of trash detected
         """
 
-        documents = self.prediction_documents(camid=camid, date=date)
+        documents = list(self.prediction_documents(camid=camid, date=date,
+                                                   projection=self.count_projection({"time": 1}, min_score, iou)))
 
-        times = []
-        count = []
-
-        for document in documents:
-            pred = document.get("OD_Predictions")
-            times.append(document.get("time"))
-            count.append(len(pred))
+        times = [document.get("time") for document in documents]
+        count = self.document_counts(documents, min_score, iou)
 
         return dict(zip(times, count))
 
-    def range_graph(self, start_date: str, end_date: str, date_format: Optional[str] = '%Y-%m-%d', camid: Optional[str] = None):
+    def range_graph(self, start_date: str, end_date: str, date_format: Optional[str] = '%Y-%m-%d',
+                    camid: Optional[str] = None, min_score: Optional[float] = None, iou: Optional[float] = None):
         """
         Calculates total number of trash per day between specified date range
 
@@ -202,6 +291,10 @@ class ODApiCall:
             Date format of the starting and ending date (Default is '%Y-%m-%d')
         camid : str, optional
             Camera ID of camera node for which the data is supposed to be retrieved (Default is None)
+        min_score : float, optional
+            Only boxes with at least this score are counted, applied to the stored boxes (Default is None)
+        iou : float, optional
+            NMS IoU threshold applied to the stored boxes (Default is None, the model's IoU when min_score is given)
 
         Returns
         -------
@@ -215,23 +308,26 @@ class ODApiCall:
 
         count = np.zeros(len(dates))
         if camid is None:
-            documents = self.collection.find({"date": {'$in': dates}, "OD_Predictions": {"$exists": True}})
+            documents = self.collection.find({"date": {'$in': dates}, "OD_Predictions": {"$exists": True}},
+                                             self.count_projection({"date": 1}, min_score, iou))
         else:
             documents = self.collection.find({"cam_id": camid, "date": {'$in': dates},
-                                              "OD_Predictions": {"$exists": True}})
+                                              "OD_Predictions": {"$exists": True}},
+                                             self.count_projection({"date": 1}, min_score, iou))
 
+        documents = list(documents)
         dates = np.array(dates)
-        for document in documents:
-            pred = document.get("OD_Predictions")
+        for document, document_count in zip(documents, self.document_counts(documents, min_score, iou)):
             date = document.get("date")
             # Find index of the date in dates array
             index = np.where(dates == date)[0]
             # Add total number of trash detected to the corresponding index
-            count[index] += len(pred)
+            count[index] += document_count
 
         return dict(zip(dates, count))
 
-    def max_trash_hours(self, camid: Optional[str] = None):
+    def max_trash_hours(self, camid: Optional[str] = None, min_score: Optional[float] = None,
+                        iou: Optional[float] = None):
         """
         Calculates the time for maximum trash detected during the day
 
@@ -239,6 +335,10 @@ class ODApiCall:
         ----------
         camid : str, optional
             Camera ID of camera node for which the data is supposed to be retrieved (Default is None)
+        min_score : float, optional
+            Only boxes with at least this score are counted, applied to the stored boxes (Default is None)
+        iou : float, optional
+            NMS IoU threshold applied to the stored boxes (Default is None, the model's IoU when min_score is given)
 
         Returns
         -------
@@ -246,15 +346,11 @@ class ODApiCall:
             Hour for which the trash detected is maximum during the day
         """
 
-        documents = self.prediction_documents(camid=camid)
+        documents = list(self.prediction_documents(camid=camid,
+                                                   projection=self.count_projection({"time": 1}, min_score, iou)))
 
-        times = []
-        count = []
-
-        for document in documents:
-            pred = document.get("OD_Predictions")
-            times.append(document.get("time"))
-            count.append(len(pred))
+        times = [document.get("time") for document in documents]
+        count = self.document_counts(documents, min_score, iou)
 
         # time filtering
         u_times = list(set(times))
@@ -279,7 +375,7 @@ class ODApiCall:
         return max_hour
 
     @staticmethod
-    def day_data_filtering(documents: Dict):
+    def day_data_filtering(documents: Dict, min_score: Optional[float] = None, iou: Optional[float] = None):
         """
         Calculates total trash detected for each date in the database
 
@@ -287,6 +383,10 @@ class ODApiCall:
         ----------
         documents : Dict
             Dictionary containing dictionaries of data for each image
+        min_score : float, optional
+            Only boxes with at least this score are counted, applied to the stored boxes (Default is None)
+        iou : float, optional
+            NMS IoU threshold applied to the stored boxes (Default is None, the model's IoU when min_score is given)
 
         Returns
         -------
@@ -295,12 +395,9 @@ class ODApiCall:
         """
 
         # All data with predictions but it has to be filtered to get total trash in a single date
-        count_data = []
-        dates_data = []
-
-        for document in documents:
-            dates_data.append(document.get("date"))
-            count_data.append(len(document.get("OD_Predictions")))
+        documents = list(documents)
+        dates_data = [document.get("date") for document in documents]
+        count_data = ODApiCall.document_counts(documents, min_score, iou)
 
         # Converting all data into single day
         dates = list(set(dates_data))
@@ -313,7 +410,8 @@ class ODApiCall:
             trash_count_days.update({date: trash_count})
         return trash_count_days
 
-    def max_trash_days(self, camid: Optional[str] = None):
+    def max_trash_days(self, camid: Optional[str] = None, min_score: Optional[float] = None,
+                       iou: Optional[float] = None):
         """
         Calculates Day of the month which gives the maximum trash
 
@@ -321,6 +419,10 @@ class ODApiCall:
         ----------
         camid : str, optional
             Camera ID of camera node for which the data is supposed to be retrieved (Default is None)
+        min_score : float, optional
+            Only boxes with at least this score are counted, applied to the stored boxes (Default is None)
+        iou : float, optional
+            NMS IoU threshold applied to the stored boxes (Default is None, the model's IoU when min_score is given)
 
         Returns
         -------
@@ -328,13 +430,14 @@ class ODApiCall:
             Day which gives the maximum trash predictions in the month over the whole dataset
         """
 
-        documents = self.prediction_documents(camid=camid)
+        documents = list(self.prediction_documents(camid=camid,
+                                                   projection=self.count_projection({"date": 1}, min_score, iou)))
 
         total_days_month = np.zeros(31)
-        for document in documents:
+        for document, document_count in zip(documents, self.document_counts(documents, min_score, iou)):
             date = document.get("date")
             day_index = int(date.split('-')[2])
-            total_days_month[day_index] += len(documents.get("OD_Predictions"))
+            total_days_month[day_index] += document_count
         max_day = str(max(total_days_month))
 
         # trash_count_days = self.day_data_filtering(documents)
@@ -349,7 +452,8 @@ class ODApiCall:
 
         return max_day
 
-    def max_trash_month(self, camid: Optional[str] = None):
+    def max_trash_month(self, camid: Optional[str] = None, min_score: Optional[float] = None,
+                        iou: Optional[float] = None):
         """
         Calculates month which gives maximum trash over the year in the dataset
 
@@ -357,6 +461,10 @@ class ODApiCall:
         ----------
         camid : str, optional
             Camera ID of camera node for which the data is supposed to be retrieved (Default is None)
+        min_score : float, optional
+            Only boxes with at least this score are counted, applied to the stored boxes (Default is None)
+        iou : float, optional
+            NMS IoU threshold applied to the stored boxes (Default is None, the model's IoU when min_score is given)
 
         Returns
         -------
@@ -364,9 +472,10 @@ class ODApiCall:
             Name of the month which gives maximum trash
         """
 
-        documents = self.prediction_documents(camid=camid)
+        documents = self.prediction_documents(camid=camid,
+                                              projection=self.count_projection({"date": 1}, min_score, iou))
 
-        trash_count_days = self.day_data_filtering(documents)
+        trash_count_days = self.day_data_filtering(documents, min_score, iou)
 
         trash_count_month = {}
 
@@ -8,6 +8,8 @@ The app routes on the following links on the default port 5000:
     * /max_trash_day - Calls max_trash_days function from the ODApiCall class in api_calls module
     * /max_trash_month - Calls range_graph function from the ODApiCall class in api_calls module
 
+OD requests can add "min_score" and "iou" to count the stored boxes at another score and NMS threshold.
+
 Examples
 curl -H "Content-Type: application/json" -X POST -d '{"start_date":"2020-04-26", "end_date":"2020-04-28",
 "camid": "lums2"}'  http://0.0.0.0:5000/range_graph
@@ -23,6 +25,56 @@ od_api = ODApiCall(cfg.mongo_cfg.get('db_name'), cfg.mongo_cfg.get('db_raw_clc')
 sg_api = SGApiCall(cfg.mongo_cfg.get('db_name'), cfg.mongo_cfg.get('db_raw_clc'))
 
 
+# threshold -> (check of its value, description of the valid range)
+THRESHOLD_RANGES = {'min_score': (lambda value: 0 <= value <= 1, '0 <= min_score <= 1'),
+                    'iou': (lambda value: 0 < value <= 1, '0 < iou <= 1')}
+
+
+class InvalidThreshold(ValueError):
+    """
+    Raised for a min_score or iou in a request which is not a number in its valid range
+    """
+
+
+@app.errorhandler(InvalidThreshold)
+def invalid_threshold(error):
+    resp = jsonify({'status': False, 'message': str(error)})
+    resp.status_code = 400
+    return resp
+
+
+def thresholds(data, api):
+    """
+    Returns the min_score and iou of a request as keyword arguments for the api that serves it, only the OD api
+    applies them at query time
+
+    Returns
+    -------
+    kwargs : Dict
+        min_score and iou as floats if they are in the request and the api is the OD api
+
+    Raises
+    ------
+    InvalidThreshold
+        If min_score or iou is not a number in its valid range, answered with a 400
+    """
+
+    if not isinstance(api, ODApiCall):
+        return {}
+    kwargs = {}
+    for key, (valid, description) in THRESHOLD_RANGES.items():
+        if key not in data:
+            continue
+        try:
+            value = float(data[key])
+        except (TypeError, ValueError):
+            raise InvalidThreshold('{} must be a number, got {!r}'.format(key, data[key]))
+        if not valid(value):
+            raise InvalidThreshold('{} must satisfy {}, got {}'.format(key, description, value))
+        kwargs[key] = value
+    return kwargs
+
+
 @app.route('/day_graph', methods=['POST'])
 def day_graph():
     """
@@ -47,9 +99,9 @@ def day_graph():
 
     camid = data['camid'] if 'camid' in data else None
     model = data['model'] if 'model' in data else 'OD'
-    api = od_api if model is 'OD' else sg_api
+    api = od_api if model == 'OD' else sg_api
 
-    graph_values = api.day_graph(date=data['date'], camid=camid)
+    graph_values = api.day_graph(date=data['date'], camid=camid, **thresholds(data, api))
     if not graph_values:
         resp = jsonify({'status': False})
         resp.status_code = 400
@@ -81,9 +133,10 @@ def range_graph():
 
     camid = data['camid'] if 'camid' in data else None
     model = data['model'] if 'model' in data else 'OD'
-    api = od_api if model is 'OD' else sg_api
+    api = od_api if model == 'OD' else sg_api
 
-    graph_values = api.range_graph(start_date=data['start_date'], end_date=data['end_date'], camid=camid)
+    graph_values = api.range_graph(start_date=data['start_date'], end_date=data['end_date'], camid=camid,
+                                   **thresholds(data, api))
     if not graph_values:
         resp = jsonify({'status': False})
         resp.status_code = 400
@@ -110,10 +163,10 @@ def trash_count():
         return resp
     camid = data['camid'] if 'camid' in data else None
     model = data['model'] if 'model' in data else 'OD'
-    api = od_api if model is 'OD' else sg_api
+    api = od_api if model == 'OD' else sg_api
     date = data['date'] if 'date' in data else None
 
-    total_trash = api.trash_count(camid=camid, date=date)
+    total_trash = api.trash_count(camid=camid, date=date, **thresholds(data, api))
 
     return jsonify(total_trash)
 
@@ -138,8 +191,8 @@ def max_trash_hour():
 
     camid = data['camid'] if 'camid' in data else None
     model = data['model'] if 'model' in data else 'OD'
-    api = od_api if model is 'OD' else sg_api
-    trash_hour = api.max_trash_hours(camid=camid)
+    api = od_api if model == 'OD' else sg_api
+    trash_hour = api.max_trash_hours(camid=camid, **thresholds(data, api))
 
     return jsonify(trash_hour)
 
@@ -164,8 +217,8 @@ def max_trash_day():
 
     camid = data['camid'] if 'camid' in data else None
     model = data['model'] if 'model' in data else 'OD'
-    api = od_api if model is 'OD' else sg_api
-    trash_day = api.max_trash_days(camid=camid)
+    api = od_api if model == 'OD' else sg_api
+    trash_day = api.max_trash_days(camid=camid, **thresholds(data, api))
 
     return jsonify(trash_day)
 
@@ -189,8 +242,8 @@ def max_trash_month():
 
     camid = data['camid'] if 'camid' in data else None
     model = data['model'] if 'model' in data else 'OD'
-    api = od_api if model is 'OD' else sg_api
-    trash_month = api.max_trash_month(camid=camid)
+    api = od_api if model == 'OD' else sg_api
+    trash_month = api.max_trash_month(camid=camid, **thresholds(data, api))
 
     return jsonify(trash_month)
 
@@ -0,0 +1,101 @@
+"""
+Startup time, CPU latency and parity of the OD model inference backends.
+
+Builds YOLO from the trained .h5 on the keras backend, which is the reference, and optionally from the frozen graph
+written by OD_model/export_frozen.py and on ONNX Runtime from the model written by OD_model/export_onnx.py, each in a
+fresh session. For every backend it reports the time to construct YOLO and the latency per frame of detect_batch at
+batch size 1 and at --batch. Boxes, scores and classes of every backend are compared per image with the reference,
+the script exits with 1 on any mismatch so it can be used as a parity test.
+
+All backends filter the boxes with the numpy post-processing, so only the model runtime differs. This script
+requires the OD_model dependencies, the trained weights and the exported models to be compared. Run it from the
+repository root:
+    python -m benchmarks.backend_bench --images camfeed/LUMS/2020-04-26 \
+        --frozen_graph OD_model/logs/yolo-attention-log-multiply_pi/frozen_graph.pb \
+        --onnx OD_model/logs/yolo-attention-log-multiply_pi/yolo.onnx
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+from keras import backend as K
+from PIL import Image
+
+from OD_model.yolo import YOLO
+from benchmarks.postprocess_parity import compare
+
+
+def run(images, batch, repeats, **kwargs):
+    """
+    Returns the construction seconds, ms per frame at batch size 1 and at batch and the detections of every image
+    """
+
+    K.clear_session()
+    begin = time.perf_counter()
+    yolo = YOLO(**kwargs)
+    startup = time.perf_counter() - begin
+    image_data = np.stack([yolo.preprocess(image) for image in images])
+    sizes = [image.size for image in images]
+    # the first run allocates the session's buffers
+    yolo.detect_batch(image_data[:1], sizes[:1])
+
+    latencies = []
+    for size in (1, batch):
+        begin = time.perf_counter()
+        for _ in range(repeats):
+            for start in range(0, len(images), size):
+                yolo.detect_batch(image_data[start:start + size], sizes[start:start + size])
+        latencies.append((time.perf_counter() - begin) / (repeats * len(images)) * 1000)
+    detections = []
+    for start in range(0, len(images), batch):
+        detections += yolo.detect_batch(image_data[start:start + batch], sizes[start:start + batch])
+    yolo.close_session()
+    return startup, latencies, detections
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the inference backends of the OD model.')
+    parser.add_argument('--images', required=True, help='Folder with test images.')
+    parser.add_argument('--frozen_graph', help='Graph written by OD_model/export_frozen.py.')
+    parser.add_argument('--onnx', help='Model written by OD_model/export_onnx.py.')
+    parser.add_argument('--threads', type=int, default=None, help='Intra op threads of the onnxruntime backend.')
+    parser.add_argument('--limit', type=int, default=32, help='Maximum number of images.')
+    parser.add_argument('--batch', type=int, default=8, help='Images per forward pass of the batched runs.')
+    parser.add_argument('--repeats', type=int, default=3, help='Timed passes over the images.')
+    parser.add_argument('--box_tolerance', type=float, default=1e-1, help='Allowed box difference in pixels.')
+    parser.add_argument('--score_tolerance', type=float, default=1e-4, help='Allowed score difference.')
+    args = parser.parse_args()
+
+    names = sorted(name for name in os.listdir(args.images) if name.endswith('.jpg'))[:args.limit]
+    images = [Image.open(os.path.join(args.images, name)).convert('RGB') for name in names]
+    backends = {'keras': {}}
+    if args.frozen_graph:
+        backends['frozen'] = {'frozen_graph_path': args.frozen_graph}
+    if args.onnx:
+        backends['onnxruntime'] = {'backend': 'onnxruntime', 'onnx_path': args.onnx,
+                                   'intra_op_threads': args.threads}
+    results = {backend: run(images, args.batch, args.repeats, postprocess='numpy', **kwargs)
+               for backend, kwargs in backends.items()}
+
+    print('{:<12} {:>10} {:>14} {:>14}'.format('backend', 'startup s', 'ms/frame b=1',
+                                               'ms/frame b={}'.format(args.batch)))
+    for backend, (startup, latencies, _) in results.items():
+        print('{:<12} {:>10.2f} {:>14.1f} {:>14.1f}'.format(backend, startup, *latencies))
+
+    mismatches = 0
+    for backend in list(results)[1:]:
+        for name, reference, result in zip(names, results['keras'][2], results[backend][2]):
+            difference = compare(reference, result, args.box_tolerance, args.score_tolerance)
+            if difference is not None:
+                mismatches += 1
+                print('{} {}: {}'.format(backend, name, difference))
+    print('{} images, {} backends compared with keras, {} mismatches'.format(len(names), len(results) - 1,
+                                                                            mismatches))
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""
+Micro-benchmark of the OD preprocessing paths.
+
+Compares the per image cost of letterbox_image followed by the float32 copy and division by 255 against
+letterbox_image_into writing into a reused batch buffer, on random images of camera resolution. Both outputs are
+checked to be identical before timing. The BICUBIC resize itself is timed separately since both paths share it.
+
+This script requires the OD_model dependencies (numpy, pillow, matplotlib). Run it from the repository root:
+    python -m benchmarks.letterbox_bench --width 1920 --height 1080 --batch 8
+"""
+
+import argparse
+import time
+
+import numpy as np
+from PIL import Image
+
+from OD_model.yolo3.utils import letterbox_image, letterbox_image_into
+
+
+def canvas_path(images, size):
+    image_data = []
+    for image in images:
+        data = np.array(letterbox_image(image, size), dtype='float32')
+        data /= 255.
+        image_data.append(data)
+    return np.stack(image_data)
+
+
+def buffer_path(images, buffer):
+    for image, out in zip(images, buffer):
+        letterbox_image_into(image, out)
+    return buffer[:len(images)]
+
+
+def resize_only(images, size):
+    for image in images:
+        iw, ih = image.size
+        scale = min(size / iw, size / ih)
+        image.resize((int(iw * scale), int(ih * scale)), Image.BICUBIC)
+
+
+def best_of(function, repeats):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the OD letterbox preprocessing.')
+    parser.add_argument('--width', type=int, default=1920, help='Width of the camera images.')
+    parser.add_argument('--height', type=int, default=1080, help='Height of the camera images.')
+    parser.add_argument('--size', type=int, default=416, help='Model input size.')
+    parser.add_argument('--batch', type=int, default=8, help='Images per batch.')
+    parser.add_argument('--repeats', type=int, default=10, help='Timed repetitions, the best one is reported.')
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    images = [Image.fromarray(rng.randint(0, 256, (args.height, args.width, 3), dtype=np.uint8))
+              for _ in range(args.batch)]
+    buffer = np.empty((args.batch, args.size, args.size, 3), dtype='float32')
+
+    assert np.array_equal(canvas_path(images, (args.size, args.size)), buffer_path(images, buffer)), \
+        'Preprocessing paths differ'
+
+    canvas = best_of(lambda: canvas_path(images, (args.size, args.size)), args.repeats) / args.batch
+    reused = best_of(lambda: buffer_path(images, buffer), args.repeats) / args.batch
+    # the BICUBIC resize is shared by both paths, the rest is the allocation and conversion overhead
+    resize = best_of(lambda: resize_only(images, args.size), args.repeats) / args.batch
+    print('{}x{} images letterboxed to {}x{}, batches of {}'.format(args.width, args.height, args.size, args.size,
+                                                                    args.batch))
+    print('{:<28} {:>8.2f} ms/image'.format('letterbox_image + float32', canvas * 1000))
+    print('{:<28} {:>8.2f} ms/image'.format('letterbox_image_into', reused * 1000))
+    print('{:<28} {:>8.2f} ms/image'.format('resize alone', resize * 1000))
+    print('{:<28} {:>8.2f}x'.format('speedup', canvas / reused))
+    print('{:<28} {:>8.2f}x'.format('speedup without resize', (canvas - resize) / max(reused - resize, 1e-9)))
+
+
+if __name__ == '__main__':
+    main()
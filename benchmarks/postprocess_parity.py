@@ -0,0 +1,96 @@
+"""
+Parity check of the NumPy post-processing against the TF graph.
+
+Runs the OD model on a folder of images one image at a time, the way detect_image does. Every image runs once through
+the session, which returns the boxes filtered by the original yolo_eval graph (yolo.boxes, yolo.scores and
+yolo.classes) and the raw yolo_body outputs. The raw outputs are then filtered by OD_model.yolo3.postprocess. Box
+counts, classes, scores and coordinates are compared per image and both post-processing times are reported.
+
+This script requires the OD_model dependencies and the trained weights. Run it from the repository root:
+    python -m benchmarks.postprocess_parity --images camfeed/LUMS/2020-04-26 --limit 200
+The numpy results can be filtered in batches with --batch, the graph side always runs per image.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+from keras import backend as K
+from PIL import Image
+
+from OD_model.yolo import YOLO
+from OD_model.yolo3.postprocess import yolo_postprocess
+
+
+def compare(graph, numpy_result, box_tolerance, score_tolerance):
+    """
+    Returns a description of the first difference between two (boxes, scores, classes) results or None
+    """
+
+    if len(graph[0]) != len(numpy_result[0]):
+        return '{} graph boxes, {} numpy boxes'.format(len(graph[0]), len(numpy_result[0]))
+    if not np.array_equal(graph[2], numpy_result[2]):
+        return 'classes differ'
+    if not np.allclose(graph[1], numpy_result[1], atol=score_tolerance):
+        return 'scores differ by {:.2e}'.format(np.abs(graph[1] - numpy_result[1]).max())
+    if not np.allclose(graph[0], numpy_result[0], atol=box_tolerance):
+        return 'boxes differ by {:.2e} px'.format(np.abs(graph[0] - numpy_result[0]).max())
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare NumPy and TF graph post-processing of the OD model.')
+    parser.add_argument('--images', required=True, help='Folder with test images.')
+    parser.add_argument('--limit', type=int, default=100, help='Maximum number of images.')
+    parser.add_argument('--batch', type=int, default=8, help='Images per numpy post-processing call.')
+    parser.add_argument('--box_tolerance', type=float, default=1e-2, help='Allowed box difference in pixels.')
+    parser.add_argument('--score_tolerance', type=float, default=1e-5, help='Allowed score difference.')
+    args = parser.parse_args()
+
+    names = sorted(name for name in os.listdir(args.images) if name.endswith('.jpg'))[:args.limit]
+    yolo = YOLO()
+    mismatches = 0
+    graph_seconds = numpy_seconds = 0.
+    for start in range(0, len(names), args.batch):
+        images = [Image.open(os.path.join(args.images, name)) for name in names[start:start + args.batch]]
+        graph_results = []
+        raw_outputs = []
+        for image in images:
+            # fed exactly like detect_image feeds the original graph
+            feed_dict = {yolo.yolo_model.input: np.expand_dims(yolo.preprocess(image), 0),
+                         yolo.input_image_shape: [image.size[1], image.size[0]], K.learning_phase(): 0}
+
+            # the forward pass is shared, the graph filtering time is the difference to running the model alone
+            begin = time.perf_counter()
+            yolo.sess.run(yolo.yolo_model.output, feed_dict=feed_dict)
+            model_seconds = time.perf_counter() - begin
+            begin = time.perf_counter()
+            outputs = yolo.sess.run([yolo.boxes, yolo.scores, yolo.classes] + list(yolo.yolo_model.output),
+                                    feed_dict=feed_dict)
+            graph_seconds += max(time.perf_counter() - begin - model_seconds, 0.)
+            graph_results.append(tuple(outputs[:3]))
+            raw_outputs.append(outputs[3:])
+
+        begin = time.perf_counter()
+        numpy_results = yolo_postprocess([np.concatenate(layer) for layer in zip(*raw_outputs)], yolo.anchors,
+                                         len(yolo.class_names), [image.size for image in images],
+                                         max_boxes=yolo.max_boxes, score_threshold=yolo.score, iou_threshold=yolo.iou)
+        numpy_seconds += time.perf_counter() - begin
+
+        for name, graph, numpy_result in zip(names[start:start + args.batch], graph_results, numpy_results):
+            difference = compare(graph, numpy_result, args.box_tolerance, args.score_tolerance)
+            if difference is not None:
+                mismatches += 1
+                print('{}: {}'.format(name, difference))
+
+    print('{} images, {} mismatches'.format(len(names), mismatches))
+    print('graph post-processing {:.2f} ms/image, numpy {:.2f} ms/image'.format(
+        graph_seconds / max(len(names), 1) * 1000, numpy_seconds / max(len(names), 1) * 1000))
+    yolo.close_session()
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == '__main__':
+    main()
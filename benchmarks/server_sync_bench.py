@@ -0,0 +1,153 @@
+"""
+Throughput benchmark of server_sync.SyncData against a local FTP server.
+
+A pyftpdlib server is started in a separate process on a synthetic camfeed tree with a configurable number of
+cameras, days and files. Every FTP command can be delayed to simulate the latency of the camera uplink. For each
+worker count the sync runs twice: a cold run downloading everything and a warm run where nothing changed, which only
+measures listing overhead.
+
+This script requires pyftpdlib to be installed. Run it from the repository root:
+    python -m benchmarks.server_sync_bench --cameras 3 --days 5 --files 50 --latency 0.05 --workers 1 4 8
+"""
+
+import argparse
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import cfg
+from server_sync import SyncData
+
+USERNAME = 'bench'
+PASSWORD = 'bench'
+
+
+def build_tree(root: str, cameras: int, days: int, files: int, size: int) -> dict:
+    """
+    Creates a synthetic camfeed tree and returns the camera info used for cfg.cam_info
+    """
+
+    cam_info = {}
+    payload = b'\xff\xd8' + os.urandom(max(size - 4, 0)) + b'\xff\xd9'
+    first_date = datetime.now() - timedelta(days=days)
+    for cam_num in range(cameras):
+        cam = 'cam{}'.format(cam_num)
+        cam_info[cam] = {'longitude': 0.0, 'latitude': 0.0, 'description': 'benchmark'}
+        for day in range(days):
+            folder = os.path.join(root, 'camfeed', cam, (first_date + timedelta(days=day)).strftime('%Y-%m-%d'))
+            os.makedirs(folder)
+            start = datetime(2000, 1, 1, 9)
+            for file_num in range(files):
+                name = (start + timedelta(seconds=10 * file_num)).strftime('%H-%M-%S') + '.jpg'
+                with open(os.path.join(folder, name), 'wb') as image:
+                    image.write(payload)
+    return cam_info
+
+
+def serve(root: str, port: int, latency: float, ready):
+    """
+    Runs a threaded FTP server on root delaying every command by latency seconds
+    """
+
+    # pyftpdlib changes the working directory of its process, which is why it runs in its own
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler
+    from pyftpdlib.log import config_logging
+    from pyftpdlib.servers import ThreadedFTPServer
+
+    class LatencyHandler(FTPHandler):
+        def pre_process_command(self, line, cmd, arg):
+            time.sleep(latency)
+            return super().pre_process_command(line, cmd, arg)
+
+    authorizer = DummyAuthorizer()
+    authorizer.add_user(USERNAME, PASSWORD, root, perm='elr')
+    LatencyHandler.authorizer = authorizer
+    LatencyHandler.banner = 'benchmark'
+    server = ThreadedFTPServer(('127.0.0.1', port), LatencyHandler)
+    server.max_cons = 256
+    # the per command log lines would dominate the benchmark output
+    config_logging(level=logging.WARNING)
+    ready.set()
+    server.serve_forever()
+
+
+class TimedSyncData(SyncData):
+    """SyncData which records the time spent listing the server."""
+
+    listing_seconds = 0.0
+
+    def missing_files(self, sess):
+        start = time.perf_counter()
+        missing = super().missing_files(sess)
+        self.listing_seconds = time.perf_counter() - start
+        return missing
+
+
+def run_sync(local_dir: str, workers: int, bandwidth: float) -> dict:
+    """
+    Runs one sync and returns its statistics
+    """
+
+    sync = TimedSyncData(local_dir=local_dir, workers=workers, bandwidth=bandwidth)
+    start = time.perf_counter()
+    sync.server_sync()
+    seconds = time.perf_counter() - start
+
+    files = num_bytes = 0
+    for folder, _, names in os.walk(local_dir):
+        for name in names:
+            if name.endswith('.jpg'):
+                files += 1
+                num_bytes += os.path.getsize(os.path.join(folder, name))
+    return {'seconds': seconds, 'listing': sync.listing_seconds, 'files': files, 'bytes': num_bytes}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark server_sync against a local FTP server.')
+    parser.add_argument('--cameras', type=int, default=3, help='Number of cameras in the synthetic tree.')
+    parser.add_argument('--days', type=int, default=5, help='Number of date folders per camera.')
+    parser.add_argument('--files', type=int, default=50, help='Number of images per date folder.')
+    parser.add_argument('--size', type=int, default=200000, help='Size of every image in bytes.')
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds added to every FTP command.')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 8], help='Session pool sizes to compare.')
+    parser.add_argument('--bandwidth', type=float, default=None, help='Download cap in bytes per second.')
+    parser.add_argument('--port', type=int, default=2121, help='Port of the local FTP server.')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='sync_bench_')
+    try:
+        cam_info = build_tree(root, args.cameras, args.days, args.files, args.size)
+        cfg.cam_info = cam_info
+        cfg.ftp_server = {'address': '127.0.0.1', 'port': args.port, 'username': USERNAME, 'password': PASSWORD}
+
+        ready = multiprocessing.Event()
+        server = multiprocessing.Process(target=serve, args=(root, args.port, args.latency, ready), daemon=True)
+        server.start()
+        ready.wait()
+
+        print('{} cameras x {} days x {} files of {} bytes, {}s latency per command'.format(
+            args.cameras, args.days, args.files, args.size, args.latency))
+        print('{:>8} {:>6} {:>9} {:>9} {:>9} {:>10} {:>10}'.format('workers', 'run', 'files', 'seconds', 'files/s',
+                                                                 'MB/s', 'listing s'))
+        for workers in args.workers:
+            local_dir = os.path.join(root, 'local_{}'.format(workers))
+            os.makedirs(local_dir)
+            for run in ('cold', 'warm'):
+                stats = run_sync(local_dir, workers, args.bandwidth)
+                downloaded = stats['files'] if run == 'cold' else 0
+                mb = stats['bytes'] / 1e6 if run == 'cold' else 0
+                print('{:>8} {:>6} {:>9} {:>9.2f} {:>9.1f} {:>10.2f} {:>10.2f}'.format(
+                    workers, run, downloaded, stats['seconds'], downloaded / stats['seconds'], mb / stats['seconds'],
+                    stats['listing']))
+        server.terminate()
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,263 @@
+"""
+This script watches the synced camfeed folder and inserts new images into the database within seconds.
+
+New JPEGs under main_dir/<cam>/<date>/ are picked up through inotify when the inotify_simple package is installed,
+otherwise through a cheap poll that only lists a folder again when its mtime has changed. Documents are inserted in
+small batches through the BatchInserter of the db_script module.
+
+This script can also be imported as a module and contains the CamfeedWatcher class.
+"""
+
+import os
+import time
+from typing import Optional, Callable, Dict, Set, Tuple
+
+# noinspection PyUnresolvedReferences
+import cfg
+from db_script import DbUp, BatchInserter
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+# Files written less than this many seconds ago may still be in transfer when polling
+FILE_SETTLE_SECONDS = 2
+
+
+def is_image(filename: str) -> bool:
+    """
+    Checks if a camfeed filename is a finished JPEG
+    """
+
+    return filename.endswith('.jpg')
+
+
+class CamfeedWatcher:
+    """
+    A class for inserting new camfeed images into the database as soon as they are synced
+
+    Only the latest recent_days date folders of every camera are watched. Older folders are handled by the nightly
+    add_to_database run.
+
+    Attributes
+    ----------
+    db_up : DbUp
+        Database object used for preparing and inserting documents
+    inserter : BatchInserter
+        Batched writer for the new documents
+    backend : str
+        'inotify' or 'poll'
+
+    Methods
+    -------
+    run(on_tick=None)
+        Watches the camfeed folder forever
+    tick()
+        Performs a single poll or inotify read and flushes the inserter if due
+    """
+
+    def __init__(self, db_up: DbUp, poll_interval: Optional[float] = cfg.ingest.get('poll_interval'),
+                 recent_days: Optional[int] = cfg.ingest.get('recent_days'), use_inotify: Optional[bool] = True):
+        """
+        Parameters
+        ----------
+        db_up : DbUp
+            Database object used for preparing and inserting documents
+        poll_interval : float, optional
+            Seconds between ticks (Default is cfg.ingest['poll_interval'])
+        recent_days : int, optional
+            Number of latest date folders per camera which are watched (Default is cfg.ingest['recent_days'])
+        use_inotify : bool, optional
+            Use inotify if it is available (Default is True)
+        """
+
+        self.db_up = db_up
+        self.inserter = BatchInserter(db_up)
+        self.poll_interval = poll_interval
+        self.recent_days = recent_days
+        self.main_dir = cfg.directories.get('main_dir')
+        self.backend = 'inotify' if use_inotify and INotify is not None else 'poll'
+
+        # (cam, date) -> names already seen in the folder
+        self._seen: Dict[Tuple[str, str], Set[str]] = {}
+        # (cam, date) -> folder mtime when it was last listed
+        self._folder_mtimes: Dict[Tuple[str, str], int] = {}
+        # cam -> camera folder mtime when it was last listed
+        self._cam_mtimes: Dict[str, int] = {}
+        # (cam, date, name) of files which were still being written when their folder was listed
+        self._unsettled: Set[Tuple[str, str, str]] = set()
+
+        if self.backend == 'inotify':
+            self._inotify = INotify()
+            self._cam_watches = {}
+            self._folder_watches = {}
+
+        for cam in cfg.cam_info.keys():
+            self._scan_cam(cam)
+
+    def _scan_cam(self, cam: str):
+        """
+        Lists the date folders of a camera and starts watching the most recent ones
+        """
+
+        cam_dir = os.path.join(self.main_dir, cam)
+        try:
+            self._cam_mtimes[cam] = os.stat(cam_dir).st_mtime_ns
+            dates = sorted(entry.name for entry in os.scandir(cam_dir) if entry.is_dir())
+        except FileNotFoundError:
+            return
+
+        if self.backend == 'inotify' and cam not in self._cam_watches.values():
+            wd = self._inotify.add_watch(cam_dir, flags.CREATE | flags.MOVED_TO | flags.ONLYDIR)
+            self._cam_watches[wd] = cam
+        for date in dates[-self.recent_days:]:
+            if (cam, date) not in self._seen:
+                self._watch_folder(cam, date)
+
+    def _watch_folder(self, cam: str, date: str):
+        """
+        Starts watching a date folder, lists it once and forgets folders which are no longer recent
+        """
+
+        folder = os.path.join(self.main_dir, cam, date)
+        if self.backend == 'inotify':
+            wd = self._inotify.add_watch(folder, flags.CLOSE_WRITE | flags.MOVED_TO)
+            self._folder_watches[wd] = (cam, date)
+        self._seen[(cam, date)] = set()
+        self._list_folder(cam, date)
+
+        # keep only the latest recent_days folders of this camera
+        cam_dates = sorted(seen_date for seen_cam, seen_date in self._seen if seen_cam == cam)
+        for old_date in cam_dates[:-self.recent_days]:
+            del self._seen[(cam, old_date)]
+            self._folder_mtimes.pop((cam, old_date), None)
+            self._unsettled = {unit for unit in self._unsettled if unit[:2] != (cam, old_date)}
+            if self.backend == 'inotify':
+                for wd, unit in list(self._folder_watches.items()):
+                    if unit == (cam, old_date):
+                        # the watch may already be gone if the folder was removed
+                        try:
+                            self._inotify.rm_watch(wd)
+                        except OSError:
+                            pass
+                        del self._folder_watches[wd]
+
+    def _list_folder(self, cam: str, date: str):
+        """
+        Lists a date folder and queues every settled image which was not seen before
+        """
+
+        folder = os.path.join(self.main_dir, cam, date)
+        try:
+            self._folder_mtimes[(cam, date)] = os.stat(folder).st_mtime_ns
+            entries = [entry for entry in os.scandir(folder) if is_image(entry.name)]
+        except FileNotFoundError:
+            return
+        seen = self._seen[(cam, date)]
+        now = time.time()
+        for entry in entries:
+            if entry.name in seen:
+                continue
+            # the file may still be in transfer and is rechecked until it settled. With inotify its CLOSE_WRITE may
+            # also have fired before the folder was watched, so the recheck is needed there as well
+            if now - entry.stat().st_mtime < FILE_SETTLE_SECONDS:
+                self._unsettled.add((cam, date, entry.name))
+                continue
+            self._add(cam, date, entry.name)
+
+    def _add(self, cam: str, date: str, name: str):
+        self._seen[(cam, date)].add(name)
+        self._unsettled.discard((cam, date, name))
+        self.inserter.add(self.db_up.image_post(cam, date, name))
+
+    def _poll(self):
+        """
+        Checks the mtime of the camera folders and recent date folders, listing only the ones which changed
+        """
+
+        for cam in cfg.cam_info.keys():
+            try:
+                cam_mtime = os.stat(os.path.join(self.main_dir, cam)).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            if cam_mtime != self._cam_mtimes.get(cam):
+                self._scan_cam(cam)
+
+        for (cam, date), mtime in list(self._folder_mtimes.items()):
+            try:
+                folder_mtime = os.stat(os.path.join(self.main_dir, cam, date)).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            if folder_mtime != mtime:
+                self._list_folder(cam, date)
+
+        self._check_unsettled()
+
+    def _check_unsettled(self):
+        """
+        Queues the files which were still being written when their folder was listed once they settled
+        """
+
+        # checked one by one instead of listing their folder again
+        now = time.time()
+        for cam, date, name in list(self._unsettled):
+            try:
+                settled = now - os.stat(os.path.join(self.main_dir, cam, date, name)).st_mtime >= FILE_SETTLE_SECONDS
+            except FileNotFoundError:
+                self._unsettled.discard((cam, date, name))
+                continue
+            if settled:
+                self._add(cam, date, name)
+
+    def _read_events(self):
+        """
+        Handles pending inotify events, waiting up to poll_interval seconds for the first one
+        """
+
+        for event in self._inotify.read(timeout=int(self.poll_interval * 1000)):
+            if event.wd in self._cam_watches:
+                cam = self._cam_watches[event.wd]
+                if event.mask & flags.ISDIR and (cam, event.name) not in self._seen:
+                    self._watch_folder(cam, event.name)
+            elif event.wd in self._folder_watches:
+                cam, date = self._folder_watches[event.wd]
+                if is_image(event.name) and event.name not in self._seen[(cam, date)]:
+                    self._add(cam, date, event.name)
+
+        # cameras whose folder did not exist at startup
+        for cam in cfg.cam_info.keys():
+            if cam not in self._cam_mtimes:
+                self._scan_cam(cam)
+        # files already in transfer when their folder was watched, whose event may have been missed
+        self._check_unsettled()
+
+    def tick(self):
+        """
+        Performs a single poll or inotify read and flushes the inserter if due
+        """
+
+        if self.backend == 'inotify':
+            self._read_events()
+        else:
+            self._poll()
+            time.sleep(self.poll_interval)
+        self.inserter.flush_if_due()
+
+    def run(self, on_tick: Optional[Callable] = None):
+        """
+        Watches the camfeed folder forever
+
+        Parameters
+        ----------
+        on_tick : callable, optional
+            Called after every tick, e.g. schedule.run_pending (Default is None)
+        """
+
+        try:
+            while True:
+                self.tick()
+                if on_tick is not None:
+                    on_tick()
+        finally:
+            self.inserter.flush()
@@ -1,6 +1,69 @@
-mongo_cfg = {'db_server': {'host': 'mongo', 'port': '27017'}, 'db_name': 'trash', 'db_raw_clc': 'main', 'db_manual_clc': 'manual'}
+mongo_cfg = {'db_server': {'host': 'mongo', 'port': '27017'}, 'db_name': 'trash', 'db_raw_clc': 'main', 'db_manual_clc': 'manual',
+             'db_checkpoint_clc': 'ingest_checkpoints', 'db_jobs_clc': 'jobs', 'db_nodes_clc': 'nodes'}
 directories = {'main_dir': 'camfeed', 'save_dir': 'results'}
-ftp_server = {'address': '0.0.0.0', 'username': 'lums/xyz', 'password': 'abcd'} # removed due to privacy reasons
+# batch_size: documents sent per insert_many call when ingesting camfeed folders
+# settle_days: date folders older than this many days before yesterday are sealed and never rescanned
+# missing_grace_days: a date folder which does not exist holds back sealing for this many days after it settled, so a
+#   late FTP upload is still ingested. Older missing folders, e.g. days a camera was offline, are sealed past
+# mode: 'batch' ingests once a day at 03:00, 'watch' inserts new images within seconds of them being synced
+# watch_batch_size / flush_interval: a watcher batch is inserted when it is full or this many seconds old
+# poll_interval: seconds between folder mtime checks when inotify is not available
+# recent_days: number of latest date folders per camera that the watcher keeps an eye on
+# workers: camera/date folders ingested concurrently during a backfill
+# image_meta: read JPEG headers at ingest and store width, height, bytes, hash and decodable flag
+ingest = {'batch_size': 1000, 'settle_days': 2, 'missing_grace_days': 7, 'mode': 'watch', 'watch_batch_size': 50,
+          'flush_interval': 5, 'poll_interval': 2, 'recent_days': 2, 'workers': 8, 'image_meta': True}
+# models: inference models that get a job for every ingested image, add 'SG' when the sg_model service is enabled
+# lease_seconds: time a worker has to finish a claimed job before it is handed out again
+# max_attempts: number of times a job is handed out before it is marked as failed
+# wait_timeout: seconds an idle worker blocks on the jobs change stream before rechecking expired leases
+# backoff_max: longest pause between polls of an empty queue when mongo is not a replica set
+# reconcile_at: time of the nightly pass which enqueues jobs for images without predictions and without a job, e.g.
+#   for a model added to models later. It also runs whenever DbUp starts
+job_queue = {'models': ['OD'], 'lease_seconds': 300, 'max_attempts': 3, 'wait_timeout': 10, 'backoff_max': 1,
+             'reconcile_at': '04:00'}
+# batch_size: images the OD worker claims and runs through the model in one forward pass
+# decode_workers: threads reading and letterboxing images while the model runs
+# prefetch_batches: decoded batches queued ahead of the model, caps the memory held by the pipeline
+# score_floor: store candidate boxes down to this score so score and IoU thresholds can be chosen at query time,
+#   None stores only the boxes of the model's default operating point
+# candidate_iou / candidate_max_boxes: NMS IoU and per class box limit used for the candidates. Queries re-run NMS on
+#   them, which approximates the model at the queried operating point: boxes removed at candidate_iou can not come
+#   back, so keep it above any IoU that is queried
+# frozen_graph_path: inference graph written by OD_model/export_frozen.py, loads faster and runs faster on CPU than
+#   the training .h5. None loads the .h5
+# backend: 'keras' runs the model in a TF session, 'onnxruntime' runs the model written by OD_model/export_onnx.py
+#   from onnx_path on the ONNX Runtime CPU engine, None for onnx_path uses the default path of OD_model.yolo. The
+#   od_model image only has onnxruntime when built with the ONNXRUNTIME_VERSION build arg
+od_worker = {'batch_size': 8, 'decode_workers': 4, 'prefetch_batches': 2, 'score_floor': None, 'candidate_iou': 0.9,
+             'candidate_max_boxes': 100, 'frozen_graph_path': None, 'backend': 'keras', 'onnx_path': None}
+# min_processes / max_processes: bounds of the inference worker processes supervisor.py runs for a model, None as
+#   max_processes fits as many as the cores allow at intra_op_threads each. Equal bounds run a fixed number
+# drain_minutes: workers are added until their measured throughput clears the backlog within this time
+# scale_interval: seconds between scaling decisions, at most one worker is retired per decision
+# intra_op_threads / inter_op_threads: TF thread pools of every worker process, keep max_processes * intra_op_threads
+#   at or below the number of cores so the workers do not oversubscribe them
+# report_interval: seconds between the images/s reports
+supervisor = {'min_processes': 1, 'max_processes': None, 'drain_minutes': 30, 'scale_interval': 30,
+              'intra_op_threads': 4, 'inter_op_threads': 1, 'report_interval': 60}
+# enabled: inference workers register as nodes and split the job partitions between them, needed when they run on
+#   several machines against one mongo
+# partitions: number of partitions the image ids are hashed into, the same on every node, so the images of a camera
+#   day are spread over all nodes. Changing it needs the partition of the open jobs to be recomputed
+# virtual_nodes: points of every node on the consistent hashing ring, more points split the partitions more evenly
+# heartbeat_interval: seconds between node heartbeats, the partitions are rebalanced on every heartbeat
+# node_timeout: seconds without a heartbeat after which a node counts as dead and its partitions move to others
+cluster = {'enabled': False, 'partitions': 256, 'virtual_nodes': 64, 'heartbeat_interval': 5, 'node_timeout': 20}
+ftp_server = {'address': '0.0.0.0', 'port': 21, 'username': 'lums/xyz', 'password': 'abcd'} # removed due to privacy reasons
+# workers: parallel FTP sessions used for downloading
+# bandwidth: total download cap in bytes per second shared by all sessions, None for no cap
+# state_file: listing state kept inside the local camfeed folder so old folders are not listed again
+# settle_days: fully synced date folders older than this many days are marked complete
+# delete_remote: delete files on the server after their download has been verified
+# ingest: insert a document for every downloaded file straight from the sync process
+# every_minutes: sync interval in minutes, None syncs once a day at 00:01
+ftp_sync = {'workers': 4, 'bandwidth': None, 'state_file': '.sync_state.json', 'settle_days': 2,
+            'delete_remote': False, 'ingest': False, 'every_minutes': None}
 # camid: {longitude,latitude,description}
 # Don't use underscore in camera id
 cam_info = {'LUMS': {'longitude': 74.409863, 'latitude': 31.472780, 'description': 'Rohi Nala-xx'}}
@@ -0,0 +1,225 @@
+"""
+This script lets inference workers on several machines split the job queue of a model between them.
+
+Every job belongs to one of a fixed number of partitions, derived from the _id of its image when it is enqueued, so
+the images of one camera day, which are ingested together, are spread over all nodes. Workers register as nodes in
+the nodes collection and refresh a heartbeat there. Each node places itself on a consistent hashing ring with a
+number of virtual points, and a partition is owned by the first live node after it on the ring. Every node computes
+the ring from the same list of live nodes, so the partitions are split without talking to each other. A node joining
+takes over only the partitions landing on its points, and the partitions of a node whose heartbeat stopped move to
+the next live nodes on the ring. Leased jobs of a dead node are claimed again by their new owner once their lease
+expires.
+
+While the nodes see different lists of live nodes, e.g. right after one joined, two nodes may both own a partition
+for up to a heartbeat interval. Claims are still atomic leases, so an image is never processed by both.
+
+This script requires pymongo to be installed. The indexes of the nodes collection are declared in the schema module.
+
+This script can also be imported as a module and contains the following:
+    * partition - Returns the partition of a document id
+    * ring_owners - Returns the owning node of every partition
+    * Cluster - A class for registering a node and tracking the partitions it owns
+"""
+
+import bisect
+import hashlib
+import threading
+import zlib
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Set
+
+from pymongo.database import Database
+
+# noinspection PyUnresolvedReferences
+import cfg
+
+
+def partition(doc_id: str, partitions: Optional[int] = cfg.cluster.get('partitions')) -> int:
+    """
+    Returns the partition of a document id, hashed from the whole id so a camera day is spread over all partitions
+
+    Parameters
+    ----------
+    doc_id : str
+        _id of the image document, camid_date_time
+    partitions : int, optional
+        Number of partitions (Default is cfg.cluster['partitions'])
+
+    Returns
+    -------
+    partition : int
+        Partition in [0, partitions)
+    """
+
+    # crc32 gives the same value in every process, unlike the salted built in hash
+    return zlib.crc32(doc_id.encode()) % partitions
+
+
+def _point(key: str) -> int:
+    """
+    Returns the position of a key on the ring
+    """
+
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+
+def ring_owners(nodes: List[str], partitions: int, virtual_nodes: int) -> Dict[int, str]:
+    """
+    Returns the owning node of every partition
+
+    Parameters
+    ----------
+    nodes : list
+        Names of the live nodes
+    partitions : int
+        Number of partitions
+    virtual_nodes : int
+        Points every node takes on the ring, more points spread the partitions more evenly
+
+    Returns
+    -------
+    owners : Dict
+        partition -> node name, empty without nodes
+    """
+
+    if not nodes:
+        return {}
+    ring = sorted((_point('{}#{}'.format(node, v)), node) for node in nodes for v in range(virtual_nodes))
+    points = [point for point, _ in ring]
+    owners = {}
+    for p in range(partitions):
+        owners[p] = ring[bisect.bisect(points, _point('partition#{}'.format(p))) % len(ring)][1]
+    return owners
+
+
+class Cluster:
+    """
+    A class for registering an inference worker as a node and tracking the partitions it owns
+
+    Attributes
+    ----------
+    collection : Collection
+        Collection where the nodes of all models are registered
+    model : str
+        Model the node runs, only nodes of the same model share its partitions
+    name : str
+        Unique name of the node
+    partitions : set
+        Partitions currently owned by the node
+
+    Methods
+    -------
+    heartbeat()
+        Refreshes the heartbeat of the node and recomputes the partitions it owns
+    live_nodes()
+        Returns the names of the nodes of the model with a recent heartbeat
+    join()
+        Registers the node and keeps its heartbeat going on a background thread
+    leave()
+        Stops the heartbeat and unregisters the node so its partitions move at once
+    """
+
+    def __init__(self, db: Database, clc: str, model: str, name: str,
+                 partition_count: Optional[int] = cfg.cluster.get('partitions'),
+                 virtual_nodes: Optional[int] = cfg.cluster.get('virtual_nodes'),
+                 heartbeat_interval: Optional[float] = cfg.cluster.get('heartbeat_interval'),
+                 node_timeout: Optional[float] = cfg.cluster.get('node_timeout')):
+        """
+        Parameters
+        ----------
+        db : Database
+            Database in which the nodes are registered
+        clc : str
+            Name of the nodes collection
+        model : str
+            Model the node runs, e.g. 'OD' or 'SG'
+        name : str
+            Unique name of the node, e.g. host and process id
+        partition_count : int, optional
+            Number of partitions, must be the same on every node (Default is cfg.cluster['partitions'])
+        virtual_nodes : int, optional
+            Points every node takes on the ring (Default is cfg.cluster['virtual_nodes'])
+        heartbeat_interval : float, optional
+            Seconds between heartbeats (Default is cfg.cluster['heartbeat_interval'])
+        node_timeout : float, optional
+            Seconds without a heartbeat after which a node counts as dead (Default is cfg.cluster['node_timeout'])
+        """
+
+        self.collection = db[clc]
+        self.model = model
+        self.name = name
+        self.partition_count = partition_count
+        self.virtual_nodes = virtual_nodes
+        self.heartbeat_interval = heartbeat_interval
+        self.node_timeout = node_timeout
+        self.partitions = set()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def live_nodes(self) -> List[str]:
+        """
+        Returns the names of the nodes of the model with a recent heartbeat
+        """
+
+        since = datetime.utcnow() - timedelta(seconds=self.node_timeout)
+        return sorted(node.get('_id') for node in self.collection.find(
+            {'model': self.model, 'heartbeat': {'$gt': since}}, {'_id': 1}))
+
+    def heartbeat(self) -> Set[int]:
+        """
+        Refreshes the heartbeat of the node and recomputes the partitions it owns
+
+        Returns
+        -------
+        partitions : set
+            Partitions owned by the node
+        """
+
+        now = datetime.utcnow()
+        self.collection.update_one({'_id': self.name},
+                                   {'$set': {'model': self.model, 'heartbeat': now},
+                                    '$setOnInsert': {'started_at': now}}, upsert=True)
+        nodes = self.live_nodes()
+        partitions = {p for p, node in ring_owners(nodes, self.partition_count, self.virtual_nodes).items()
+                      if node == self.name}
+        if partitions != self.partitions:
+            print('{} owns {} of {} partitions, {} live {} nodes'.format(
+                self.name, len(partitions), self.partition_count, len(nodes), self.model))
+        # replaced as a whole so claims on other threads never see a half updated set
+        self.partitions = partitions
+        return partitions
+
+    def _beat(self):
+        """
+        Sends heartbeats until leave is called, a failed heartbeat is retried on the next interval
+        """
+
+        while not self._stop.wait(self.heartbeat_interval):
+            try:
+                self.heartbeat()
+            except Exception as error:
+                print('Heartbeat of {} failed: {}'.format(self.name, error))
+
+    def join(self):
+        """
+        Registers the node and keeps its heartbeat going on a background thread
+        """
+
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self.heartbeat()
+        self._thread = threading.Thread(target=self._beat, name='heartbeat', daemon=True)
+        self._thread.start()
+
+    def leave(self):
+        """
+        Stops the heartbeat and unregisters the node so the other nodes take over its partitions at once
+        """
+
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.collection.delete_one({'_id': self.name})
+        self.partitions = set()
@@ -8,21 +8,256 @@ This script can also be used as a module and contains the DbUp class.
 """
 
 import os
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Optional, Dict, List, Tuple
 import warnings
 
 import schedule
-from pymongo import MongoClient, GEO2D
-from pymongo.errors import DuplicateKeyError
+from pymongo import MongoClient
+from pymongo.errors import DuplicateKeyError, BulkWriteError
 
 # noinspection PyUnresolvedReferences
 import cfg
+from image_meta import read_image_meta
+from ingest_checkpoints import IngestCheckpoints
+from job_queue import JobQueue
+from schema import ensure_indexes, migrate
 
 # Mongo initialization
 client = MongoClient(cfg.mongo_cfg.get('db_server').get('host'), int(cfg.mongo_cfg.get('db_server').get('port')))
 
+# Mongo error code raised for duplicate _id inserts
+DUPLICATE_KEY_CODE = 11000
+# Folders modified more recently than this may still receive files within the same mtime tick, so they are not
+# checkpointed yet
+CHECKPOINT_SETTLE_NS = 2 * 10 ** 9
+
+
+class IngestSummary:
+    """
+    Result of a bulk ingestion run, counting inserted and duplicate documents per camera and date.
+
+    Attributes
+    ----------
+    counts : Dict
+        Maps (cam_id, date) to a dict with 'inserted' and 'duplicates' counts
+    failed : Dict
+        Maps (cam_id, date) to the error message of units which could not be ingested
+    missing : set
+        (cam_id, date) units whose folder did not exist
+
+    Methods
+    -------
+    add(cam, date, inserted=0, duplicates=0)
+        Adds counts for a camera and date
+    merge(other)
+        Adds all counts of another summary to this one
+    status(cam, date)
+        Returns 'inserted', 'unchanged', 'missing' or 'failed' for a camera and date
+    table()
+        Formats the per camera and date results as a table
+    """
+
+    def __init__(self):
+        self.counts = {}
+        self.failed = {}
+        self.missing = set()
+
+    def add(self, cam: str, date: str, inserted: Optional[int] = 0, duplicates: Optional[int] = 0):
+        """
+        Adds counts for a camera and date
+
+        Parameters
+        ----------
+        cam : str
+            Camera ID of the camera node
+        date : str
+            Date of the ingested folder
+        inserted : int, optional
+            Number of newly inserted documents (Default is 0)
+        duplicates : int, optional
+            Number of documents which were already present in the database (Default is 0)
+        """
+
+        unit = self.counts.setdefault((cam, date), {'inserted': 0, 'duplicates': 0})
+        unit['inserted'] += inserted
+        unit['duplicates'] += duplicates
+
+    def merge(self, other: 'IngestSummary'):
+        """
+        Adds all counts of another summary to this one
+
+        Parameters
+        ----------
+        other : IngestSummary
+            Summary whose counts are added
+        """
+
+        for (cam, date), unit in other.counts.items():
+            self.add(cam, date, unit['inserted'], unit['duplicates'])
+        self.failed.update(other.failed)
+        self.missing.update(other.missing)
+
+    def status(self, cam: str, date: str) -> str:
+        """
+        Returns 'inserted', 'unchanged', 'missing' or 'failed' for a camera and date
+
+        Parameters
+        ----------
+        cam : str
+            Camera ID of the camera node
+        date : str
+            Date of the folder
+
+        Returns
+        -------
+        status : str
+            'unchanged' covers folders skipped by their checkpoint and folders without new images
+        """
+
+        if (cam, date) in self.failed:
+            return 'failed'
+        if (cam, date) in self.missing:
+            return 'missing'
+        if self.counts.get((cam, date), {}).get('inserted'):
+            return 'inserted'
+        return 'unchanged'
+
+    def table(self) -> str:
+        """
+        Formats the per camera and date results as a table
+
+        Returns
+        -------
+        table : str
+            One row per visited camera and date with its status, inserted and duplicate counts and error
+        """
+
+        row = '{:<12} {:<12} {:<10} {:>10} {:>10}  {}'
+        rows = [row.format('camera', 'date', 'status', 'inserted', 'duplicates', 'error')]
+        for cam, date in sorted(set(self.counts) | set(self.failed) | self.missing):
+            unit = self.counts.get((cam, date), {'inserted': 0, 'duplicates': 0})
+            rows.append(row.format(cam, date, self.status(cam, date), unit['inserted'], unit['duplicates'],
+                                   self.failed.get((cam, date), '')))
+        return '\n'.join(rows)
+
+    @property
+    def inserted(self) -> int:
+        return sum(unit['inserted'] for unit in self.counts.values())
+
+    @property
+    def duplicates(self) -> int:
+        return sum(unit['duplicates'] for unit in self.counts.values())
+
+    def __repr__(self):
+        return 'IngestSummary(units={}, inserted={}, duplicates={}, failed={})'.format(
+            len(self.counts), self.inserted, self.duplicates, len(self.failed))
+
+
+class BatchInserter:
+    """
+    A class which collects image documents from a producer and inserts them in small unordered batches.
+
+    A batch is sent once batch_size documents are queued or flush_interval seconds have passed since the last one.
+    The class is thread-safe so several producers can share one inserter.
+
+    Attributes
+    ----------
+    db_up : DbUp
+        Database object whose collection receives the documents
+    batch_size : int
+        Number of queued documents that triggers an insert
+    flush_interval : float
+        Maximum number of seconds a document waits in the queue
+    summary : IngestSummary
+        Inserted and duplicate counts of all flushed documents
+
+    Methods
+    -------
+    add(post)
+        Queues a document and flushes the queue if it is full
+    flush_if_due()
+        Flushes the queue if flush_interval seconds have passed since the last flush
+    flush()
+        Inserts all queued documents
+    """
+
+    def __init__(self, db_up: 'DbUp', batch_size: Optional[int] = cfg.ingest.get('watch_batch_size'),
+                 flush_interval: Optional[float] = cfg.ingest.get('flush_interval')):
+        """
+        Parameters
+        ----------
+        db_up : DbUp
+            Database object whose collection receives the documents
+        batch_size : int, optional
+            Number of queued documents that triggers an insert (Default is cfg.ingest['watch_batch_size'])
+        flush_interval : float, optional
+            Maximum number of seconds a document waits in the queue (Default is cfg.ingest['flush_interval'])
+        """
+
+        self.db_up = db_up
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.summary = IngestSummary()
+        self._posts = []
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+
+    def add(self, post: Dict):
+        """
+        Queues a document and flushes the queue if it is full
+
+        Parameters
+        ----------
+        post : Dict
+            Document prepared by DbUp.image_post
+        """
+
+        with self._lock:
+            self._posts.append(post)
+            full = len(self._posts) >= self.batch_size
+        if full:
+            self.flush()
+
+    def flush_if_due(self):
+        """
+        Flushes the queue if flush_interval seconds have passed since the last flush
+        """
+
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Inserts all queued documents. If an insert fails the documents which were not inserted yet are queued again
+        before the error is raised, they are retried by the next flush
+        """
+
+        with self._lock:
+            posts, self._posts = self._posts, []
+            self._last_flush = time.monotonic()
+
+        # group by folder so the summary keeps per camera and date counts
+        units = {}
+        for post in posts:
+            units.setdefault((post.get('cam_id'), post.get('date')), []).append(post)
+        pending = list(units.items())
+        while pending:
+            (cam, date), unit_posts = pending[0]
+            try:
+                inserted, duplicates = self.db_up.insert_posts(unit_posts)
+            except Exception:
+                # inserting twice only counts duplicates, so the failed unit is queued again as a whole
+                with self._lock:
+                    self._posts = [post for _, unit_posts in pending for post in unit_posts] + self._posts
+                raise
+            pending.pop(0)
+            with self._lock:
+                self.summary.add(cam, date, inserted, duplicates)
+
 
 class DbUp:
     """
@@ -41,11 +276,24 @@ class DbUp:
     -------
     update_24
         Calls add_to_database function every 24 hours
+    watch
+        Inserts new images within seconds of them landing in the camfeed folder
+    cam_date_add(cam, date, force=False)
+        Adds image data of a single camera and date unless its folder is unchanged since the last checkpoint
+    images_add_bulk(date, force=False)
+        Adds image data of a date for all cameras using unordered batched inserts
+    backfill(units, force=False, workers=cfg.ingest['workers'])
+        Adds image data of many camera and date units in parallel over a bounded thread pool
     get_all_data(start_date, num_days=5)
         Adds data from the specified starting date till the number of days to the database
+    reconcile_jobs()
+        Enqueues jobs for every image which has no predictions of a configured model and no job yet
     """
 
-    def __init__(self, db: str, clc: str, starting_date: Optional[str] = None, date_format: Optional[str] = '%Y-%m-%d'):
+    def __init__(self, db: str, clc: str, starting_date: Optional[str] = None, date_format: Optional[str] = '%Y-%m-%d',
+                 batch_size: Optional[int] = cfg.ingest.get('batch_size'),
+                 settle_days: Optional[int] = cfg.ingest.get('settle_days'),
+                 missing_grace_days: Optional[int] = cfg.ingest.get('missing_grace_days')):
         """
         Parameters
         ----------
@@ -57,18 +305,139 @@ class DbUp:
             starting date from which the data is supposed to be added to database
         date_format : str, optional
             Date format of the starting and ending date (Default is '%Y-%m-%d')
+        batch_size : int, optional
+            Number of documents sent per insert_many call in bulk mode (Default is cfg.ingest['batch_size'])
+        settle_days : int, optional
+            Days after which a date folder is sealed and no longer rescanned (Default is cfg.ingest['settle_days'])
+        missing_grace_days : int, optional
+            Days after settling during which a missing date folder holds back sealing
+            (Default is cfg.ingest['missing_grace_days'])
         """
 
         # specify which db to use
         self.db = client[db]
         # specify which collection to use
         self.collection = self.db[clc]
-        # creating index for GEO spatial data
-        self.collection.create_index([('location', GEO2D)])
+        # creating the GEO spatial, query and job queue indexes and bringing old data up to date
+        ensure_indexes(self.db)
+        migrate(self.db)
 
         self.starting_date = starting_date
         self.date_format = date_format
+        self.batch_size = batch_size
+        self.settle_days = settle_days
+        self.missing_grace_days = missing_grace_days
+        self.checkpoints = IngestCheckpoints(self.db, cfg.mongo_cfg.get('db_checkpoint_clc'))
+        # every inserted image gets a job for each inference model
+        self.queues = [JobQueue(self.db, cfg.mongo_cfg.get('db_jobs_clc'), model)
+                       for model in cfg.job_queue.get('models')]
+        self.reconcile_jobs()
+
+    def reconcile_jobs(self) -> Dict[str, int]:
+        """
+        Enqueues jobs for every image which has no predictions of a configured model and no job yet
+
+        insert_posts enqueues right after inserting, so images are left without a job when it is interrupted in
+        between, and models added to cfg.job_queue['models'] later have no jobs for the images ingested before.
+        Images with an open or failed job are skipped, so the pass can be repeated at any time. It runs on every
+        start and nightly at cfg.job_queue['reconcile_at'].
+
+        Returns
+        -------
+        enqueued : Dict
+            Number of jobs added per model
+        """
+
+        enqueued = {}
+        for queue in self.queues:
+            enqueued[queue.model] = queue.enqueue_missing(self.collection, queue.model + '_Predictions')
+            if enqueued[queue.model]:
+                print('{} missing {} jobs enqueued'.format(enqueued[queue.model], queue.model))
+        return enqueued
+
+    @staticmethod
+    def image_post(cam: str, date: str, image: str, with_meta: Optional[bool] = cfg.ingest.get('image_meta'),
+                   image_path: Optional[str] = None) -> Dict:
+        """
+        Prepares the document of an image to be posted to the database
+
+        Parameters
+        ----------
+        cam : str
+            Camera ID of the camera node which captured the image
+        date : str
+            Date folder of the image
+        image : str
+            Filename of the image
+        with_meta : bool, optional
+            Read the JPEG header and store size, hash and decodable flag under 'image'
+            (Default is cfg.ingest['image_meta'])
+        image_path : str, optional
+            Path of the image file to read the header from
+            (Default is the image in cfg.directories['main_dir'])
+
+        Returns
+        -------
+        post : Dict
+            Document containing data about the image
+        """
+
+        # get image time through its name
+        img_time = image.split('.')[0]
+        post = {
+            '_id':      cam + '_' + date + '_' + img_time,
+            'cam_id':   cam,
+            'filename': image,
+            'date':     date,
+            'time':     img_time,
+            'location': [cfg.cam_info.get(cam).get('longitude'), cfg.cam_info.get(cam).get('latitude')],
+            'description': cfg.cam_info.get(cam).get('description')
+        }
+        if with_meta:
+            image_path = image_path or os.path.join(cfg.directories.get('main_dir'), cam, date, image)
+            try:
+                post['image'] = read_image_meta(image_path)
+            except OSError as e:
+                # the file could not be read now, which says nothing about the image, so the worker decodes it itself
+                print('Could not read the header of {}: {}'.format(image_path, e))
+        return post
+
+    def insert_posts(self, posts: List[Dict]) -> Tuple[int, int]:
+        """
+        Inserts documents with a single unordered insert_many call, skipping documents that already exist, and
+        enqueues inference jobs for the inserted ones
+
+        Parameters
+        ----------
+        posts : list
+            Documents to be inserted
+
+        Returns
+        -------
+        inserted : int
+            Number of newly inserted documents
+        duplicates : int
+            Number of documents which were already present in the database
+        """
 
+        if not posts:
+            return 0, 0
+        try:
+            result = self.collection.insert_many(posts, ordered=False)
+            inserted_ids = result.inserted_ids
+            duplicates = 0
+        except BulkWriteError as error:
+            write_errors = error.details.get('writeErrors', [])
+            duplicates = sum(1 for write_error in write_errors if write_error.get('code') == DUPLICATE_KEY_CODE)
+            # anything other than a duplicate is a real failure
+            if duplicates != len(write_errors):
+                raise
+            failed = {write_error.get('index') for write_error in write_errors}
+            inserted_ids = [post.get('_id') for index, post in enumerate(posts) if index not in failed]
+
+        for queue in self.queues:
+            queue.enqueue(inserted_ids)
+        return len(inserted_ids), duplicates
 
     def images_add(self, date: str):
         """
@@ -90,26 +459,19 @@ class DbUp:
         for cam in cfg.cam_info.keys():
             # get image list
             try:
-                images = os.listdir(os.path.join(cfg.directories.get('main_dir'), cam, date))
+                images = [image for image in os.listdir(os.path.join(cfg.directories.get('main_dir'), cam, date))
+                          if image.endswith('.jpg')]
                 # prepare images to post
                 for image in images:
-                    # get image time through its name
-                    img_time = image.split('.')[0]
-                    post = {
-                        '_id':      cam + '_' + date + '_' + img_time,
-                        'cam_id':   cam,
-                        'filename': image,
-                        'date':     date,
-                        'time':     img_time,
-                        'location': [cfg.cam_info.get(cam).get('longitude'), cfg.cam_info.get(cam).get('latitude')],
-                        'description': cfg.cam_info.get(cam).get('description')
-                    }
+                    post = self.image_post(cam, date, image)
 
                     try:
                         self.collection.insert_one(post)
                     except DuplicateKeyError:
                         warnings.warn('Duplicate file')
                         continue
+                    for queue in self.queues:
+                        queue.enqueue([post.get('_id')])
 
             except FileNotFoundError:
                 warnings.warn('Folder for {} date does not exist'.format(date))
@@ -118,9 +480,145 @@ class DbUp:
         current_date = datetime.now().strftime(self.date_format)
         print('database updated on {}'.format(current_date))
 
-    def add_to_database(self):
+    def cam_date_add(self, cam: str, date: str, force: Optional[bool] = False) -> IngestSummary:
         """
-        Adds yesterday data to the database by using the image_add function
+        Adds image data of a single camera and date unless its folder is unchanged since the last checkpoint
+
+        Parameters
+        ----------
+        cam : str
+            Camera ID of the camera node
+        date : str
+            Date for which the data is retrieved and added
+        force : bool, optional
+            Ingest the folder even if its checkpoint is up to date (Default is False)
+
+        Returns
+        -------
+        summary : IngestSummary
+            Inserted and duplicate counts of the camera and date
+
+        Warnings
+        --------
+        UserWarning
+            If the data for a specified date does not exist.
+        """
+
+        summary = IngestSummary()
+        folder = os.path.join(cfg.directories.get('main_dir'), cam, date)
+        try:
+            mtime = os.stat(folder).st_mtime_ns
+        except FileNotFoundError:
+            warnings.warn('Folder for {} date does not exist'.format(date))
+            summary.missing.add((cam, date))
+            return summary
+        # a folder only changes its mtime when files are added, removed or renamed
+        if not force and self.checkpoints.folder_unchanged(cam, date, mtime):
+            # listed with zero counts so the unit still shows up in the results
+            summary.add(cam, date)
+            return summary
+
+        # partially downloaded files keep a suffix until they are complete
+        images = [image for image in os.listdir(folder) if image.endswith('.jpg')]
+        posts = [self.image_post(cam, date, image) for image in images]
+        summary.add(cam, date)
+        for start in range(0, len(posts), self.batch_size):
+            inserted, duplicates = self.insert_posts(posts[start:start + self.batch_size])
+            summary.add(cam, date, inserted, duplicates)
+
+        if time.time_ns() - mtime > CHECKPOINT_SETTLE_NS:
+            self.checkpoints.record(cam, date, mtime, len(images))
+        return summary
+
+    def images_add_bulk(self, date: str, force: Optional[bool] = False) -> IngestSummary:
+        """
+        Adds image data of a date for all cameras using unordered batched inserts
+
+        Documents are sent in insert_many batches of batch_size. Duplicates are counted instead of being
+        warned about one at a time. Folders which did not change since their last checkpoint are skipped.
+
+        Parameters
+        ----------
+        date: str
+            Date for which the data is retrieved and added
+        force : bool, optional
+            Ingest folders even if their checkpoints are up to date (Default is False)
+
+        Returns
+        -------
+        summary : IngestSummary
+            Inserted and duplicate counts for every camera of the date
+
+        Warnings
+        --------
+        UserWarning
+            If the data for a specified date does not exist.
+        """
+
+        summary = IngestSummary()
+        for cam in cfg.cam_info.keys():
+            summary.merge(self.cam_date_add(cam, date, force=force))
+
+        print('{} images added and {} duplicates skipped for {}'.format(summary.inserted, summary.duplicates, date))
+        return summary
+
+    def backfill(self, units: List[Tuple[str, str]], force: Optional[bool] = False,
+                 workers: Optional[int] = cfg.ingest.get('workers')) -> IngestSummary:
+        """
+        Adds image data of many camera and date units in parallel over a bounded thread pool
+
+        Listing folders on the network mounted camfeed volume is slow, so units are spread over workers threads.
+        Progress is printed as units finish and the per unit results are printed as a table at the end.
+
+        Parameters
+        ----------
+        units : list
+            (cam, date) tuples which are supposed to be added
+        force : bool, optional
+            Ingest folders even if their checkpoints are up to date (Default is False)
+        workers : int, optional
+            Number of units processed concurrently (Default is cfg.ingest['workers'])
+
+        Returns
+        -------
+        summary : IngestSummary
+            Inserted and duplicate counts for every unit, failed units are listed in summary.failed
+        """
+
+        summary = IngestSummary()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(self.cam_date_add, cam, date, force): (cam, date) for cam, date in units}
+            for done, future in enumerate(as_completed(futures), start=1):
+                cam, date = futures[future]
+                try:
+                    unit_summary = future.result()
+                except Exception as error:
+                    summary.failed[(cam, date)] = repr(error)
+                    print('[{}/{}] {} {} failed: {!r}'.format(done, len(units), cam, date, error))
+                    continue
+                summary.merge(unit_summary)
+                print('[{}/{}] {} {} {}: {} inserted, {} duplicates'.format(done, len(units), cam, date,
+                                                                           unit_summary.status(cam, date),
+                                                                           unit_summary.inserted,
+                                                                           unit_summary.duplicates))
+
+        print(summary.table())
+        return summary
+
+    def add_to_database(self) -> IngestSummary:
+        """
+        Adds yesterday data to the database by using the images_add_bulk and backfill functions
+
+        If starting date is mentioned, every camera resumes from the day after its sealed checkpoint so the cost of a
+        run does not grow with the age of the starting date. Dates older than settle_days are sealed afterwards, but
+        never past a date whose folder failed, or was missing for less than missing_grace_days after it settled, so
+        folders which arrive late, e.g. after an FTP outage, are still ingested by a later run. Folders missing for
+        longer, e.g. days a camera was offline, are sealed past so they are not rescanned every night.
+
+        Returns
+        -------
+        summary : IngestSummary
+            Inserted and duplicate counts for every camera and date added
         """
 
         current_date = datetime.now()
@@ -129,16 +627,63 @@ class DbUp:
 
         print('Adding Images')
 
+        summary = IngestSummary()
         # check if starting date is mentioned
         if self.starting_date is not None:
-            days_diff = abs((yesterday_date - datetime.strptime(self.starting_date, self.date_format)).days)
-            for date_inc in range(days_diff+1):
-                date = (datetime.strptime(self.starting_date, self.date_format) + timedelta(days=date_inc)).strftime(
-                                                                                                    self.date_format)
-                self.images_add(date)
+            seal_date = (yesterday_date - timedelta(days=self.settle_days)).strftime(self.date_format)
+            units = []
+            for cam in cfg.cam_info.keys():
+                first_date = datetime.strptime(self.starting_date, self.date_format)
+                sealed = self.checkpoints.sealed_through(cam)
+                if sealed is not None:
+                    first_date = max(first_date, datetime.strptime(sealed, self.date_format) + timedelta(days=1))
+                for date_inc in range((yesterday_date - first_date).days + 1):
+                    units.append((cam, (first_date + timedelta(days=date_inc)).strftime(self.date_format)))
+            summary.merge(self.backfill(units))
+            # every date up to yesterday has been visited, old ones are sealed up to the first one which was missing
+            # or failed
+            for cam in cfg.cam_info.keys():
+                self.checkpoints.seal(cam, self.seal_limit(cam, seal_date, summary))
         else:
             y_date_format = yesterday_date.strftime(self.date_format)
-            self.images_add(y_date_format)
+            summary.merge(self.images_add_bulk(y_date_format))
+
+        current_date = datetime.now().strftime(self.date_format)
+        print('database updated on {}: {}'.format(current_date, summary))
+        return summary
+
+    def seal_limit(self, cam: str, seal_date: str, summary: IngestSummary) -> str:
+        """
+        Returns the latest date a camera can be sealed through after a run
+
+        Parameters
+        ----------
+        cam : str
+            Camera ID of the camera node
+        seal_date : str
+            Latest date old enough to be sealed
+        summary : IngestSummary
+            Result of the run
+
+        Returns
+        -------
+        date : str
+            seal_date, or the day before the first date of the camera whose folder failed or is missing within its
+            grace period
+        """
+
+        grace_date = (datetime.strptime(seal_date, self.date_format)
+                      - timedelta(days=self.missing_grace_days)).strftime(self.date_format)
+        blocked = sorted([date for unit_cam, date in summary.failed if unit_cam == cam] +
+                         [date for unit_cam, date in summary.missing if unit_cam == cam and date > grace_date])
+        limit = seal_date
+        if blocked and blocked[0] <= seal_date:
+            limit = (datetime.strptime(blocked[0], self.date_format) - timedelta(days=1)).strftime(self.date_format)
+        given_up = sorted(date for unit_cam, date in summary.missing if unit_cam == cam and date <= limit)
+        if given_up:
+            print('{}: sealing past {} date folders which never arrived, {} to {}'.format(
+                cam, len(given_up), given_up[0], given_up[-1]))
+        return limit
 
     def update_24(self):
         """
@@ -146,6 +691,7 @@ class DbUp:
         """
 
         schedule.every().day.at('03:00').do(self.add_to_database)
+        schedule.every().day.at(cfg.job_queue.get('reconcile_at')).do(self.reconcile_jobs)
         # schedule.every(25).seconds.do(self.add_to_database)
         print('Database is UP')
         # schedule.run_all()
@@ -153,7 +699,25 @@ class DbUp:
             schedule.run_pending()
             time.sleep(1)
 
-    def get_all_data(self, start_date: str, num_days: Optional[int] = 5):
+    def watch(self):
+        """
+        Inserts new images within seconds of them landing in the camfeed folder
+
+        The nightly add_to_database run is kept as a reconciliation pass for anything the watcher missed while it
+        was down.
+        """
+
+        # imported here as camfeed_watcher depends on this module
+        from camfeed_watcher import CamfeedWatcher
+
+        schedule.every().day.at('03:00').do(self.add_to_database)
+        schedule.every().day.at(cfg.job_queue.get('reconcile_at')).do(self.reconcile_jobs)
+        watcher = CamfeedWatcher(self)
+        print('Database is UP, watching {} with {}'.format(cfg.directories.get('main_dir'), watcher.backend))
+        watcher.run(on_tick=schedule.run_pending)
+
+    def get_all_data(self, start_date: str, num_days: Optional[int] = 5, force: Optional[bool] = False,
+                     workers: Optional[int] = cfg.ingest.get('workers')) -> IngestSummary:
         """
         Adds data from the specified starting date till the number of days to the database
 
@@ -163,19 +727,30 @@ class DbUp:
             Starting date from which database is supposed to be added
         num_days : int
             Number of days from starting date which are supposed to be added
+        force : bool, optional
+            Ingest folders even if their checkpoints are up to date (Default is False)
+        workers : int, optional
+            Number of camera and date units processed concurrently (Default is cfg.ingest['workers'])
+
+        Returns
+        -------
+        summary : IngestSummary
+            Inserted and duplicate counts for every camera and date added
         """
 
         # get last date by subtracting 1 day time from current date
         start_date = datetime.strptime(start_date, self.date_format)
 
-        for day in range(num_days + 1):
-            date = start_date + timedelta(days=day)
-            data_date = date.strftime(self.date_format)
-            print(f'Adding Images for date {data_date}')
-            self.images_add(data_date)
+        dates = [(start_date + timedelta(days=day)).strftime(self.date_format) for day in range(num_days + 1)]
+        print(f'Adding Images from {dates[0]} to {dates[-1]}')
+        units = [(cam, date) for date in dates for cam in cfg.cam_info.keys()]
+        return self.backfill(units, force=force, workers=workers)
 
 
 if __name__ == '__main__':
     server = DbUp(cfg.mongo_cfg.get('db_name'), cfg.mongo_cfg.get('db_raw_clc'), starting_date='2020-09-07')
-    server.update_24()
+    if cfg.ingest.get('mode') == 'watch':
+        server.watch()
+    else:
+        server.update_24()
     # server.get_all_data('2020-05-10', num_days=25)
\ No newline at end of file
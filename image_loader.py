@@ -0,0 +1,142 @@
+"""
+This script decodes camfeed JPEGs at reduced resolution for the inference models.
+
+Camera images are several times larger than the model inputs. libjpeg can scale the DCT blocks by 1/2, 1/4 or 1/8
+while decoding, which skips most of the work of a full decode and the memory of the full size image. The smallest
+scale which still covers the size the model resizes to is chosen, so the final resize only ever shrinks.
+
+PIL (used by the OD model) and OpenCV (used by the SG model) are both optional, each worker image installs only the
+library its model needs.
+
+This script can also be imported as a module and contains the following methods:
+    * fit_size - Returns the size an image is resized to when it is letterboxed
+    * reduction_factor - Returns the largest DCT scaling denominator keeping an image at least as large as a target
+    * load_image - Returns a PIL image decoded at reduced resolution and the original size
+    * load_array - Returns an OpenCV BGR array decoded at reduced resolution and the original size
+"""
+
+from typing import Optional, Tuple
+
+from image_meta import read_image_meta
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+# Scaling denominators libjpeg supports while decoding
+REDUCTIONS = (8, 4, 2, 1)
+if cv2 is not None:
+    CV2_FLAGS = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4,
+                 8: cv2.IMREAD_REDUCED_COLOR_8}
+
+
+def fit_size(image_size: Tuple[int, int], fit: Tuple[int, int]) -> Tuple[int, int]:
+    """
+    Returns the size an image is resized to when it is letterboxed into fit, keeping its aspect ratio
+
+    Parameters
+    ----------
+    image_size : tuple
+        (width, height) of the image
+    fit : tuple
+        (width, height) of the letterbox
+
+    Returns
+    -------
+    size : tuple
+        (width, height) of the resized image
+    """
+
+    width, height = image_size
+    scale = min(fit[0] / width, fit[1] / height)
+    return int(width * scale), int(height * scale)
+
+
+def reduction_factor(image_size: Tuple[int, int], target: Tuple[int, int]) -> int:
+    """
+    Returns the largest DCT scaling denominator which keeps an image at least as large as the target
+
+    Parameters
+    ----------
+    image_size : tuple
+        (width, height) of the full resolution image
+    target : tuple
+        (width, height) the decoded image is resized to afterwards
+
+    Returns
+    -------
+    factor : int
+        1, 2, 4 or 8
+    """
+
+    for factor in REDUCTIONS:
+        if image_size[0] // factor >= target[0] and image_size[1] // factor >= target[1]:
+            return factor
+    return 1
+
+
+def load_image(image_path, fit: Optional[Tuple[int, int]] = None,
+               size: Optional[Tuple[int, int]] = None) -> Tuple['Image.Image', Tuple[int, int]]:
+    """
+    Returns a PIL image decoded at reduced resolution and the original size
+
+    Parameters
+    ----------
+    image_path : str or file
+        Path of the JPEG file, or the file opened in binary mode
+    fit : tuple, optional
+        (width, height) of the letterbox the image is resized into keeping its aspect ratio
+    size : tuple, optional
+        (width, height) the image is stretched to. Without fit or size the image is decoded at full resolution
+
+    Returns
+    -------
+    image : Image
+        Decoded image, at least as large as the target
+    original_size : tuple
+        (width, height) of the full resolution image, boxes are reported in these coordinates
+    """
+
+    image = Image.open(image_path)
+    original_size = image.size
+    target = fit_size(original_size, fit) if fit is not None else size
+    if target is not None:
+        # draft picks the smallest DCT scale which is still equal or larger than target
+        image.draft(image.mode, target)
+    image.load()
+    return image, original_size
+
+
+def load_array(image_path: str, size: Tuple[int, int], image_size: Optional[Tuple[int, int]] = None):
+    """
+    Returns an OpenCV BGR array decoded at reduced resolution and the original size
+
+    Parameters
+    ----------
+    image_path : str
+        Path of the JPEG file
+    size : tuple
+        (width, height) the image is resized to afterwards
+    image_size : tuple, optional
+        (width, height) of the full resolution image, e.g. from the document written at ingest. Read from the JPEG
+        header if not given
+
+    Returns
+    -------
+    image : ndarray or None
+        Decoded image, None if the file could not be decoded
+    original_size : tuple
+        (width, height) of the full resolution image
+    """
+
+    if not image_size or not all(image_size):
+        meta = read_image_meta(image_path)
+        image_size = (meta.get('width'), meta.get('height'))
+    factor = reduction_factor(image_size, size) if all(image_size) else 1
+    return cv2.imread(str(image_path), CV2_FLAGS[factor]), image_size
@@ -0,0 +1,105 @@
+"""
+This script extracts metadata of camfeed JPEGs without decoding them.
+
+Only the marker segments up to the start of scan, the first HASH_HEAD_BYTES and the last TAIL_BYTES of a file are
+read. That is enough to know the image size and whether the file is complete, so inference workers can skip broken
+files and choose a resize path before opening them.
+
+This script can also be imported as a module and contains the following method:
+    * read_image_meta - Returns width, height, byte size, content hash and decodable flag of a JPEG
+"""
+
+import hashlib
+import os
+import struct
+from typing import Dict, Optional, Tuple
+
+# Start of frame markers carrying the image size (baseline, progressive, lossless and arithmetic variants)
+SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+# Markers which are not followed by a segment length
+STANDALONE_MARKERS = {0x01, 0xD0, 0xD1, 0xD2, 0xD3, 0xD4, 0xD5, 0xD6, 0xD7}
+SOI, EOI, SOS = b'\xff\xd8', b'\xff\xd9', 0xDA
+# Bytes hashed from the start of the file together with the tail and the file size
+HASH_HEAD_BYTES = 64 * 1024
+# Bytes read from the end of the file to look for the end of image marker
+TAIL_BYTES = 1024
+
+
+def _read_frame_size(jpeg) -> Tuple[Optional[int], Optional[int], bool]:
+    """
+    Walks the marker segments of a JPEG from its start until the start of scan
+
+    Returns
+    -------
+    width : int or None
+    height : int or None
+    has_scan : bool
+        True if a start of scan marker was found after the frame header
+    """
+
+    width = height = None
+    if jpeg.read(2) != SOI:
+        return width, height, False
+    while True:
+        byte = jpeg.read(1)
+        if byte != b'\xff':
+            return width, height, False
+        marker = jpeg.read(1)
+        # fill bytes may precede a marker
+        while marker == b'\xff':
+            marker = jpeg.read(1)
+        if not marker:
+            return width, height, False
+        marker = marker[0]
+        if marker in STANDALONE_MARKERS:
+            continue
+        length_bytes = jpeg.read(2)
+        if len(length_bytes) < 2:
+            return width, height, False
+        length = struct.unpack('>H', length_bytes)[0]
+        if marker == SOS:
+            return width, height, width is not None
+        if marker in SOF_MARKERS:
+            segment = jpeg.read(5)
+            if len(segment) < 5:
+                return width, height, False
+            height, width = struct.unpack('>HH', segment[1:5])
+            jpeg.seek(length - 7, os.SEEK_CUR)
+        else:
+            jpeg.seek(length - 2, os.SEEK_CUR)
+
+
+def read_image_meta(image_path: str) -> Dict:
+    """
+    Returns width, height, byte size, content hash and decodable flag of a JPEG without decoding it
+
+    The hash is a blake2b digest of the first HASH_HEAD_BYTES, the last TAIL_BYTES and the size of the file. It is
+    meant to cheaply detect identical or replaced files, not as a cryptographic guarantee.
+
+    Parameters
+    ----------
+    image_path : str
+        Path of the JPEG file
+
+    Returns
+    -------
+    meta : Dict
+        Dict with 'width', 'height', 'bytes', 'hash' and 'decodable' keys. width and height are None if the frame
+        header could not be read.
+    """
+
+    size = os.path.getsize(image_path)
+    with open(image_path, 'rb') as jpeg:
+        width, height, has_scan = _read_frame_size(jpeg)
+        jpeg.seek(0)
+        head = jpeg.read(HASH_HEAD_BYTES)
+        jpeg.seek(max(0, size - TAIL_BYTES))
+        tail = jpeg.read(TAIL_BYTES)
+
+    digest = hashlib.blake2b(head, digest_size=16)
+    digest.update(tail)
+    digest.update(struct.pack('>Q', size))
+
+    # a truncated transfer loses the end of image marker
+    decodable = has_scan and bool(width) and bool(height) and EOI in tail
+    return {'width': width, 'height': height, 'bytes': size, 'hash': digest.hexdigest(), 'decodable': decodable}
@@ -0,0 +1,126 @@
+"""
+This script keeps track of which camfeed folders have already been ingested into the database.
+
+Checkpoints are stored in a small Mongo collection. Each camera/date folder gets a document recording the folder
+mtime and the number of files seen when it was last ingested. Each camera also gets a watermark document recording
+the last date up to which all folders are sealed and never need to be looked at again.
+
+This script requires pymongo to be installed. The database server and port also need to be defined in the
+configuration file.
+
+This script can also be imported as a module and contains the IngestCheckpoints class.
+"""
+
+from datetime import datetime
+from typing import Optional
+
+from pymongo.database import Database
+
+
+class IngestCheckpoints:
+    """
+    A class for storing per camera and per date ingestion checkpoints
+
+    Attributes
+    ----------
+    collection : Collection
+        Collection where the checkpoint documents are stored
+
+    Methods
+    -------
+    folder_unchanged(cam, date, mtime)
+        Checks if a folder has not changed since it was last ingested
+    record(cam, date, mtime, count)
+        Records the mtime and file count of an ingested folder
+    sealed_through(cam)
+        Returns the last date up to which all folders of a camera are sealed
+    seal(cam, date)
+        Moves the sealed watermark of a camera forward to the specified date
+    """
+
+    def __init__(self, db: Database, clc: str):
+        """
+        Parameters
+        ----------
+        db : Database
+            Database in which the checkpoints are stored
+        clc : str
+            Name of the checkpoint collection
+        """
+
+        self.collection = db[clc]
+
+    def folder_unchanged(self, cam: str, date: str, mtime: int) -> bool:
+        """
+        Checks if a folder has not changed since it was last ingested
+
+        Parameters
+        ----------
+        cam : str
+            Camera ID of the camera node
+        date : str
+            Date of the folder
+        mtime : int
+            Current mtime of the folder in nanoseconds
+
+        Returns
+        -------
+        bool
+            True if the folder was ingested before with the same mtime
+        """
+
+        return self.collection.count_documents({'_id': cam + '_' + date, 'mtime': mtime}, limit=1) > 0
+
+    def record(self, cam: str, date: str, mtime: int, count: int):
+        """
+        Records the mtime and file count of an ingested folder
+
+        Parameters
+        ----------
+        cam : str
+            Camera ID of the camera node
+        date : str
+            Date of the folder
+        mtime : int
+            mtime of the folder in nanoseconds when it was listed
+        count : int
+            Number of files found in the folder
+        """
+
+        self.collection.update_one({'_id': cam + '_' + date},
+                                   {'$set': {'cam_id': cam, 'date': date, 'mtime': mtime, 'count': count,
+                                             'updated': datetime.now()}},
+                                   upsert=True)
+
+    def sealed_through(self, cam: str) -> Optional[str]:
+        """
+        Returns the last date up to which all folders of a camera are sealed
+
+        Parameters
+        ----------
+        cam : str
+            Camera ID of the camera node
+
+        Returns
+        -------
+        date : str or None
+            Sealed date or None if nothing has been sealed yet
+        """
+
+        watermark = self.collection.find_one({'_id': cam})
+        return watermark.get('sealed_through') if watermark is not None else None
+
+    def seal(self, cam: str, date: str):
+        """
+        Moves the sealed watermark of a camera forward to the specified date. The watermark never moves back.
+
+        Parameters
+        ----------
+        cam : str
+            Camera ID of the camera node
+        date : str
+            Date in '%Y-%m-%d' format up to which all folders are sealed
+        """
+
+        # ISO dates compare in chronological order so $max keeps the latest one
+        self.collection.update_one({'_id': cam}, {'$max': {'sealed_through': date}}, upsert=True)
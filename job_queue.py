@@ -0,0 +1,350 @@
+"""
+This script contains a leased work queue for the inference workers.
+
+Every image inserted by DbUp gets one job per model in the jobs collection. Workers claim jobs atomically with
+find_one_and_update, which puts a lease on the job. A job whose lease expires, e.g. because its worker crashed, is
+handed out again until it runs out of attempts, after which it is marked as failed and no longer counted as open
+work. Finished jobs are removed so the collection only holds open work.
+Jobs are enqueued with the partition of their image, workers on several machines given a Cluster only claim jobs of
+the partitions their node owns.
+Idle workers block on a change stream of the jobs collection, which needs MongoDB to run as a replica set (a single
+node replica set is enough). Without change streams they fall back to polling with exponential backoff.
+
+This script requires pymongo to be installed. The indexes of the jobs collection are declared in the schema module.
+
+This script can also be imported as a module and contains the JobQueue class.
+"""
+
+import time
+from datetime import datetime, timedelta
+from typing import Optional, Dict, List
+
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.database import Database
+from pymongo.errors import BulkWriteError, OperationFailure, PyMongoError
+
+# noinspection PyUnresolvedReferences
+import cfg
+from cluster import partition
+
+# Job states
+PENDING = 'pending'
+LEASED = 'leased'
+FAILED = 'failed'
+# Error code of an insert whose _id already exists
+DUPLICATE_KEY_CODE = 11000
+# First poll delay when change streams are unavailable, doubled on every empty poll up to backoff_max
+BACKOFF_MIN = 0.05
+
+
+class JobQueue:
+    """
+    A class for handing out inference jobs of one model to several workers
+
+    Attributes
+    ----------
+    collection : Collection
+        Collection where the jobs of all models are stored
+    model : str
+        Model whose jobs are handled, e.g. 'OD' or 'SG'
+    lease_seconds : int
+        Seconds a claimed job is reserved for its worker
+    max_attempts : int
+        Number of times a job is handed out before it is marked as failed
+    cluster : Cluster
+        Node whose partitions are claimed, None claims jobs of every partition
+
+    Methods
+    -------
+    enqueue(doc_ids)
+        Adds a job for every document id
+    claim(worker)
+        Atomically leases the oldest available job, of the partitions owned by the node if there is a cluster
+    next_job(worker, stop)
+        Blocks until a job can be leased and returns it, or None once stop is set
+    next_jobs(worker, count, stop)
+        Blocks until a job can be leased and returns it together with up to count - 1 more available jobs
+    backlog()
+        Returns the number of open jobs
+    expire()
+        Marks jobs as failed whose last lease expired without attempts left
+    complete(job)
+        Removes a finished job
+    fail(job)
+        Hands a job back or marks it as failed once it ran out of attempts
+    enqueue_missing(collection, field)
+        Adds jobs for all documents of a collection which do not have the field yet
+    """
+
+    def __init__(self, db: Database, clc: str, model: str,
+                 lease_seconds: Optional[int] = cfg.job_queue.get('lease_seconds'),
+                 max_attempts: Optional[int] = cfg.job_queue.get('max_attempts'),
+                 wait_timeout: Optional[float] = cfg.job_queue.get('wait_timeout'),
+                 backoff_max: Optional[float] = cfg.job_queue.get('backoff_max'),
+                 cluster=None):
+        """
+        Parameters
+        ----------
+        db : Database
+            Database in which the jobs are stored
+        clc : str
+            Name of the jobs collection
+        model : str
+            Model whose jobs are handled, e.g. 'OD' or 'SG'
+        lease_seconds : int, optional
+            Seconds a claimed job is reserved for its worker (Default is cfg.job_queue['lease_seconds'])
+        max_attempts : int, optional
+            Number of times a job is handed out before it is marked as failed
+            (Default is cfg.job_queue['max_attempts'])
+        wait_timeout : float, optional
+            Maximum seconds an idle worker blocks on the change stream before checking for expired leases
+            (Default is cfg.job_queue['wait_timeout'])
+        backoff_max : float, optional
+            Maximum seconds between polls when change streams are unavailable
+            (Default is cfg.job_queue['backoff_max'])
+        cluster : Cluster, optional
+            Node whose partitions are claimed (Default is None, jobs of every partition are claimed)
+        """
+
+        self.collection = db[clc]
+        self.model = model
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.wait_timeout = wait_timeout
+        self.backoff_max = backoff_max
+        self.cluster = cluster
+        self._stream = None
+        self._change_streams = True
+        self._backoff = BACKOFF_MIN
+
+    def enqueue(self, doc_ids: List[str]) -> int:
+        """
+        Adds a job for every document id. Documents which already have a job are skipped.
+
+        Parameters
+        ----------
+        doc_ids : list
+            _id values of the documents in the main collection
+
+        Returns
+        -------
+        enqueued : int
+            Number of jobs added
+        """
+
+        if not doc_ids:
+            return 0
+        now = datetime.utcnow()
+        jobs = [{'_id': self.model + '_' + doc_id, 'model': self.model, 'doc_id': doc_id, 'status': PENDING,
+                 'partition': partition(doc_id), 'enqueued_at': now, 'attempts': 0} for doc_id in doc_ids]
+        try:
+            return len(self.collection.insert_many(jobs, ordered=False).inserted_ids)
+        except BulkWriteError as error:
+            # documents which already have a job are expected, anything else would leave an image without one
+            write_errors = error.details.get('writeErrors', [])
+            if any(write_error.get('code') != DUPLICATE_KEY_CODE for write_error in write_errors):
+                raise
+            return error.details.get('nInserted', 0)
+
+    def claim(self, worker: str) -> Optional[Dict]:
+        """
+        Atomically leases the oldest available job, of the partitions owned by the node if there is a cluster
+
+        Parameters
+        ----------
+        worker : str
+            Name of the claiming worker, stored on the job for debugging
+
+        Returns
+        -------
+        job : Dict or None
+            Leased job or None if there is no work
+        """
+
+        now = datetime.utcnow()
+        query = {'model': self.model, 'attempts': {'$lt': self.max_attempts},
+                 '$or': [{'status': PENDING}, {'status': LEASED, 'lease_expires': {'$lt': now}}]}
+        if self.cluster is not None:
+            partitions = self.cluster.partitions
+            if not partitions:
+                return None
+            query['partition'] = {'$in': sorted(partitions)}
+        return self.collection.find_one_and_update(
+            query,
+            {'$set': {'status': LEASED, 'worker': worker, 'lease_expires': now + timedelta(seconds=self.lease_seconds)},
+             '$inc': {'attempts': 1}},
+            sort=[('enqueued_at', ASCENDING)],
+            return_document=ReturnDocument.AFTER)
+
+    def next_job(self, worker: str, stop=None) -> Optional[Dict]:
+        """
+        Blocks until a job can be leased and returns it, or None once stop is set
+
+        Parameters
+        ----------
+        worker : str
+            Name of the claiming worker, stored on the job for debugging
+        stop : Event, optional
+            threading or multiprocessing Event which makes an idle worker give up waiting, checked at least every
+            wait_timeout seconds (Default is None, wait forever)
+
+        Returns
+        -------
+        job : Dict or None
+            Leased job, None if stop was set before one could be leased
+        """
+
+        while stop is None or not stop.is_set():
+            # the stream is opened before claiming so an insert in between is not missed
+            self._open_stream()
+            job = self.claim(worker)
+            if job is not None:
+                self._backoff = BACKOFF_MIN
+                return job
+            self.expire()
+            self._wait()
+        return None
+
+    def next_jobs(self, worker: str, count: int, stop=None) -> List[Dict]:
+        """
+        Blocks until a job can be leased and returns it together with up to count - 1 more available jobs
+
+        Only the first job is waited for, so a batch is never held back until it is full.
+
+        Parameters
+        ----------
+        worker : str
+            Name of the claiming worker, stored on the jobs for debugging
+        count : int
+            Maximum number of jobs returned
+        stop : Event, optional
+            Event which makes an idle worker give up waiting, see next_job (Default is None, wait forever)
+
+        Returns
+        -------
+        jobs : list
+            Leased jobs in enqueue order, empty if stop was set before one could be leased
+        """
+
+        job = self.next_job(worker, stop)
+        if job is None:
+            return []
+        jobs = [job]
+        while len(jobs) < count:
+            job = self.claim(worker)
+            if job is None:
+                break
+            jobs.append(job)
+        return jobs
+
+    def backlog(self) -> int:
+        """
+        Returns the number of open jobs, leased ones included. Every image without predictions of the model has one,
+        except for images whose job failed.
+        """
+
+        self.expire()
+        return self.collection.count_documents({'model': self.model, 'status': {'$in': [PENDING, LEASED]}})
+
+    def expire(self) -> int:
+        """
+        Marks jobs as failed whose last lease expired without attempts left, e.g. images which crash every worker
+        claiming them. claim skips such jobs, without this they would stay leased forever.
+
+        Returns
+        -------
+        expired : int
+            Number of jobs marked as failed
+        """
+
+        return self.collection.update_many(
+            {'model': self.model, 'status': LEASED, 'attempts': {'$gte': self.max_attempts},
+             'lease_expires': {'$lt': datetime.utcnow()}},
+            {'$set': {'status': FAILED}, '$unset': {'lease_expires': ''}}).modified_count
+
+    def _open_stream(self):
+        """
+        Opens a change stream on inserted jobs of the model if change streams are available
+        """
+
+        if self._stream is not None or not self._change_streams:
+            return
+        try:
+            self._stream = self.collection.watch([{'$match': {'operationType': 'insert',
+                                                              'fullDocument.model': self.model}}],
+                                                 max_await_time_ms=int(self.wait_timeout * 1000))
+        except OperationFailure:
+            # standalone servers do not support change streams
+            self._change_streams = False
+            print('Change streams are not available, polling the {} queue'.format(self.model))
+
+    def _wait(self):
+        """
+        Waits for a new job on the change stream, or sleeps with exponential backoff without one
+        """
+
+        if self._stream is not None:
+            try:
+                # returns on the first insert or after wait_timeout so expired leases are picked up too
+                self._stream.try_next()
+                return
+            except PyMongoError:
+                self._stream.close()
+                self._stream = None
+        time.sleep(self._backoff)
+        self._backoff = min(self._backoff * 2, self.backoff_max)
+
+    def complete(self, job: Dict):
+        """
+        Removes a finished job
+
+        Parameters
+        ----------
+        job : Dict
+            Job returned by claim
+        """
+
+        self.collection.delete_one({'_id': job.get('_id'), 'worker': job.get('worker')})
+
+    def fail(self, job: Dict):
+        """
+        Hands a job back or marks it as failed once it ran out of attempts
+
+        Parameters
+        ----------
+        job : Dict
+            Job returned by claim
+        """
+
+        status = FAILED if job.get('attempts', 0) >= self.max_attempts else PENDING
+        self.collection.update_one({'_id': job.get('_id'), 'worker': job.get('worker')},
+                                   {'$set': {'status': status}, '$unset': {'lease_expires': ''}})
+
+    def enqueue_missing(self, collection, field: str, batch_size: Optional[int] = 1000) -> int:
+        """
+        Adds jobs for all documents of a collection which do not have the field yet
+
+        Parameters
+        ----------
+        collection : Collection
+            Main collection containing the image documents
+        field : str
+            Prediction field written by the model, e.g. 'OD_Predictions'
+        batch_size : int, optional
+            Number of jobs inserted at once (Default is 1000)
+
+        Returns
+        -------
+        enqueued : int
+            Number of jobs added
+        """
+
+        enqueued = 0
+        doc_ids = []
+        for document in collection.find({field: {'$exists': False}}, {'_id': 1}):
+            doc_ids.append(document.get('_id'))
+            if len(doc_ids) >= batch_size:
+                enqueued += self.enqueue(doc_ids)
+                doc_ids = []
+        return enqueued + self.enqueue(doc_ids)
+
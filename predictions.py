@@ -0,0 +1,316 @@
+"""
+This script defines how object detection results are stored in the main collection.
+
+A document with predictions has
+    * OD_Predictions - parallel arrays 'class' (index into the classes file), 'score', 'left', 'top', 'right' and
+      'bottom', one entry per box. Coordinates are pixels of the original image
+    * od_count - number of boxes
+    * od_class_counts - class name -> number of boxes
+
+When the OD worker stores candidate boxes down to a low score floor, od_score_floor holds that floor and the counts
+are those at the model's default score and IoU. Other operating points are approximated when querying with select.
+
+The counts are written together with the boxes, so analytics sum an integer instead of loading box lists. Documents
+written before this format kept a list of string dicts per box, they are converted by a migration in the schema
+module.
+
+This script can also be imported as a module and contains the following methods:
+    * load_class_names - Returns the class names of the OD model
+    * empty - Returns the fields to $set for an image without detections
+    * pack - Returns the fields to $set for the detections of one image
+    * from_annotations - Returns the fields to $set for a list of annotation dicts of the old format
+    * unpack - Returns the boxes of stored predictions as a list of dicts
+    * select - Returns the indexes of stored boxes kept at a score threshold and NMS IoU
+    * count - Returns the number of stored boxes kept at a score threshold and NMS IoU
+    * count_many - Returns the number of stored boxes kept at a score threshold and NMS IoU for many documents
+    * at_default - Returns whether a score threshold and NMS IoU are the ones od_count was taken at
+"""
+
+import math
+import os
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# numpy is only needed to filter boxes at query time, the db image applies the migrations without it
+try:
+    import numpy as np
+    from OD_model.yolo3.postprocess import non_max_suppression
+except ImportError:
+    np = None
+
+# Box arrays stored in OD_Predictions, in this order
+FIELDS = ('class', 'score', 'left', 'top', 'right', 'bottom')
+CLASSES_PATH = os.path.join('OD_model', 'model_data', 'garbage_classes.txt')
+# Digits scores are rounded to
+SCORE_DIGITS = 4
+# Score threshold, NMS IoU and per class box limit of the model's default operating point, the score, iou and
+# max_boxes defaults of OD_model.yolo.YOLO
+DEFAULT_SCORE = 0.5
+DEFAULT_IOU = 0.45
+DEFAULT_MAX_BOXES = 20
+
+
+def load_class_names(classes_path: Optional[str] = CLASSES_PATH) -> List[str]:
+    """
+    Returns the class names of the OD model, the position of a name is its class index
+    """
+
+    with open(os.path.expanduser(classes_path)) as f:
+        return [c.strip() for c in f.readlines()]
+
+
+def _fields(classes: List[int], names: List[str], scores: List[float],
+            boxes: List[Tuple[int, int, int, int]]) -> Dict:
+    """
+    Returns OD_Predictions, od_count and od_class_counts for boxes given as (left, top, right, bottom)
+    """
+
+    class_counts = {}
+    for name in names:
+        class_counts[name] = class_counts.get(name, 0) + 1
+    predictions = {'class': classes, 'score': scores}
+    for i, field in enumerate(FIELDS[2:]):
+        predictions[field] = [box[i] for box in boxes]
+    return {'OD_Predictions': predictions, 'od_count': len(classes), 'od_class_counts': class_counts}
+
+
+def _recount(fields: Dict, names: List[str], operating_point: Optional[Tuple[float, float, int]]) -> Dict:
+    """
+    Replaces od_count and od_class_counts by the counts of the boxes kept at the operating point
+    """
+
+    if operating_point is None:
+        return fields
+    kept = select(fields.get('OD_Predictions'), *operating_point)
+    classes = fields.get('OD_Predictions').get('class')
+    counted = _fields([classes[i] for i in kept], [names[i] for i in kept], [], [])
+    fields['od_count'] = counted.get('od_count')
+    fields['od_class_counts'] = counted.get('od_class_counts')
+    return fields
+
+
+def empty() -> Dict:
+    """
+    Returns the fields to $set for an image without detections, e.g. a file which could not be decoded
+    """
+
+    return _fields([], [], [], [])
+
+
+def pack(out_boxes, out_scores, out_classes, image_size: Tuple[int, int], class_names: Sequence[str],
+         operating_point: Optional[Tuple[float, float, int]] = None) -> Dict:
+    """
+    Returns the fields to $set for the detections of one image
+
+    Boxes are rounded and clipped to the image the same way YOLO.annotate does.
+
+    Parameters
+    ----------
+    out_boxes : ndarray
+        (top, left, bottom, right) of every box in original image coordinates
+    out_scores : ndarray
+        Score of every box
+    out_classes : ndarray
+        Class index of every box
+    image_size : tuple
+        (width, height) of the original image
+    class_names : list
+        Class names of the model
+    operating_point : tuple, optional
+        (score, iou, max_boxes) the counts are computed at when the detections are candidates filtered at a lower
+        score floor (Default is None, every box is counted)
+
+    Returns
+    -------
+    fields : Dict
+        OD_Predictions, od_count and od_class_counts
+    """
+
+    classes, scores, boxes = [], [], []
+    for i, c in reversed(list(enumerate(out_classes))):
+        top, left, bottom, right = out_boxes[i]
+        top = max(0, math.floor(top + 0.5))
+        left = max(0, math.floor(left + 0.5))
+        bottom = min(image_size[1], math.floor(bottom + 0.5))
+        right = min(image_size[0], math.floor(right + 0.5))
+        classes.append(int(c))
+        scores.append(round(float(out_scores[i]), SCORE_DIGITS))
+        boxes.append((left, top, right, bottom))
+    return _recount(_fields(classes, [class_names[c] for c in classes], scores, boxes),
+                    [class_names[c] for c in classes], operating_point)
+
+
+def from_annotations(annot: List[Dict], class_names: Sequence[str],
+                     operating_point: Optional[Tuple[float, float, int]] = None) -> Dict:
+    """
+    Returns the fields to $set for a list of annotation dicts of the old format
+
+    Parameters
+    ----------
+    annot : list
+        Dicts with string values for 'class', 'confidence_score', 'left', 'top', 'right' and 'bottom'
+    class_names : list
+        Class names of the model, names which are not in it get the index -1
+    operating_point : tuple, optional
+        (score, iou, max_boxes) the counts are computed at, see pack (Default is None, every box is counted)
+
+    Returns
+    -------
+    fields : Dict
+        OD_Predictions, od_count and od_class_counts
+    """
+
+    classes = [class_names.index(box.get('class')) if box.get('class') in class_names else -1 for box in annot]
+    scores = [float(box.get('confidence_score')) for box in annot]
+    boxes = [tuple(int(box.get(field)) for field in FIELDS[2:]) for box in annot]
+    names = [box.get('class') for box in annot]
+    return _recount(_fields(classes, names, scores, boxes), names, operating_point)
+
+
+def unpack(predictions: Dict, class_names: Sequence[str]) -> List[Dict]:
+    """
+    Returns the boxes of stored predictions as a list of dicts
+
+    Parameters
+    ----------
+    predictions : Dict
+        OD_Predictions of a document
+    class_names : list
+        Class names of the model
+
+    Returns
+    -------
+    boxes : list
+        Dicts with 'class' name, 'score', 'left', 'top', 'right' and 'bottom'
+    """
+
+    boxes = []
+    for values in zip(*[predictions.get(field, []) for field in FIELDS]):
+        box = dict(zip(FIELDS, values))
+        box['class'] = class_names[box['class']] if 0 <= box['class'] < len(class_names) else None
+        boxes.append(box)
+    return boxes
+
+
+def select(od_predictions: Dict, min_score: Optional[float] = None, iou: Optional[float] = None,
+           max_boxes: Optional[int] = None):
+    """
+    Returns the indexes of stored boxes kept at a score threshold and per class NMS IoU
+
+    This approximates running the model at that operating point. The candidates were already suppressed at the IoU
+    and box limit they were stored with and their scores are rounded, so boxes removed then can not come back and
+    near ties may be resolved differently. Without iou and max_boxes the model's defaults are applied, so counts at
+    the default operating point equal od_count.
+
+    Parameters
+    ----------
+    od_predictions : Dict
+        OD_Predictions of a document
+    min_score : float, optional
+        Boxes with a lower score are dropped (Default is None, no score filter)
+    iou : float, optional
+        Boxes overlapping a higher scoring box of the same class by more than this are dropped
+        (Default is None, DEFAULT_IOU)
+    max_boxes : int, optional
+        Maximum boxes kept per class (Default is None, DEFAULT_MAX_BOXES)
+
+    Returns
+    -------
+    indexes : ndarray
+        Indexes into the box arrays
+    """
+
+    scores = np.asarray(od_predictions.get('score', []), dtype='float32')
+    classes = np.asarray(od_predictions.get('class', []), dtype='int64')
+    candidates = np.flatnonzero(scores >= min_score) if min_score is not None else np.arange(len(scores))
+    iou = DEFAULT_IOU if iou is None else iou
+    max_boxes = DEFAULT_MAX_BOXES if max_boxes is None else max_boxes
+
+    # (top, left, bottom, right) as used by the NMS
+    boxes = np.stack([np.asarray(od_predictions.get(field, []), dtype='float32')
+                      for field in ('top', 'left', 'bottom', 'right')], axis=-1).reshape(-1, 4)
+    kept = []
+    for c in np.unique(classes[candidates]):
+        class_indexes = candidates[classes[candidates] == c]
+        keep = non_max_suppression(boxes[class_indexes], scores[class_indexes], max_boxes, iou)
+        kept.append(class_indexes[keep])
+    return np.sort(np.concatenate(kept)) if kept else candidates[:0]
+
+
+def count(od_predictions: Dict, min_score: Optional[float] = None, iou: Optional[float] = None,
+          max_boxes: Optional[int] = None) -> int:
+    """
+    Returns the number of stored boxes kept at a score threshold and per class NMS IoU, see select
+    """
+
+    return len(select(od_predictions, min_score, iou, max_boxes))
+
+
+def count_many(od_predictions: Sequence[Dict], min_score: Optional[float] = None, iou: Optional[float] = None,
+               max_boxes: Optional[int] = None):
+    """
+    Returns the number of stored boxes kept at a score threshold and per class NMS IoU for every document, see select
+
+    The score filter runs once over the concatenated arrays of all documents. NMS only runs for the (document, class)
+    groups left with more than one candidate, a single candidate is always kept.
+
+    Parameters
+    ----------
+    od_predictions : list
+        OD_Predictions of the documents
+    min_score : float, optional
+        Boxes with a lower score are dropped (Default is None, no score filter)
+    iou : float, optional
+        NMS IoU (Default is None, DEFAULT_IOU)
+    max_boxes : int, optional
+        Maximum boxes kept per class (Default is None, DEFAULT_MAX_BOXES)
+
+    Returns
+    -------
+    counts : ndarray
+        Number of kept boxes of every document
+    """
+
+    iou = DEFAULT_IOU if iou is None else iou
+    max_boxes = DEFAULT_MAX_BOXES if max_boxes is None else max_boxes
+    lengths = [len(predictions.get('score', [])) for predictions in od_predictions]
+    counts = np.zeros(len(lengths), dtype='int64')
+    if not sum(lengths):
+        return counts
+    documents = np.repeat(np.arange(len(lengths)), lengths)
+    scores = np.concatenate([np.asarray(predictions.get('score', []), dtype='float32')
+                             for predictions in od_predictions])
+    classes = np.concatenate([np.asarray(predictions.get('class', []), dtype='int64')
+                              for predictions in od_predictions])
+    candidates = np.flatnonzero(scores >= min_score) if min_score is not None else np.arange(len(scores))
+    if not len(candidates):
+        return counts
+
+    # one key per (document, class) group, classes of unknown names are -1
+    span = classes.max() - classes.min() + 1
+    groups, inverse, sizes = np.unique(documents[candidates] * span + classes[candidates] - classes.min(),
+                                       return_inverse=True, return_counts=True)
+    kept = np.minimum(sizes, max_boxes)
+    crowded = np.flatnonzero(sizes > 1)
+    if len(crowded):
+        # (top, left, bottom, right) as used by the NMS
+        boxes = np.concatenate([np.stack([np.asarray(predictions.get(field, []), dtype='float32')
+                                          for field in ('top', 'left', 'bottom', 'right')], axis=-1).reshape(-1, 4)
+                                for predictions in od_predictions])
+        members = candidates[np.argsort(inverse, kind='stable')]
+        starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+        for group in crowded:
+            indexes = members[starts[group]:starts[group] + sizes[group]]
+            kept[group] = len(non_max_suppression(boxes[indexes], scores[indexes], max_boxes, iou))
+    np.add.at(counts, groups // span, kept)
+    return counts
+
+
+def at_default(min_score: Optional[float] = None, iou: Optional[float] = None) -> bool:
+    """
+    Returns whether a score threshold and NMS IoU are the ones od_count was taken at, so the stored count can be used
+    instead of filtering the boxes. Without either the stored count is used as well
+    """
+
+    if min_score is None and iou is None:
+        return True
+    return min_score == DEFAULT_SCORE and iou in (None, DEFAULT_IOU)
@@ -0,0 +1,240 @@
+"""
+This script declares the indexes of the database collections and runs versioned data migrations.
+
+Indexes are created idempotently, so ensure_indexes can be called by every service at startup. It first waits for
+the replica set to have a primary, which takes a few seconds after the containers start. Migrations are applied
+once, in version order, and recorded in the schema_migrations collection.
+
+This script requires pymongo to be installed. The database server and port also need to be defined in the
+configuration file. Running it directly applies indexes and migrations and prints how often each index was used.
+
+This script can also be imported as a module and contains the following methods:
+    * wait_for_primary - Blocks until the server accepts writes
+    * ensure_indexes - Creates all declared indexes which do not exist yet
+    * migrate - Applies all migrations which have not been applied yet
+    * index_usage - Returns usage statistics of the indexes of a collection
+"""
+
+import time
+from datetime import datetime
+from typing import List, Dict
+
+from pymongo import MongoClient, ASCENDING, GEO2D, UpdateOne
+from pymongo.database import Database
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+# noinspection PyUnresolvedReferences
+import cfg
+from cluster import partition
+from job_queue import JobQueue
+from predictions import load_class_names, from_annotations
+
+MIGRATIONS_CLC = 'schema_migrations'
+# seconds a service waits for the replica set to elect a primary before giving up
+PRIMARY_TIMEOUT = 300
+
+# cfg.mongo_cfg collection key -> list of (keys, options) passed to create_index. Indexes without a name keep the
+# default one mongo derives from their keys
+INDEXES = {
+    'db_raw_clc': [
+        ([('location', GEO2D)], {'name': 'location_2d'}),
+        # image lookups by camera and day, ordered by time
+        ([('cam_id', ASCENDING), ('date', ASCENDING), ('time', ASCENDING)], {'name': 'cam_date_time'}),
+        ([('date', ASCENDING), ('time', ASCENDING)], {'name': 'date_time'}),
+        # api queries only ever look at documents which already have predictions. Partial indexes can not express
+        # missing fields, the inference workers find those through the jobs collection instead
+        ([('cam_id', ASCENDING), ('date', ASCENDING)],
+         {'name': 'od_predicted_cam_date', 'partialFilterExpression': {'OD_Predictions': {'$exists': True}}}),
+        ([('date', ASCENDING)],
+         {'name': 'od_predicted_date', 'partialFilterExpression': {'OD_Predictions': {'$exists': True}}}),
+        ([('cam_id', ASCENDING), ('date', ASCENDING)],
+         {'name': 'sg_predicted_cam_date', 'partialFilterExpression': {'SG_Predictions': {'$exists': True}}}),
+        ([('date', ASCENDING)],
+         {'name': 'sg_predicted_date', 'partialFilterExpression': {'SG_Predictions': {'$exists': True}}}),
+    ],
+    'db_jobs_clc': [
+        # claims look up open jobs of a model in enqueue order, expired leases by their expiry
+        ([('model', ASCENDING), ('status', ASCENDING), ('enqueued_at', ASCENDING)], {}),
+        ([('model', ASCENDING), ('status', ASCENDING), ('lease_expires', ASCENDING)], {}),
+        # claims of a cluster node look up open jobs of the partitions it owns
+        ([('model', ASCENDING), ('status', ASCENDING), ('partition', ASCENDING), ('enqueued_at', ASCENDING)], {}),
+    ],
+    'db_nodes_clc': [
+        # live nodes of a model are found by their last heartbeat, nodes which died are removed after a day
+        ([('model', ASCENDING), ('heartbeat', ASCENDING)], {}),
+        ([('heartbeat', ASCENDING)], {'name': 'heartbeat_ttl', 'expireAfterSeconds': 24 * 60 * 60}),
+    ],
+}
+
+
+def wait_for_primary(client: MongoClient, timeout: float = PRIMARY_TIMEOUT):
+    """
+    Blocks until the server accepts writes. mongo runs as a replica set, which has no primary until mongo_rs_init
+    initiated it
+
+    Parameters
+    ----------
+    client : MongoClient
+        Client connected to the server
+    timeout : float, optional
+        Seconds to wait before raising the last error (Default is PRIMARY_TIMEOUT)
+    """
+
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            if client.admin.command('isMaster').get('ismaster'):
+                return
+            error = None
+        except PyMongoError as e:
+            error = e
+        if time.monotonic() > deadline:
+            raise error or TimeoutError('mongo has no primary after {} seconds'.format(timeout))
+        print('Waiting for a mongo primary')
+        time.sleep(2)
+
+
+def ensure_indexes(db: Database):
+    """
+    Creates all declared indexes which do not exist yet, once the server accepts writes
+
+    Parameters
+    ----------
+    db : Database
+        Database containing the collections
+    """
+
+    wait_for_primary(db.client)
+    for clc_key, indexes in INDEXES.items():
+        collection = db[cfg.mongo_cfg.get(clc_key)]
+        for keys, options in indexes:
+            collection.create_index(keys, **options)
+
+
+def enqueue_missing_predictions(db: Database):
+    """
+    Enqueues inference jobs for images which were ingested before the jobs collection existed
+    """
+
+    for model in cfg.job_queue.get('models'):
+        queue = JobQueue(db, cfg.mongo_cfg.get('db_jobs_clc'), model)
+        enqueued = queue.enqueue_missing(db[cfg.mongo_cfg.get('db_raw_clc')], model + '_Predictions')
+        print('{} {} jobs enqueued'.format(enqueued, model))
+
+
+def compact_od_predictions(db: Database, batch_size: int = 1000):
+    """
+    Converts OD predictions stored as lists of string dicts into the parallel arrays of the predictions module and
+    adds od_count and od_class_counts
+    """
+
+    collection = db[cfg.mongo_cfg.get('db_raw_clc')]
+    class_names = load_class_names()
+    converted = 0
+    updates = []
+    # documents in the new format hold an object, only the old lists match
+    old_format = {'OD_Predictions': {'$type': 'array'}}
+    for document in collection.find(old_format, {'OD_Predictions': 1}):
+        updates.append(UpdateOne(dict(old_format, _id=document.get('_id')),
+                                 {'$set': from_annotations(document.get('OD_Predictions'), class_names)}))
+        if len(updates) >= batch_size:
+            converted += collection.bulk_write(updates, ordered=False).modified_count
+            updates = []
+    if updates:
+        converted += collection.bulk_write(updates, ordered=False).modified_count
+    print('{} OD predictions converted'.format(converted))
+
+
+def partition_jobs(db: Database, batch_size: int = 1000):
+    """
+    Stores the cluster partition on jobs which were enqueued before jobs had one
+    """
+
+    jobs = db[cfg.mongo_cfg.get('db_jobs_clc')]
+    updated = 0
+    updates = []
+    for job in jobs.find({'partition': {'$exists': False}}, {'doc_id': 1}):
+        updates.append(UpdateOne({'_id': job.get('_id')}, {'$set': {'partition': partition(job.get('doc_id'))}}))
+        if len(updates) >= batch_size:
+            updated += jobs.bulk_write(updates, ordered=False).modified_count
+            updates = []
+    if updates:
+        updated += jobs.bulk_write(updates, ordered=False).modified_count
+    print('{} jobs partitioned'.format(updated))
+
+
+# (version, description, function taking the database) in the order they are applied
+MIGRATIONS = [
+    (1, 'enqueue jobs for images without predictions', enqueue_missing_predictions),
+    (2, 'store OD predictions as numeric arrays with counts', compact_od_predictions),
+    (3, 'store the cluster partition on open jobs', partition_jobs),
+]
+
+
+def migrate(db: Database) -> List[int]:
+    """
+    Applies all migrations which have not been applied yet
+
+    A migration is claimed by inserting its version before running it, so concurrent services starting up at the same
+    time do not apply it twice.
+
+    Parameters
+    ----------
+    db : Database
+        Database to be migrated
+
+    Returns
+    -------
+    applied : list
+        Versions applied by this call
+    """
+
+    migrations = db[MIGRATIONS_CLC]
+    applied = []
+    for version, description, migration in MIGRATIONS:
+        try:
+            migrations.insert_one({'_id': version, 'description': description, 'status': 'running',
+                                   'started_at': datetime.utcnow()})
+        except DuplicateKeyError:
+            continue
+        try:
+            migration(db)
+        except Exception:
+            # release the claim so the migration is retried on the next start
+            migrations.delete_one({'_id': version})
+            raise
+        migrations.update_one({'_id': version}, {'$set': {'status': 'done', 'applied_at': datetime.utcnow()}})
+        applied.append(version)
+        print('Applied migration {}: {}'.format(version, description))
+    return applied
+
+
+def index_usage(collection) -> List[Dict]:
+    """
+    Returns usage statistics of the indexes of a collection
+
+    Parameters
+    ----------
+    collection : Collection
+        Collection whose indexes are reported
+
+    Returns
+    -------
+    usage : list
+        Dicts with index 'name', number of 'ops' served and the time usage counting started 'since'
+    """
+
+    return [{'name': stats.get('name'), 'ops': stats.get('accesses', {}).get('ops'),
+             'since': stats.get('accesses', {}).get('since')}
+            for stats in collection.aggregate([{'$indexStats': {}}])]
+
+
+if __name__ == '__main__':
+    client = MongoClient(cfg.mongo_cfg.get('db_server').get('host'), int(cfg.mongo_cfg.get('db_server').get('port')))
+    database = client[cfg.mongo_cfg.get('db_name')]
+    ensure_indexes(database)
+    migrate(database)
+    for key in INDEXES:
+        print(cfg.mongo_cfg.get(key))
+        for usage in sorted(index_usage(database[cfg.mongo_cfg.get(key)]), key=lambda stats: -stats.get('ops')):
+            print('    {:<28} {:>12} ops since {}'.format(usage.get('name'), usage.get('ops'), usage.get('since')))
@@ -1,28 +1,76 @@
 import os
+import socket
+import traceback
 
 from pymongo import MongoClient
 
 import cfg
+import image_loader
+from cluster import Cluster
+from job_queue import JobQueue
+from schema import ensure_indexes
 from SG_model.script import predict_
 
 client = MongoClient(cfg.mongo_cfg.get('db_server').get('host'), int(cfg.mongo_cfg.get('db_server').get('port')))
 db = client[cfg.mongo_cfg.get('db_name')]
 collection = db[cfg.mongo_cfg.get('db_raw_clc')]
+ensure_indexes(db)
+worker_name = '{}-{}'.format(socket.gethostname(), os.getpid())
+# with cfg.cluster enabled the worker is a node of the cluster and only claims jobs of the partitions it owns
+cluster = Cluster(db, cfg.mongo_cfg.get('db_nodes_clc'), 'SG', worker_name) if cfg.cluster.get('enabled') else None
+queue = JobQueue(db, cfg.mongo_cfg.get('db_jobs_clc'), 'SG', cluster=cluster)
+# (width, height) of the SG model input
+SG_INPUT_SIZE = (256, 256)
 
 
-def db(model):
-    while True:
-        documents = collection.find({"SG_Predictions": {"$exists": False}})
-        for document in documents:
-            id = document.get('_id')
-            cam_id, folder_name, image_name = id.split('_')
-            image_path = os.path.join(cfg.directories.get('main_dir'), cam_id,
-                                      folder_name, image_name + '.jpg')
-            # image = Image.open(image_path)
+def predict_document(model, document):
+    id = document.get('_id')
+    cam_id, folder_name, image_name = id.split('_')
+    image_path = os.path.join(cfg.directories.get('main_dir'), cam_id,
+                              folder_name, image_name + '.jpg')
+    # image = Image.open(image_path)
+    # broken files are known from the header read at ingest, no need to decode them
+    if document.get('image', {}).get('decodable') is False:
+        collection.update_one({'_id': id}, {'$set': {'SG_Predictions': 0}})
+        return
+
+    # decoded at the smallest DCT scale still covering the model input, using the size read at ingest
+    image, _ = image_loader.load_array(image_path, SG_INPUT_SIZE, (document.get('image', {}).get('width'),
+                                                                   document.get('image', {}).get('height')))
+    if image is None:
+        # cv2.imread gives None for missing and unreadable files as well, opening the file raises the actual error.
+        # Either way the job is failed and retried, only the ingest flag above stores a prediction of 0
+        with open(image_path, 'rb'):
+            pass
+        raise OSError('cv2 could not decode {}'.format(image_path))
+
+    output = model(image)
 
-            output = model(image_path)
+    collection.update_one({'_id': id}, {'$set': {'SG_Predictions': output}})
 
-            collection.update_one({'_id': id}, {'$set': {'SG_Predictions': output}})
+
+def db(model, on_batch=None, stop=None):
+    # on_batch is called with 1 after every image, setting stop makes db return once the current image is done
+    if cluster is not None:
+        cluster.join()
+    while True:
+        job = queue.next_job(worker_name, stop)
+        if job is None:
+            if cluster is not None:
+                cluster.leave()
+            return
+        document = collection.find_one({'_id': job.get('doc_id')})
+        try:
+            if document is not None:
+                predict_document(model, document)
+        except Exception:
+            # the job is handed out again until it runs out of attempts
+            traceback.print_exc()
+            queue.fail(job)
+            continue
+        queue.complete(job)
+        if on_batch is not None:
+            on_batch(1)
 
 
 if __name__ == '__main__':
@@ -1,43 +1,278 @@
+import calendar
 import ftplib
-from typing import Optional
+import json
+import queue
+import threading
+from datetime import datetime, timedelta
+from typing import Optional, Dict, List, Tuple, TYPE_CHECKING
 import os
 import time
 
 import schedule
+from pymongo.errors import PyMongoError
 
 import cfg
 
+if TYPE_CHECKING:
+    from db_script import BatchInserter
+
+# Suffix of files which are still being downloaded, they are renamed into place once verified
+PART_SUFFIX = '.part'
+
+
+class BandwidthLimiter:
+    """Token bucket shared by all download sessions to cap the total transfer rate in bytes per second."""
+
+    def __init__(self, rate: Optional[float] = None):
+        self.rate = rate
+        self._allowance = rate or 0
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, num_bytes: int):
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._allowance = min(self.rate, self._allowance + (now - self._last) * self.rate)
+            self._last = now
+            self._allowance -= num_bytes
+            wait = -self._allowance / self.rate if self._allowance < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class SyncState:
+    """
+    Remote listing state persisted between sync runs in a json file.
+
+    Every camera folder keeps the server modify time it had when it was last listed, the number of files on the
+    server, the number of files which are still missing locally and whether it is complete. Complete folders are
+    never listed again.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        try:
+            with open(path) as state_file:
+                self.folders = json.load(state_file)
+        except FileNotFoundError:
+            self.folders = {}
+
+    def get(self, cam: str, folder: str) -> Dict:
+        return self.folders.get(cam, {}).get(folder, {})
+
+    def update(self, cam: str, folder: str, **values):
+        self.folders.setdefault(cam, {}).setdefault(folder, {}).update(values)
+
+    def save(self):
+        # write to a temporary file first so a crash can not leave a half written state behind
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path + '.tmp', 'w') as state_file:
+            json.dump(self.folders, state_file, indent=1, sort_keys=True)
+        os.replace(self.path + '.tmp', self.path)
+
 
 class SyncData:
-    def __init__(self, local_dir: Optional[str] = './camfeed', server_dir: Optional[str] = '/camfeed'):
+    def __init__(self, local_dir: Optional[str] = './camfeed', server_dir: Optional[str] = '/camfeed',
+                 workers: Optional[int] = cfg.ftp_sync.get('workers'),
+                 bandwidth: Optional[float] = cfg.ftp_sync.get('bandwidth'),
+                 settle_days: Optional[int] = cfg.ftp_sync.get('settle_days'),
+                 delete_remote: Optional[bool] = cfg.ftp_sync.get('delete_remote'),
+                 inserter: Optional['BatchInserter'] = None):
         self.local_dir = local_dir
         self.server_dir = server_dir
+        # number of parallel authenticated FTP sessions used for downloading
+        self.workers = workers
+        self.limiter = BandwidthLimiter(bandwidth)
+        # fully synced folders older than this many days are marked complete and never listed again
+        self.settle_days = settle_days
+        # remove files from the server once their download has been verified
+        self.delete_remote = delete_remote
+        # batched database writer which receives a document for every downloaded file, None to leave ingestion to
+        # db_script
+        self.inserter = inserter
+        self.state = SyncState(os.path.join(local_dir, cfg.ftp_sync.get('state_file')))
+        self._failed = set()
+        self._lock = threading.Lock()
 
-    def server_sync(self):
-        sess = ftplib.FTP(cfg.ftp_server.get('address'))
+    @staticmethod
+    def connect() -> ftplib.FTP:
+        sess = ftplib.FTP()
+        sess.connect(cfg.ftp_server.get('address'), int(cfg.ftp_server.get('port', 21)))
         sess.login(cfg.ftp_server.get('username'), cfg.ftp_server.get('password'))
+        return sess
+
+    @staticmethod
+    def list_remote(sess: ftplib.FTP) -> Dict[str, Dict]:
+        # file name -> MLSD facts of the current directory, only names when the server has no MLSD
+        try:
+            return {name: facts for name, facts in sess.mlsd(facts=['type', 'size', 'modify'])
+                    if facts.get('type') not in ('cdir', 'pdir')}
+        except ftplib.error_perm:
+            return {name: {} for name in sess.nlst()}
+
+    def missing_files(self, sess: ftplib.FTP) -> Dict[str, List[Tuple[str, str, Dict]]]:
+        # camera -> (folder, file, facts) of files missing locally, newest date folder first
+        missing = {}
         for cam in cfg.cam_info.keys():
             sess.cwd(os.path.join(self.server_dir, cam))
-            for folder in sess.nlst():
+            missing[cam] = []
+            for folder, folder_facts in sorted(self.list_remote(sess).items(), reverse=True):
+                folder_state = self.state.get(cam, folder)
+                if folder_state.get('complete'):
+                    continue
+                # nothing was added on the server since the last run and everything listed then was downloaded
+                if folder_facts.get('modify') and folder_facts.get('modify') == folder_state.get('modify') \
+                        and folder_state.get('missing') == 0:
+                    continue
+
                 sess.cwd(os.path.join(self.server_dir, cam, folder))
                 try:
                     local_files = os.listdir(os.path.join(self.local_dir, cam, folder))
                 except FileNotFoundError:
                     local_files = []
-                    if not os.path.exists(os.path.join(self.local_dir, cam)):
-                        os.mkdir(os.path.join(self.local_dir, cam))
-                    os.mkdir(os.path.join(self.local_dir, cam, folder))
+                    os.makedirs(os.path.join(self.local_dir, cam, folder), exist_ok=True)
 
-                server_files = [k for k in sess.nlst() if '.jpg' in k]
+                server_files = {k: facts for k, facts in self.list_remote(sess).items() if '.jpg' in k}
                 file_difference = sorted(list(set(server_files) - set(local_files)))
-                if file_difference:
-                    for file in file_difference:
-                        with open(os.path.join(self.local_dir, cam, folder, file), 'wb') as ftpfile:
-                            sess.retrbinary('RETR ' + file, ftpfile.write)
+                missing[cam].extend((folder, file, server_files[file]) for file in file_difference)
+                self.state.update(cam, folder, modify=folder_facts.get('modify'), count=len(server_files),
+                                  missing=len(file_difference))
+        return missing
+
+    def is_settled(self, folder: str) -> bool:
+        try:
+            folder_date = datetime.strptime(folder, '%Y-%m-%d')
+        except ValueError:
+            return False
+        return folder_date < datetime.now() - timedelta(days=self.settle_days + 1)
+
+    def update_state(self, missing: Dict[str, List[Tuple[str, str, Dict]]]):
+        for cam, files in missing.items():
+            for folder in {folder for folder, _, _ in files}:
+                failed = sum(1 for failed_cam, failed_folder, _ in self._failed
+                             if (failed_cam, failed_folder) == (cam, folder))
+                self.state.update(cam, folder, missing=failed)
+        for cam, folders in self.state.folders.items():
+            for folder, folder_state in folders.items():
+                if folder_state.get('missing') == 0 and self.is_settled(folder):
+                    folder_state['complete'] = True
+        self.state.save()
+
+    @staticmethod
+    def schedule_downloads(missing: Dict[str, List[Tuple[str, str, Dict]]]) -> List[Tuple[str, str, str, Dict]]:
+        # round robin over cameras so one camera's backlog can not starve the others
+        order = []
+        pending = {cam: list(files) for cam, files in missing.items()}
+        while any(pending.values()):
+            for cam, files in pending.items():
+                if files:
+                    folder, file, facts = files.pop(0)
+                    order.append((cam, folder, file, facts))
+        return order
+
+    def download(self, sess: ftplib.FTP, cam: str, folder: str, file: str, facts: Optional[Dict] = None):
+        def write(block):
+            self.limiter.consume(len(block))
+            ftpfile.write(block)
+
+        facts = facts or {}
+        remote_path = os.path.join(self.server_dir, cam, folder, file)
+        local_path = os.path.join(self.local_dir, cam, folder, file)
+        # the pipeline only picks up .jpg files, so nothing sees the file before it is complete
+        part_path = local_path + PART_SUFFIX
+
+        sess.voidcmd('TYPE I')
+        if 'size' in facts:
+            remote_size = int(facts.get('size'))
+        else:
+            try:
+                remote_size = sess.size(remote_path)
+            except ftplib.error_perm:
+                remote_size = None
+
+        # resume an interrupted download instead of starting from byte zero
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if remote_size is not None and offset > remote_size:
+            offset = 0
+        with open(part_path, 'ab' if offset else 'wb') as ftpfile:
+            sess.retrbinary('RETR ' + remote_path, write, rest=offset or None)
+
+        local_size = os.path.getsize(part_path)
+        if remote_size is not None and local_size != remote_size:
+            if local_size > remote_size:
+                os.remove(part_path)
+            raise ftplib.error_reply('{} has {} bytes, expected {}'.format(remote_path, local_size, remote_size))
+        if 'modify' in facts:
+            modified = calendar.timegm(time.strptime(facts.get('modify')[:14], '%Y%m%d%H%M%S'))
+            os.utime(part_path, (modified, modified))
+        os.replace(part_path, local_path)
+        if self.inserter is not None:
+            try:
+                self.inserter.add(self.inserter.db_up.image_post(cam, folder, file, image_path=local_path))
+                self.inserter.flush_if_due()
+            except PyMongoError as error:
+                # the documents stay queued in the inserter and are inserted by a later flush
+                print('Failed to insert the documents of {}/{}/{}: {!r}'.format(cam, folder, file, error))
+        if self.delete_remote:
+            sess.delete(remote_path)
+
+    def download_worker(self, work: queue.Queue):
+        sess = self.connect()
+        try:
+            while True:
+                try:
+                    cam, folder, file, facts = work.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    self.download(sess, cam, folder, file, facts)
+                except ftplib.all_errors as error:
+                    # the .part file is kept and resumed on the next run
+                    print('Failed to download {}/{}/{}: {!r}'.format(cam, folder, file, error))
+                    with self._lock:
+                        self._failed.add((cam, folder, file))
+                    # the session may be broken after a dropped connection
+                    sess.close()
+                    sess = self.connect()
+        finally:
+            sess.close()
+
+    def server_sync(self):
+        sess = self.connect()
+        try:
+            missing = self.missing_files(sess)
+        finally:
+            sess.quit()
+
+        work = queue.Queue()
+        for item in self.schedule_downloads(missing):
+            work.put(item)
+        threads = [threading.Thread(target=self.download_worker, args=(work,), daemon=True)
+                   for _ in range(min(self.workers, work.qsize()))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # files left behind by a worker that could not reconnect
+        while not work.empty():
+            cam, folder, file, _ = work.get_nowait()
+            self._failed.add((cam, folder, file))
+        self.update_state(missing)
+        self._failed = set()
+        if self.inserter is not None:
+            try:
+                self.inserter.flush()
+            except PyMongoError as error:
+                print('Failed to insert the synced documents, retrying on the next sync: {!r}'.format(error))
 
     def update_24(self):
 
-        schedule.every().day.at('00:01').do(self.server_sync)
+        if cfg.ftp_sync.get('every_minutes'):
+            schedule.every(cfg.ftp_sync.get('every_minutes')).minutes.do(self.server_sync)
+        else:
+            schedule.every().day.at('00:01').do(self.server_sync)
         print('Syncing Files')
         # schedule.run_all()
         while True:
@@ -46,5 +281,11 @@ class SyncData:
 
 
 if __name__ == '__main__':
-    ftp_sync = SyncData()
+    if cfg.ftp_sync.get('ingest'):
+        # imported here so the plain sync does not need a database connection
+        from db_script import DbUp, BatchInserter
+        db_up = DbUp(cfg.mongo_cfg.get('db_name'), cfg.mongo_cfg.get('db_raw_clc'))
+        ftp_sync = SyncData(inserter=BatchInserter(db_up))
+    else:
+        ftp_sync = SyncData()
     ftp_sync.update_24()
@@ -0,0 +1,404 @@
+"""
+This script runs the inference worker processes of one model and scales their number with the backlog.
+
+A single TF session leaves most cores of a large host idle, and a fixed number of workers either takes days to catch
+up after an FTP outage or holds memory while idle at night. The supervisor runs between min_processes and
+max_processes workers, each with its own model instance, Mongo client and TF thread pools sized by intra_op_threads
+and inter_op_threads. Every scale_interval it compares the open jobs of the model (one per image without its
+predictions) with the measured images per second of a worker, and adds workers until the backlog would be cleared
+within drain_minutes. Without a backlog workers are retired one at a time down to min_processes.
+
+Retiring a worker drains it: it stops claiming jobs, finishes the batches it already claimed and exits, so no image
+is left leased. SIGTERM (docker stop) and Ctrl+C drain all workers the same way before the supervisor exits. Workers
+claim their images from the jobs collection, whose leases hand every image to one worker only, and workers which
+exit on their own are restarted. A worker crashing again and again, e.g. on a broken model file, is restarted with an
+exponentially growing delay, and once it crashed CRASH_LIMIT times in a row within CRASH_WINDOW seconds every further
+crash is logged as an error.
+
+This script requires pymongo and the dependencies of the supervised model to be installed. The database server and
+port also need to be defined in the configuration file. Run it with the model as argument:
+    python3 supervisor.py OD
+
+This script can also be imported as a module and contains the Supervisor class.
+"""
+
+import argparse
+import math
+import multiprocessing
+import os
+import queue
+import signal
+import time
+from typing import Optional
+
+from pymongo import MongoClient
+
+# noinspection PyUnresolvedReferences
+import cfg
+from job_queue import JobQueue
+from schema import wait_for_primary
+
+# Weight of the latest measurement in the per worker throughput estimate
+RATE_SMOOTHING = 0.5
+# Seconds before a crashed worker is restarted, doubled on every further crash of its slot up to RESTART_DELAY_MAX
+RESTART_DELAY_MIN = 1
+RESTART_DELAY_MAX = 300
+# Crashes of a slot without a finished batch in between, within CRASH_WINDOW seconds, after which they are errors
+CRASH_LIMIT = 5
+CRASH_WINDOW = 600
+
+
+def worker_count(processes: Optional[int], intra_op_threads: int) -> int:
+    """
+    Returns the number of worker processes, as many as fit on the cores if processes is not given
+    """
+
+    return processes or max(1, (os.cpu_count() or 1) // intra_op_threads)
+
+
+def run_od_worker(intra_op_threads: int, inter_op_threads: int, on_batch, stop):
+    """
+    Runs the OD worker of yolo_db until stop is set
+    """
+
+    import tensorflow as tf
+    from keras import backend as K
+    K.set_session(tf.Session(config=tf.ConfigProto(intra_op_parallelism_threads=intra_op_threads,
+                                                   inter_op_parallelism_threads=inter_op_threads)))
+    # imported once the session is set, YOLO picks it up through K.get_session
+    import yolo_db
+    yolo_model = yolo_db.create_model(intra_op_threads, inter_op_threads)
+    yolo_db.db(yolo_model, on_batch=on_batch, stop=stop)
+
+
+def run_sg_worker(intra_op_threads: int, inter_op_threads: int, on_batch, stop):
+    """
+    Runs the SG worker of segmentation_db until stop is set
+    """
+
+    import tensorflow as tf
+    # TF 2 sizes its thread pools once, before the model is built when segmentation_db is imported
+    tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+    import segmentation_db
+    segmentation_db.db(segmentation_db.predict_, on_batch=on_batch, stop=stop)
+
+
+# Worker entry points of the models
+WORKERS = {'OD': run_od_worker, 'SG': run_sg_worker}
+
+
+def run_worker(model: str, index: int, intra_op_threads: int, inter_op_threads: int, reports, stop):
+    """
+    Entry point of a worker process, reports (index, images) to the supervisor after every batch
+    """
+
+    # Ctrl+C reaches the whole process group, the supervisor drains the workers through stop instead
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # OpenMP thread pools, e.g. of MKL builds of tensorflow, are sized from the environment when they are loaded
+    os.environ['OMP_NUM_THREADS'] = str(intra_op_threads)
+    WORKERS[model](intra_op_threads, inter_op_threads, lambda images: reports.put((index, images)), stop)
+
+
+class Supervisor:
+    """
+    A class for running the inference worker processes of a model and scaling them with its backlog
+
+    Attributes
+    ----------
+    model : str
+        Model whose workers are run, a key of WORKERS
+    min_processes : int
+        Workers kept running without a backlog
+    max_processes : int
+        Most workers run at once
+    drain_minutes : float
+        Minutes the workers should take to clear the backlog
+    scale_interval : float
+        Seconds between scaling decisions
+    intra_op_threads : int
+        Threads TF uses inside one operation in every worker
+    inter_op_threads : int
+        Operations TF runs in parallel in every worker
+    report_interval : float
+        Seconds between throughput reports
+    queue : JobQueue
+        Jobs of the model, used to measure the backlog
+
+    Methods
+    -------
+    start_worker(index=None)
+        Starts a new worker process
+    retire_worker()
+        Drains the newest worker process
+    target(backlog)
+        Returns the number of workers for a backlog
+    scale(seconds)
+        Measures the throughput over the last seconds and starts or retires workers
+    report(seconds)
+        Prints the images per second of every worker over the last seconds
+    stop()
+        Makes run drain all workers and return
+    run()
+        Runs and scales the workers until stop is called
+    """
+
+    def __init__(self, model: Optional[str] = 'OD',
+                 min_processes: Optional[int] = cfg.supervisor.get('min_processes'),
+                 max_processes: Optional[int] = cfg.supervisor.get('max_processes'),
+                 drain_minutes: Optional[float] = cfg.supervisor.get('drain_minutes'),
+                 scale_interval: Optional[float] = cfg.supervisor.get('scale_interval'),
+                 intra_op_threads: Optional[int] = cfg.supervisor.get('intra_op_threads'),
+                 inter_op_threads: Optional[int] = cfg.supervisor.get('inter_op_threads'),
+                 report_interval: Optional[float] = cfg.supervisor.get('report_interval'),
+                 queue: Optional[JobQueue] = None):
+        """
+        Parameters
+        ----------
+        model : str, optional
+            Model whose workers are run, a key of WORKERS (Default is 'OD')
+        min_processes : int, optional
+            Workers kept running without a backlog, may be 0 (Default is cfg.supervisor['min_processes'])
+        max_processes : int, optional
+            Most workers run at once, None to fit as many as the cores allow at intra_op_threads each
+            (Default is cfg.supervisor['max_processes'])
+        drain_minutes : float, optional
+            Minutes the workers should take to clear the backlog (Default is cfg.supervisor['drain_minutes'])
+        scale_interval : float, optional
+            Seconds between scaling decisions (Default is cfg.supervisor['scale_interval'])
+        intra_op_threads : int, optional
+            Threads TF uses inside one operation in every worker (Default is cfg.supervisor['intra_op_threads'])
+        inter_op_threads : int, optional
+            Operations TF runs in parallel in every worker (Default is cfg.supervisor['inter_op_threads'])
+        report_interval : float, optional
+            Seconds between throughput reports (Default is cfg.supervisor['report_interval'])
+        queue : JobQueue, optional
+            Jobs of the model (Default is None, connects to the configured database)
+        """
+
+        self.model = model
+        self.max_processes = worker_count(max_processes, intra_op_threads)
+        self.min_processes = min(min_processes, self.max_processes)
+        self.drain_minutes = drain_minutes
+        self.scale_interval = scale_interval
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.report_interval = report_interval
+        if queue is None:
+            client = MongoClient(cfg.mongo_cfg.get('db_server').get('host'),
+                                 int(cfg.mongo_cfg.get('db_server').get('port')))
+            wait_for_primary(client)
+            queue = JobQueue(client[cfg.mongo_cfg.get('db_name')], cfg.mongo_cfg.get('db_jobs_clc'), model)
+        self.queue = queue
+        # every worker imports tensorflow and connects to mongo itself, neither survives a fork
+        self._context = multiprocessing.get_context('spawn')
+        self._reports = self._context.Queue()
+        # index -> (process, stop event) of running and of draining workers
+        self._workers = {}
+        self._retiring = {}
+        # index -> monotonic time a crashed worker is restarted at, and the times its slot crashed since the last batch
+        self._restarts = {}
+        self._crashes = {}
+        # images per worker since the last report and since the last scaling decision
+        self._images = {}
+        self._scale_images = {}
+        # measured images per second of one worker, None until a worker finished a batch
+        self._rate = None
+        self._stopping = False
+
+    def start_worker(self, index: Optional[int] = None):
+        """
+        Starts a new worker process
+
+        Parameters
+        ----------
+        index : int, optional
+            Slot of the worker (Default is None, the lowest free slot)
+        """
+
+        if index is None:
+            used = set(self._workers) | set(self._retiring) | set(self._restarts)
+            index = min(set(range(len(used) + 1)) - used)
+        stop = self._context.Event()
+        process = self._context.Process(target=run_worker, name='{}_worker_{}'.format(self.model.lower(), index),
+                                        args=(self.model, index, self.intra_op_threads, self.inter_op_threads,
+                                              self._reports, stop),
+                                        daemon=True)
+        process.start()
+        self._workers[index] = (process, stop)
+        self._images.setdefault(index, 0)
+
+    def retire_worker(self):
+        """
+        Drains the newest worker process, it exits once its claimed batches are done
+        """
+
+        index = max(self._workers)
+        process, stop = self._workers.pop(index)
+        stop.set()
+        self._retiring[index] = (process, stop)
+
+    def target(self, backlog: int) -> int:
+        """
+        Returns the number of workers for a backlog
+
+        Parameters
+        ----------
+        backlog : int
+            Open jobs of the model
+
+        Returns
+        -------
+        processes : int
+            Workers needed to clear the backlog within drain_minutes at the measured throughput, within the bounds
+        """
+
+        if backlog == 0:
+            return self.min_processes
+        if self._rate:
+            wanted = math.ceil(backlog / (self._rate * self.drain_minutes * 60))
+        else:
+            # throughput is unknown until a worker loaded its model and finished a batch, keep what is running
+            wanted = max(len(self._workers), 1)
+        return min(max(wanted, self.min_processes), self.max_processes)
+
+    def scale(self, seconds: float):
+        """
+        Measures the throughput over the last seconds and starts or retires workers
+
+        Workers are started all at once, but retired one per call so a short gap in the backlog does not drop them
+        all.
+
+        Parameters
+        ----------
+        seconds : float
+            Time since the last call
+        """
+
+        backlog = self.queue.backlog()
+        # only workers which finished a batch count, idle or still loading workers would lower the estimate
+        if backlog and self._scale_images:
+            rate = sum(self._scale_images.values()) / seconds / len(self._scale_images)
+            self._rate = rate if self._rate is None else RATE_SMOOTHING * rate + (1 - RATE_SMOOTHING) * self._rate
+        self._scale_images = {}
+
+        target = self.target(backlog)
+        # crashed workers waiting for their restart count as running, so scaling does not bypass their backoff
+        running = len(self._workers) + len(self._restarts)
+        if target != running:
+            print('{} backlog {}, {:.2f} images/s per worker, {} workers running, target {}'.format(
+                self.model, backlog, self._rate or 0, running, target))
+        while len(self._workers) + len(self._restarts) < target:
+            self.start_worker()
+        if len(self._workers) + len(self._restarts) > target:
+            if self._restarts:
+                del self._restarts[max(self._restarts)]
+            else:
+                self.retire_worker()
+
+    def _collect(self, timeout: float):
+        """
+        Adds up the reports sent by the workers within timeout seconds
+        """
+
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                index, images = self._reports.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                return
+            self._images[index] = self._images.get(index, 0) + images
+            self._scale_images[index] = self._scale_images.get(index, 0) + images
+            # a worker finishing a batch ends the crash streak of its slot
+            self._crashes.pop(index, None)
+
+    def _reap(self):
+        """
+        Removes drained workers and restarts workers which exited on their own, with backoff for repeated crashes
+        """
+
+        now = time.monotonic()
+        for index, (process, _) in list(self._retiring.items()):
+            if not process.is_alive():
+                print('{} worker {} drained'.format(self.model, index))
+                del self._retiring[index]
+        for index, (process, _) in list(self._workers.items()):
+            if not process.is_alive():
+                del self._workers[index]
+                crashes = [crashed for crashed in self._crashes.get(index, []) if now - crashed < CRASH_WINDOW] + [now]
+                self._crashes[index] = crashes
+                delay = min(RESTART_DELAY_MIN * 2 ** (len(crashes) - 1), RESTART_DELAY_MAX)
+                self._restarts[index] = now + delay
+                if len(crashes) >= CRASH_LIMIT:
+                    print('ERROR: {} worker {} exited with code {}, {} crashes within {} seconds without finishing a '
+                          'batch, restarting it in {} seconds'.format(self.model, index, process.exitcode,
+                                                                      len(crashes), CRASH_WINDOW, delay))
+                else:
+                    print('{} worker {} exited with code {}, restarting it in {} seconds'.format(
+                        self.model, index, process.exitcode, delay))
+        for index, restart_at in list(self._restarts.items()):
+            if now >= restart_at and not self._stopping:
+                del self._restarts[index]
+                self.start_worker(index)
+
+    def report(self, seconds: float):
+        """
+        Prints the images per second of every worker over the last seconds and resets the counts
+
+        Parameters
+        ----------
+        seconds : float
+            Length of the reported interval
+        """
+
+        total = 0
+        for index in sorted(self._images):
+            total += self._images[index]
+            print('{} worker {}: {:.2f} images/s'.format(self.model, index, self._images[index] / seconds))
+        print('{} workers: {:.2f} images/s in total over {} processes'.format(self.model, total / seconds,
+                                                                             len(self._workers)))
+        self._images = {index: 0 for index in self._workers}
+
+    def stop(self):
+        """
+        Makes run drain all workers and return, safe to call from a signal handler
+        """
+
+        self._stopping = True
+
+    def run(self):
+        """
+        Runs and scales the workers until stop is called, then drains them
+        """
+
+        print('Running {} to {} {} workers with {} intra op and {} inter op threads'.format(
+            self.min_processes, self.max_processes, self.model, self.intra_op_threads, self.inter_op_threads))
+        last_scale = last_report = time.monotonic()
+        self.scale(self.scale_interval)
+        while not self._stopping:
+            self._collect(1)
+            self._reap()
+            now = time.monotonic()
+            if now - last_scale >= self.scale_interval:
+                self.scale(now - last_scale)
+                last_scale = now
+            if now - last_report >= self.report_interval:
+                self.report(now - last_report)
+                last_report = now
+
+        print('Draining {} {} workers'.format(len(self._workers) + len(self._retiring), self.model))
+        self._restarts = {}
+        while self._workers:
+            self.retire_worker()
+        while self._retiring:
+            self._collect(1)
+            self._reap()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run and autoscale the inference workers of a model.')
+    parser.add_argument('model', nargs='?', default='OD', choices=sorted(WORKERS), help='Model to run workers for.')
+    supervisor = Supervisor(parser.parse_args().model)
+    signal.signal(signal.SIGTERM, lambda signum, frame: supervisor.stop())
+    signal.signal(signal.SIGINT, lambda signum, frame: supervisor.stop())
+    supervisor.run()
@@ -1,43 +1,216 @@
 import os
+import socket
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
 
+import numpy as np
 from PIL import Image
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
 
 import cfg
+import image_loader
+import predictions
+from cluster import Cluster
+from job_queue import JobQueue
+from schema import ensure_indexes
 from OD_model.yolo import YOLO
 
 client = MongoClient(cfg.mongo_cfg.get('db_server').get('host'), int(cfg.mongo_cfg.get('db_server').get('port')))
 db = client[cfg.mongo_cfg.get('db_name')]
 collection = db[cfg.mongo_cfg.get('db_raw_clc')]
+ensure_indexes(db)
+worker_name = '{}-{}'.format(socket.gethostname(), os.getpid())
+# with cfg.cluster enabled the worker is a node of the cluster and only claims jobs of the partitions it owns
+cluster = Cluster(db, cfg.mongo_cfg.get('db_nodes_clc'), 'OD', worker_name) if cfg.cluster.get('enabled') else None
+queue = JobQueue(db, cfg.mongo_cfg.get('db_jobs_clc'), 'OD', cluster=cluster)
+# with a score floor the model keeps low scoring candidates and the counts are taken at its default operating point
+score_floor = cfg.od_worker.get('score_floor')
+operating_point = (YOLO.get_defaults('score'), YOLO.get_defaults('iou'), YOLO.get_defaults('max_boxes')) \
+    if score_floor else None
 
 
-def db(yolo_model, save=False):
+def predict_document(yolo_model, document, save=False):
+    id = document.get('_id')
+    cam_id, folder_name, image_name = id.split('_')
+    # cam_id = id[0]
+    # folder_name = id[1]
+    # image_name = id[2]
+    image_path = os.path.join(cfg.directories.get('main_dir'), cam_id,
+                              folder_name, image_name + '.jpg')
+    # broken files are known from the header read at ingest, no need to decode them
+    if document.get('image', {}).get('decodable') is False:
+        collection.update_one({'_id': id}, {'$set': predictions.empty()})
+        return
+    # I/O errors are raised so the job is handed out again, only a file which can not be decoded gets no predictions
+    with open(image_path, 'rb') as image_file:
+        try:
+            image = Image.open(image_file)
+            image.load()
+        # In case we get corrupted file from server
+        except OSError:
+            collection.update_one({'_id': id}, {'$set': predictions.empty()})
+            return
+    if save is True:
+        image, annot = yolo_model.detect_image(image, save)
+        save_dir = cfg.directories.get('save_dir')
+        if not os.path.exists(save_dir):
+            os.mkdir(save_dir)
+        image.save(os.path.join(save_dir,cam_id,folder_name,image_name + '.jpg'))
+    else:
+        annot = yolo_model.detect_image(image)
+    collection.update_one({'_id': id}, {'$set': dict(
+        predictions.from_annotations(annot, yolo_model.class_names, operating_point), od_score_floor=score_floor)})
+
+
+def load_image(document, fit=None):
+    # returns (image, original (width, height)) or None for files which can not be decoded. With fit the JPEG is
+    # decoded at the smallest DCT scale that still covers the letterbox. Opening the file is outside the try, so a
+    # missing or unreadable file raises and its job is handed back instead of getting empty predictions
+    if document.get('image', {}).get('decodable') is False:
+        return None
+    cam_id, folder_name, image_name = document.get('_id').split('_')
+    image_path = os.path.join(cfg.directories.get('main_dir'), cam_id, folder_name, image_name + '.jpg')
+    with open(image_path, 'rb') as image_file:
+        try:
+            return image_loader.load_image(image_file, fit=fit)
+        # PIL raises OSError, e.g. UnidentifiedImageError, for files which are not a complete image
+        except OSError:
+            return None
+
+
+def prepare_document(yolo_model, document, out, save=False):
+    # letterboxes the image into its row of the batch buffer, returns (original (width, height), image kept for
+    # drawing) or None for files which can not be decoded. Runs on the decode threads, saved results are drawn on the
+    # full resolution image. Other errors are raised and fail the job of the document
+    loaded = load_image(document, None if save is True else tuple(reversed(yolo_model.model_image_size)))
+    if loaded is None:
+        return None
+    image, original_size = loaded
+    yolo_model.preprocess(image, out)
+    return original_size, image if save is True else None
+
+
+def prefetch(yolo_model, batches, buffers, batch_size, decode_workers, save=False, stop=None):
+    # claims job batches and decodes their images ahead of the model, blocks once all buffers are in use. Once stop
+    # is set no more jobs are claimed and None tells the model loop that the batches already claimed are all
+    try:
+        with ThreadPoolExecutor(decode_workers) as pool:
+            while stop is None or not stop.is_set():
+                buffer = buffers.get()
+                jobs = queue.next_jobs(worker_name, batch_size, stop)
+                if not jobs:
+                    break
+                documents = list(collection.find({'_id': {'$in': [job.get('doc_id') for job in jobs]}}))
+                futures = [pool.submit(prepare_document, yolo_model, document, out, save)
+                           for document, out in zip(documents, buffer)]
+                batches.put((jobs, documents, buffer, futures))
+        batches.put(None)
+    except Exception as error:
+        traceback.print_exc()
+        batches.put(error)
+
+
+def predict_prepared(yolo_model, documents, buffer, prepared, save=False, failed=()):
+    # returns the _id of the documents which could not be predicted, their jobs are handed back. failed holds the
+    # documents whose preparation already failed, they are left without predictions
+    fields = {document.get('_id'): predictions.empty() for document in documents
+              if document.get('_id') not in failed}
+    rows = [row for row, item in enumerate(prepared) if item is not None]
+    if rows:
+        # the buffer is only copied when undecodable images left gaps in it
+        image_data = buffer[:len(rows)] if len(rows) == len(documents) else buffer[rows]
+        try:
+            detections = yolo_model.detect_batch(image_data, [prepared[row][0] for row in rows])
+        except Exception:
+            # fall back to one image at a time so a single bad image does not fail the whole batch
+            traceback.print_exc()
+            failed = []
+            for document in documents:
+                try:
+                    predict_document(yolo_model, document, save)
+                except Exception:
+                    # the job is handed out again until it runs out of attempts
+                    traceback.print_exc()
+                    failed.append(document.get('_id'))
+            return failed
+
+        for row, detection in zip(rows, detections):
+            document = documents[row]
+            size, image = prepared[row]
+            fields[document.get('_id')] = dict(predictions.pack(*detection, size, yolo_model.class_names,
+                                                                operating_point), od_score_floor=score_floor)
+            if save is True:
+                image, _ = yolo_model.annotate(size, *detection, image)
+                cam_id, folder_name, image_name = document.get('_id').split('_')
+                save_dir = cfg.directories.get('save_dir')
+                if not os.path.exists(save_dir):
+                    os.mkdir(save_dir)
+                image.save(os.path.join(save_dir, cam_id, folder_name, image_name + '.jpg'))
+    if fields:
+        collection.bulk_write([UpdateOne({'_id': id}, {'$set': document_fields})
+                               for id, document_fields in fields.items()], ordered=False)
+    return list(failed)
+
+
+def create_model(intra_op_threads=None, inter_op_threads=None):
+    # the thread counts size the onnxruntime pools, a TF session is configured before it is created
+    options = dict(frozen_graph_path=cfg.od_worker.get('frozen_graph_path'), backend=cfg.od_worker.get('backend'),
+                   intra_op_threads=intra_op_threads, inter_op_threads=inter_op_threads)
+    if cfg.od_worker.get('onnx_path'):
+        options['onnx_path'] = cfg.od_worker.get('onnx_path')
+    if score_floor:
+        return YOLO(score=score_floor, iou=cfg.od_worker.get('candidate_iou'),
+                    max_boxes=cfg.od_worker.get('candidate_max_boxes'), **options)
+    return YOLO(**options)
+
+
+def db(yolo_model, save=False, batch_size=cfg.od_worker.get('batch_size'),
+       decode_workers=cfg.od_worker.get('decode_workers'), prefetch_batches=cfg.od_worker.get('prefetch_batches'),
+       on_batch=None, stop=None):
+    # on_batch is called with the number of finished jobs after every batch, e.g. to report throughput. Setting the
+    # stop event drains the worker: claimed batches are finished and db returns, nothing is left leased
+    # preallocated model inputs, one per batch in flight: prefetch_batches queued, one being decoded and one in the
+    # model. The decoded images are written straight into them, so the pipeline memory is fixed
+    buffers = Queue()
+    for _ in range(prefetch_batches + 2):
+        buffers.put(np.empty((batch_size,) + tuple(yolo_model.model_image_size) + (3,), dtype='float32'))
+    batches = Queue(maxsize=prefetch_batches)
+    if cluster is not None:
+        cluster.join()
+    threading.Thread(target=prefetch, args=(yolo_model, batches, buffers, batch_size, decode_workers, save, stop),
+                     daemon=True).start()
     while True:
-        documents = collection.find({"OD_Predictions": {"$exists": False}})
-        for document in documents:
-            id = document.get('_id')
-            cam_id, folder_name, image_name = id.split('_')
-            # cam_id = id[0]
-            # folder_name = id[1]
-            # image_name = id[2]
-            image_path = os.path.join(cfg.directories.get('main_dir'), cam_id,
-                                      folder_name, image_name + '.jpg')
+        batch = batches.get()
+        if batch is None:
+            # the batches claimed before stop are done, the partitions can move to the other nodes
+            if cluster is not None:
+                cluster.leave()
+            return
+        if isinstance(batch, Exception):
+            raise batch
+        jobs, documents, buffer, futures = batch
+        prepared, failed = [], []
+        for document, future in zip(documents, futures):
             try:
-                image = Image.open(image_path)
-                if save is True:
-                    image, annot = yolo_model.detect_image(image, save)
-                    save_dir = cfg.directories.get('save_dir')
-                    if not os.path.exists(save_dir):
-                        os.mkdir(save_dir)
-                    image.save(os.path.join(save_dir,cam_id,folder_name,image_name + '.jpg'))
-                else:
-                    annot = yolo_model.detect_image(image)
-                collection.update_one({'_id': id}, {'$set': {'OD_Predictions': annot}})
-            # In case we get corrupted file from server
-            except:
-                collection.update_one({'_id': id}, {'$set': {'OD_Predictions': []}})
+                prepared.append(future.result())
+            except Exception:
+                # e.g. a file which is missing or can not be read right now, not one which can not be decoded
+                traceback.print_exc()
+                prepared.append(None)
+                failed.append(document.get('_id'))
+        failed = set(predict_prepared(yolo_model, documents, buffer, prepared, save, failed)) if documents else set()
+        buffers.put(buffer)
+        for job in jobs:
+            if job.get('doc_id') in failed:
+                queue.fail(job)
+            else:
+                queue.complete(job)
+        if on_batch is not None:
+            on_batch(len(jobs))
 
 
 if __name__ == '__main__':
-    yolo_model = YOLO()
+    yolo_model = create_model()
     db(yolo_model, save=False)
\ No newline at end of file